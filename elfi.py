@@ -1,17 +1,276 @@
 #!/usr/bin/env python3
+import argparse
+import bz2
+import cProfile
+import errno
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import lzma
 import os
+import re
+import select
 import shutil
+import sqlite3
+import stat
+import struct
 import sys
-from itertools import filterfalse
+import tarfile
+import tempfile
+import tracemalloc
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Set
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import chain
+from queue import Queue
+from threading import Lock, Thread, get_ident
+from time import (localtime, perf_counter, sleep, strftime, strptime, time,
+        time_ns)
+from types import SimpleNamespace
+
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 #TODO
 # - logging instead of printing
 # - tests
-# - actually make directory changes
-# - filters to exclude certain files
-# - tar and compress option
 
-def diff_walk(base, backup):
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+DELTA_BLOCK_SIZE = 1024 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+FICLONE = 0x40049409
+ARCHIVE_CHUNK_SIZE = 1024 * 1024
+ARCHIVE_QUEUE_SIZE = 8
+ARCHIVE_MANIFEST = '.elfi-manifest.json'
+SMALL_FILE_BATCH = 256
+PRESERVE_OWNER = hasattr(os, 'geteuid') and os.geteuid() == 0
+SNAPSHOT_PARTIAL_SUFFIX = '.partial'
+STORE_CHUNK_SIZE = 4 * 1024 * 1024
+STORE_MANIFEST_SUFFIX = '.json.gz'
+THROTTLE_MIN_SCALE = 1 / 16
+THROTTLE_ADAPT_INTERVAL = 1.0
+THROTTLE_MIN_BYTES = 64 * 1024
+WATCH_INTERVAL = 10.0
+INOTIFY_BUFFER_SIZE = 64 * 1024
+INOTIFY_EVENT = struct.Struct('iIII')
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+                | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+SIZE_SUFFIXES = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+                'T': 1024 ** 4}
+
+def diff_walk(base, backup, workers=1, index=None, compare=None,
+                path_filter=None, observer=None, detect_moves=False):
+    """Compares base against backup, returning the (add, remove, update) sets.
+
+    The sets are views of a single DiffResult.  With detect_moves a fourth
+    set of (old, new) pairs is returned, holding entries removed at old that
+    were added at new unchanged, see find_moves(); they are left out of the
+    add and remove sets.
+    """
+    result = collect_diff(iter_diff(base, backup, workers, index, compare,
+            path_filter, observer))
+    diff_sets = (result.view('add'), result.view('remove'),
+            result.view('update'))
+    if not detect_moves:
+        return diff_sets
+    base = os.path.abspath(base)
+    if not os.path.isdir(base):
+        base = os.path.dirname(base)
+    move_set = find_moves(base, os.path.abspath(backup), *diff_sets[:2])
+    for old, new in move_set:
+        result.discard('remove', old)
+        result.discard('add', new)
+    return diff_sets + (move_set,)
+
+def collect_diff(events):
+    """Builds a DiffResult from iter_diff() events, printing the warnings."""
+    result = DiffResult()
+    errors = []
+    for event in record_diff(events, result, errors):
+        pass
+    print_diff_warnings(result, errors)
+    return result
+
+def record_diff(events, result, errors):
+    """Passes iter_diff() events through, recording them on the way.
+
+    Changes are added to result, a DiffResult, and the items of 'error'
+    events appended to errors, so that a consumer such as backup_stream()
+    can apply the changes while the walk goes on.
+    """
+    for action, item in events:
+        if action == 'error':
+            errors.append(item)
+        else:
+            result.add(action, item)
+        yield action, item
+
+def print_diff_warnings(result, errors):
+    """Prints the newer backup files and errors recorded by record_diff()."""
+    for path in result.view('newer'):
+        print('Warning: backup file newer than original:')
+        print('    {}'.format(path))
+    for path, error in sorted(errors, key=lambda error: error[0]):
+        print('Warning: could not compare {}: {}'.format(path, error))
+
+def diff_changed_dirs(base, backup, rel_dirs, compare=None, path_filter=None,
+                        observer=None):
+    """Compares only the directories rel_dirs of base against backup.
+
+    Returns the diff_walk() sets.  Unlike diff_walk() the subdirectories are
+    not descended into, so rel_dirs must hold every directory whose entries
+    changed, e.g. as InotifyWatcher.read() returns them.  Directories below
+    an entry added or removed, or missing on either side, are skipped; the
+    changes to their parents cover them.
+    """
+    def events():
+        replaced = set()
+        for rel_dir in sorted(rel_dirs,
+                key=lambda rel_dir: rel_dir.count(os.path.sep)):
+            if (rel_dir in replaced
+                    or any(parent in replaced
+                        for parent in rel_path_parents(rel_dir))
+                    or not os.path.isdir(os.path.join(base, rel_dir))
+                    or not os.path.isdir(os.path.join(backup, rel_dir))):
+                continue
+            for action, item in dir_diff_events(diff_dir(base, backup, rel_dir,
+                    None, compare, path_filter, observer)):
+                if action in ('add', 'remove'):
+                    replaced.add(item)
+                yield action, item
+
+    result = collect_diff(events())
+    return (result.view('add'), result.view('remove'), result.view('update'))
+
+def find_moves(base, backup, add_set, remove_set):
+    """Returns (old, new) pairs for removed entries that reappear as added ones.
+
+    A removed backup entry and an added base entry match if they have the
+    same type and, for files, the same size and mtime, which is what
+    compare_mtime() judges files by.  Directories must match in the names,
+    sizes and mtimes of their immediate entries.  A candidate is then
+    confirmed, a file by comparing content digests, since unrelated files
+    often share a size and mtime, e.g. after extracting a tar archive, and
+    a directory by comparing the whole subtrees, so that renaming the backup
+    directory leaves it identical to the base one.  Only removed and added
+    entries are stat'ed.  Among several candidates one with the same name
+    is preferred.  The pairs are returned as a set-like view ordered as
+    add_set iterates, which for a diff_walk() set is by the new path.
+    """
+    candidates = {}
+    for old in remove_set:
+        try:
+            key = entry_fingerprint(os.path.join(backup, old))
+        except OSError:
+            continue
+        candidates.setdefault(key, []).append(old)
+
+    moves = {}
+    for new in add_set:
+        try:
+            key = entry_fingerprint(os.path.join(base, new))
+        except OSError:
+            continue
+        olds = candidates.get(key)
+        if not olds:
+            continue
+        name = os.path.basename(new.rstrip(os.path.sep))
+        olds.sort(key=lambda old:
+                os.path.basename(old.rstrip(os.path.sep)) != name)
+        for old in olds:
+            old_path = os.path.join(backup, old)
+            new_path = os.path.join(base, new)
+            try:
+                if new.endswith(os.path.sep):
+                    if (entry_fingerprint(old_path, True)
+                            == entry_fingerprint(new_path, True)):
+                        break
+                elif hash_file(old_path, key[1]) == hash_file(new_path, key[1]):
+                    break
+            except OSError:
+                pass
+        else:
+            continue
+        olds.remove(old)
+        moves[(old, new)] = None
+    return moves.keys()
+
+def entry_fingerprint(path, deep=False, walk_ids=frozenset()):
+    """Returns what must be unchanged for the entry at path to count as moved.
+
+    That is the size and mtime of a file, or the names of a directory's
+    entries with the sizes and mtimes of its files, and unless deep only of
+    its immediate entries.  walk_ids holds the directories the recursion
+    came through, see is_link_loop().
+    """
+    path_stat = os.stat(path)
+    if not stat.S_ISDIR(path_stat.st_mode):
+        return ('file', path_stat.st_size, path_stat.st_mtime_ns)
+    walk_ids = walk_ids | {(path_stat.st_dev, path_stat.st_ino)}
+    entries = []
+    for name, entry in sorted(scan_dir(path).items()):
+        if not is_dir_entry(entry):
+            entry_stat = entry.stat()
+            entries.append((name, entry_stat.st_size, entry_stat.st_mtime_ns))
+        elif not deep:
+            entries.append((name, 'dir'))
+        elif entry.is_symlink() and is_link_loop(os.path.join(path, name), path,
+                walk_ids):
+            raise OSError(errno.ELOOP, 'symbolic link loop',
+                    os.path.join(path, name))
+        else:
+            entries.append((name, entry_fingerprint(os.path.join(path, name),
+                    True, walk_ids)))
+    return ('dir', tuple(entries))
+
+def iter_diff(base, backup, workers=1, index=None, compare=None,
+                path_filter=None, observer=None):
+    """Yields (action, relpath) for each difference as soon as it is found.
+
+    action is 'add', 'remove' or 'update', or 'newer' for a backup file that is
+    newer than its original and is left alone.  An entry that could not be
+    listed or stat'ed is skipped and reported as an
+    ('error', (relpath, OSError)) event instead of aborting the walk.  Paths
+    are already collapsed to subtree roots, and within a directory removals
+    come before additions so an entry whose type changed is cleared before
+    it is replaced.  The paths of each action come in sorted order, the same
+    for any number of workers, see split_dir_events().  Entries excluded by
+    path_filter are left out on both sides, see PathFilter.  The walk is
+    reported to observer, see Observer.
+    """
+    start = perf_counter()
     base = os.path.abspath(base)
     backup = os.path.abspath(backup)
 
@@ -24,84 +283,2126 @@ def diff_walk(base, backup):
 
     os.makedirs(backup, exist_ok=True)
 
+    if index is not None and not index.built:
+        index.rebuild(backup)
+
+    #directories whose entries after their next subdirectory are still due,
+    #as (rel_path, iterator over the remaining split_dir_events() parts)
+    stack = []
+    for rel_path, dir_diff in walk_dir_diffs(base, backup, workers, index,
+            compare, path_filter, observer):
+        parent = parent_rel_path(rel_path)
+        while stack and stack[-1][0] != parent:
+            for events in stack.pop()[1]:
+                yield from events
+        if stack:
+            yield from next(stack[-1][1])
+        parts = split_dir_events(dir_diff)
+        if len(parts) == 1:
+            yield from parts[0]
+        else:
+            stack.append((rel_path, iter(parts)))
+    while stack:
+        for events in stack.pop()[1]:
+            yield from events
+    if observer is not None:
+        observer.phase_done('walk', perf_counter() - start)
+
+def dir_diff_events(dir_diff):
+    """Yields the iter_diff() events for a diff_dir() result."""
+    add_list, remove_list, update_list, newer_list, errors, subdirs = dir_diff
+    for error in errors:
+        yield ('error', error)
+    for item in remove_list:
+        yield ('remove', item)
+    for item in add_list:
+        yield ('add', item)
+    for item in update_list:
+        yield ('update', item)
+    for item in newer_list:
+        yield ('newer', item)
+
+def split_dir_events(dir_diff):
+    """Splits the dir_diff_events() of a diff_dir() result at its subdirs.
+
+    Returns len(subdirs) + 1 lists of events: those sorting before the first
+    subdirectory, those between the first and the second, and so on.  Emitting
+    the subdirectories' events in between keeps each action's paths sorted.
+    A removed directory is placed by its name without the trailing separator,
+    so that it still comes before an addition replacing it by a file.
+    """
+    subdirs = dir_diff[-1]
+    parts = [[] for i in range(len(subdirs) + 1)]
+    for action, item in dir_diff_events(dir_diff):
+        if action == 'error':
+            key = item[0]
+        elif action == 'remove':
+            key = item.rstrip(os.path.sep)
+        else:
+            key = item
+        parts[bisect_right(subdirs, key)].append((action, item))
+    return parts
+
+def diff_walk_targets(base, backups, workers=1, compare=None, path_filter=None,
+                        observer=None):
+    """Compares base against each of backups, walking base only once.
+
+    Returns a list holding diff_walk()'s (add, remove, update) sets for each
+    backup.
+    """
+    results = [DiffResult() for backup in backups]
+    errors = []
+    for target, action, item in iter_diff_targets(base, backups, workers,
+            compare, path_filter, observer):
+        if action == 'error':
+            errors.append((backups[target],) + item)
+        else:
+            results[target].add(action, item)
+
+    for backup, result in zip(backups, results):
+        for path in result.view('newer'):
+            print('Warning: backup file in {} newer than original:'.format(
+                    backup))
+            print('    {}'.format(path))
+    for backup, path, error in sorted(errors, key=lambda error: error[:2]):
+        print('Warning: could not compare {} with {}: {}'.format(path, backup,
+                error))
+    return [(result.view('add'), result.view('remove'), result.view('update'))
+            for result in results]
+
+def iter_diff_targets(base, backups, workers=1, compare=None, path_filter=None,
+                        observer=None):
+    """Yields (target, action, relpath) for the differences to several backups.
+
+    target is the index of the backup in backups, and action and relpath are
+    as iter_diff() yields them for that backup.  Each base directory is
+    listed once and compared against every backup holding it, see
+    diff_dir_targets().
+    """
+    start = perf_counter()
+    base = os.path.abspath(base)
+    backups = [os.path.abspath(backup) for backup in backups]
+
+    if not os.path.exists(base):
+        raise IOError('File not found: {}'.format(base))
+
+    if not os.path.isdir(base):
+        print('Warning: base path not a directory, changing to base directory')
+        base = os.path.dirname(base)
+
+    for backup in backups:
+        os.makedirs(backup, exist_ok=True)
+
+    def diff(task):
+        return diff_dir_targets(base, backups, task, compare, path_filter,
+                observer)
+
+    for task, (dir_diffs, subdirs) in walk_dirs(diff,
+            ('', tuple(range(len(backups)))), workers):
+        for target, dir_diff in sorted(dir_diffs.items()):
+            for action, item in dir_diff_events(dir_diff):
+                yield target, action, item
+    if observer is not None:
+        observer.phase_done('walk', perf_counter() - start)
+
+def diff_dir_targets(base, backups, task, compare=None, path_filter=None,
+                        observer=None):
+    """Compares a directory of base against the same one in several backups.
+
+    task is (rel_path, targets), where targets are the indexes in backups of
+    the backups holding the directory rel_path.  Returns (dir_diffs, subdirs):
+    dir_diffs maps each target to its diff_dir() result, and subdirs holds a
+    task for every subdirectory present in base and in any of the targets.
+    The base directory is listed once, and each of its entries stat'ed once,
+    however many backups it is compared against.
+    """
+    rel_path, targets = task
+    start = perf_counter()
+    try:
+        base_entries = scan_dir(os.path.join(base, rel_path))
+    except OSError as e:
+        return {target: ([], [], [], [], [(rel_path, e)], [])
+                for target in targets}, []
+    if path_filter is not None:
+        base_entries = path_filter.filter_entries(rel_path, base_entries)
+
+    dir_diffs = {}
+    shared = {}
+    entries = len(base_entries)
+    stat_calls = 0
+    for target in targets:
+        try:
+            backup_entries = scan_dir(os.path.join(backups[target], rel_path))
+        except OSError as e:
+            dir_diffs[target] = ([], [], [], [], [(rel_path, e)], [])
+            continue
+        if path_filter is not None:
+            backup_entries = path_filter.filter_entries(rel_path,
+                    backup_entries)
+        dir_diffs[target], calls = compare_entries(base, backups[target],
+                rel_path, base_entries, backup_entries, compare)
+        entries += len(backup_entries)
+        stat_calls += calls
+        for subdir in dir_diffs[target][-1]:
+            shared.setdefault(subdir, []).append(target)
+
+    if observer is not None:
+        observer.dir_listed(rel_path, entries, stat_calls,
+                perf_counter() - start)
+    return dir_diffs, [(subdir, tuple(subdir_targets))
+            for subdir, subdir_targets in sorted(shared.items())]
+
+def walk_dir_diffs(base, backup, workers=1, index=None, compare=None,
+                    path_filter=None, observer=None):
+    """Yields (rel_path, diff_dir() result) for every directory pair compared.
+
+    Both roots are walked in lockstep, only descending into directories that
+    are present on both sides, depth first in sorted order.  With more than
+    one worker the directories are compared concurrently on a thread pool,
+    reading ahead of the one to be yielded next, and yielded in the same order
+    from the calling thread.  At most workers * 4 directories are queued or
+    finished but not yet yielded, so a slow consumer such as backup_stream()
+    holds the walk back instead of letting results pile up.  With an index
+    the backup side is read from the index instead of being listed.
+    """
+    return walk_dirs(lambda rel_path: diff_dir(base, backup, rel_path, index,
+            compare, path_filter, observer), '', workers)
+
+def walk_dirs(diff, root, workers=1):
+    """Yields (task, diff(task)) for root and every subdirectory task found.
+
+    diff(task) returns a sequence ending in the sorted list of subdirectory
+    tasks still to walk.  The tasks are yielded depth first in that order,
+    whatever the number of workers.  This is the walk behind
+    walk_dir_diffs(), bounded and concurrent in the same way.
+    """
+    if workers <= 1:
+        pending = [root]
+        while pending:
+            task = pending.pop()
+            dir_diff = diff(task)
+            pending.extend(reversed(dir_diff[-1]))
+            yield task, dir_diff
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = [root]
+        futures = {}
+        while pending:
+            #the top of pending is yielded next, so read ahead from there
+            for task in reversed(pending):
+                if len(futures) >= workers * 4:
+                    break
+                if task not in futures:
+                    futures[task] = executor.submit(diff, task)
+            task = pending.pop()
+            dir_diff = futures.pop(task).result()
+            pending.extend(reversed(dir_diff[-1]))
+            yield task, dir_diff
+
+def diff_dir(base, backup, rel_path, index=None, compare=None, path_filter=None,
+                observer=None):
+    """Compares the directory rel_path of base against the same one in backup.
+
+    Returns (add_list, remove_list, update_list, newer_list, errors, subdirs),
+    where newer_list holds files whose backup is newer than the original,
+    errors holds (relpath, OSError) for entries that could not be listed or
+    stat'ed, and subdirs holds the directories present on both sides that still
+    need comparing.  Added and removed directories are reported as a single
+    entry for their whole subtree.  Each entry is stat'ed at most once per side.
+    Symbolic links are followed, as copy_to_backup() does.  Files present on
+    both sides are judged by compare, compare_mtime() by default.  Entries
+    excluded by path_filter are dropped right after listing, so excluded
+    directories are never descended into.  The listing, with its number of
+    stat calls, is reported to observer's dir_listed().
+    """
+    start = perf_counter()
+    stat_calls = 0
+    try:
+        if index is None:
+            base_entries = scan_dir(os.path.join(base, rel_path))
+            backup_entries = scan_dir(os.path.join(backup, rel_path))
+        else:
+            backup_entries = index.scan_dir(rel_path)
+            base_entries = index.scan_base_dir(base, rel_path, backup_entries)
+            #the directory itself, and each entry when it was not re-listed
+            stat_calls += 1 + sum(isinstance(entry, StatEntry)
+                    for entry in base_entries.values())
+    except OSError as e:
+        return ([], [], [], [], [(rel_path, e)], [])
+    if path_filter is not None:
+        base_entries = path_filter.filter_entries(rel_path, base_entries)
+        backup_entries = path_filter.filter_entries(rel_path, backup_entries)
+
+    dir_diff, compare_stat_calls = compare_entries(base, backup, rel_path,
+            base_entries, backup_entries, compare)
+    if observer is not None:
+        observer.dir_listed(rel_path, len(base_entries) + len(backup_entries),
+                stat_calls + compare_stat_calls, perf_counter() - start)
+    return dir_diff
+
+def compare_entries(base, backup, rel_path, base_entries, backup_entries,
+                    compare=None):
+    """Compares the scan_dir() listings of rel_path in base and in backup.
+
+    Returns the diff_dir() result and the number of stat calls made.  Both
+    listings are sorted by relative path and merged in one pass, so each
+    returned list is sorted too.  An entry whose type changed has different
+    relative paths on the two sides, so it comes out as a removal and an
+    addition.  Stat results are cached in the entries, so comparing the same
+    base entries against several backups stats each of them once.
+    """
+    compare = compare or compare_mtime
+    base_path = os.path.join(base, rel_path)
+    backup_path = os.path.join(backup, rel_path)
+    #joined once, so each entry's path is a plain concatenation
+    base_dir = os.path.join(base_path, '')
+    backup_dir = os.path.join(backup_path, '')
+
     add_list = []
     remove_list = []
     update_list = []
+    newer_list = []
+    errors = []
+    subdirs = []
+    stat_calls = 0
+
+    #key the entries by their path relative to rel_path, dirs ending in sep
+    prefix = os.path.join(rel_path, '')
+    base_keyed = {}
+    loops = set()
+    for name, base_entry in base_entries.items():
+        if not is_dir_entry(base_entry):
+            base_keyed[name] = base_entry
+        elif (base_entry.is_symlink()
+                and is_link_loop(os.path.join(base_path, name), base_path,
+                    walk_dir_ids(base, rel_path))):
+            #leave whatever the backup holds under that name alone
+            loops.add(name)
+            errors.append((prefix + name + os.path.sep, OSError(errno.ELOOP,
+                    'symbolic link loop', os.path.join(base_path, name))))
+        else:
+            base_keyed[name + os.path.sep] = base_entry
+    backup_keyed = {}
+    for name, backup_entry in backup_entries.items():
+        if name in loops:
+            continue
+        if is_dir_entry(backup_entry):
+            name += os.path.sep
+        backup_keyed[name] = backup_entry
+    base_keys = sorted(base_keyed)
+    backup_keys = sorted(backup_keyed)
 
-    #walk base root to find difference between dir trees
-    for base_path, dirs, files in os.walk(base):
-        rel_path = os.path.join(get_rel_path(base, base_path), '')
-        backup_path = os.path.join(backup, rel_path)
+    i = j = 0
+    base_count = len(base_keys)
+    backup_count = len(backup_keys)
+    while i < base_count and j < backup_count:
+        key = base_keys[i]
+        backup_key = backup_keys[j]
+        if key < backup_key:
+            add_list.append(prefix + key)
+            i += 1
+            continue
+        if backup_key < key:
+            remove_list.append(prefix + backup_key)
+            j += 1
+            continue
 
-        if not os.path.exists(backup_path):
-            add_list.append(rel_path)
+        i += 1
+        j += 1
+        if key.endswith(os.path.sep):
+            subdirs.append(prefix + key)
+            continue
+        base_entry = base_keyed[key]
+        backup_entry = backup_keyed[key]
+        stat_calls += (isinstance(base_entry, os.DirEntry)
+                + isinstance(backup_entry, os.DirEntry))
+        try:
+            change = compare(base_dir + key, backup_dir + key,
+                    base_entry.stat(), backup_entry.stat())
+        except OSError as e:
+            errors.append((prefix + key, e))
             continue
+        if change == 'update':
+            update_list.append(prefix + key)
+        elif change == 'newer':
+            newer_list.append(prefix + key)
+    add_list.extend(prefix + key for key in base_keys[i:])
+    remove_list.extend(prefix + key for key in backup_keys[j:])
 
-        backup_listing = os.listdir(backup_path)
-        base_listing = dirs + files
+    errors.sort(key=lambda error: error[0])
+    return (add_list, remove_list, update_list, newer_list, errors,
+            subdirs), stat_calls
 
-        for direntry in files:
-            if not direntry in backup_listing:
-                add_list.append(os.path.join(rel_path, direntry))
+def scan_dir(path):
+    """Lists path as a dict of name to os.DirEntry with cached stat results."""
+    with os.scandir(path) as entries:
+        return {entry.name: entry for entry in entries}
 
-        for direntry in backup_listing:
-            rel_direntry = os.path.join(rel_path, direntry)
-            base_direntry = os.path.join(base_path, direntry)
-            backup_direntry = os.path.join(backup_path, direntry)
-            if os.path.isdir(backup_direntry):
-                rel_direntry = os.path.join(rel_direntry, '')
+class StatEntry:
+    """Stands in for an os.DirEntry when the stat result is already known."""
+    def __init__(self, name, stat_result):
+        self.name = name
+        self.stat_result = stat_result
 
-            if not direntry in base_listing:
-                remove_list.append(rel_direntry)
-            elif newer(base_direntry, backup_direntry):
-                if not os.path.isdir(base_direntry):
-                    update_list.append(rel_direntry)
-            elif newer(backup_direntry, base_direntry):
-                print('Warning: backup file newer than original:')
-                print('    {}'.format(os.path.join(rel_path, direntry)))
+    def is_dir(self, follow_symlinks=True):
+        return stat.S_ISDIR(self.stat_result.st_mode)
 
-    add_set = build_backup_path_set(add_list)
-    remove_set = build_backup_path_set(remove_list)
-    update_set = build_backup_path_set(update_list)
+    def is_symlink(self):
+        return False
 
-    return (add_set, remove_set, update_set)
+    def stat(self, follow_symlinks=True):
+        return self.stat_result
 
-def do_backup(base, backup, add_set, remove_set, update_set):
-    for item in add_set | update_set:
-        base_path = os.path.join(base, item)
-        copy_to_backup(base, backup, item)
+def is_dir_entry(entry):
+    return entry.is_dir()
 
-    for item in remove_set:
-        remove_from_backup(backup, item)
+def is_link_loop(link_path, dir_path, walk_ids=()):
+    """Returns whether following the directory link at link_path loops.
+
+    It does if the linked directory contains dir_path, the directory the
+    link is in, or is one of walk_ids, the (st_dev, st_ino) of the
+    directories walked through to reach dir_path, see walk_dir_ids().  The
+    latter catches links leading into each other, e.g. A/to_b -> ../B and
+    B/to_a -> ../A.
+    """
+    target = os.path.join(os.path.realpath(link_path), '')
+    if os.path.join(os.path.realpath(dir_path), '').startswith(target):
+        return True
+    link_stat = os.stat(link_path)
+    return (link_stat.st_dev, link_stat.st_ino) in walk_ids
+
+def walk_dir_ids(base, rel_path):
+    """Returns the (st_dev, st_ino) of base and of each directory to rel_path.
+
+    Links are followed, as the walks do.
+    """
+    path = base
+    path_stat = os.stat(path)
+    ids = {(path_stat.st_dev, path_stat.st_ino)}
+    for name in rel_path.split(os.path.sep):
+        if name:
+            path = os.path.join(path, name)
+            path_stat = os.stat(path)
+            ids.add((path_stat.st_dev, path_stat.st_ino))
+    return ids
+
+def entry_rel_path(rel_path, entry):
+    if is_dir_entry(entry):
+        return os.path.join(rel_path, entry.name, '')
+    return os.path.join(rel_path, entry.name)
+
+class PathFilter:
+    """Decides which relative paths are left out of the comparison and backup.
+
+    excludes and includes are gitignore-style globs, see glob_regex(), and
+    exclude_regexes and include_regexes are regular expressions searched for
+    in the relative path, which ends with a separator for directories.  All
+    rules of a kind are compiled into a single regex up front.  A path is
+    excluded if it matches an exclude rule and no include rule; as with
+    gitignore, nothing below an excluded directory can be included again,
+    since the directory is never listed.
+    """
+    def __init__(self, excludes=(), includes=(), exclude_regexes=(),
+                    include_regexes=()):
+        self.exclude = compile_rules(excludes, exclude_regexes)
+        self.include = compile_rules(includes, include_regexes)
+
+    def excluded(self, relpath):
+        return (self.exclude is not None
+                and self.exclude.search(relpath) is not None
+                and (self.include is None
+                    or self.include.search(relpath) is None))
+
+    def filter_entries(self, rel_path, entries):
+        """Drops the excluded entries from a scan_dir() listing of rel_path."""
+        return {name: entry for name, entry in entries.items()
+                if not self.excluded(entry_rel_path(rel_path, entry))}
+
+    def ignore(self, base):
+        """Returns a shutil.copytree() ignore function for copies below base."""
+        def ignore(path, names):
+            rel_path = get_rel_path(base, path)
+            ignored = set()
+            for name in names:
+                relpath = os.path.join(rel_path, name)
+                if os.path.isdir(os.path.join(path, name)):
+                    relpath = os.path.join(relpath, '')
+                if self.excluded(relpath):
+                    ignored.add(name)
+            return ignored
+        return ignore
+
+def compile_rules(globs, regexes):
+    rules = [glob_regex(glob) for glob in globs] + list(regexes)
+    if not rules:
+        return None
+    return re.compile('|'.join('(?:{})'.format(rule) for rule in rules))
+
+def glob_regex(pattern):
+    """Translates a gitignore-style glob into a regex for relative paths.
+
+    Patterns use '/' as separator.  A pattern without a separator, other than
+    a trailing one, matches names at any depth, otherwise it is anchored at the
+    root.  A trailing separator only matches directories.  '**' matches
+    across separators, while '*', '?' and '[...]' match within a name.
+    """
+    sep = re.escape(os.path.sep)
+    dir_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    parts = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*{})?'.format(sep))
+            i += 3
+        elif pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            parts.append('[^{}]*'.format(sep))
+            i += 1
+        elif pattern[i] == '?':
+            parts.append('[^{}]'.format(sep))
+            i += 1
+        elif pattern[i] == '[' and pattern.find(']', i + 2) > 0:
+            end = pattern.find(']', i + 2)
+            chars = pattern[i + 1:end].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            parts.append('[{}]'.format(chars))
+            i = end + 1
+        elif pattern[i] == '/':
+            parts.append(sep)
+            i += 1
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    prefix = '' if anchored else '(?:.*{})?'.format(sep)
+    suffix = sep if dir_only else sep + '?'
+    return r'\A' + prefix + ''.join(parts) + suffix + r'\Z'
+
+def do_backup(base, backup, add_set, remove_set, update_set, workers=1,
+                index=None, delta_threshold=None, copy_method=None,
+                path_filter=None, observer=None, journal=None, throttle=None,
+                move_set=(), small_file_size=None):
+    """Applies the changes found by diff_walk() to backup.
+
+    All removals run before the copies; see backup_stream().  Entries in
+    move_set are renamed within the backup instead of copied.  With a journal
+    every change is recorded as pending before any is applied, so that an
+    interrupted backup can be resumed from the journal, see Journal.
+    """
+    events = diff_events(add_set, remove_set, update_set, move_set)
+    if journal is not None:
+        journal.start(base, backup, events)
+        events = journal.pending()
+    return backup_stream(base, backup, events, workers, index, delta_threshold,
+            copy_method, path_filter, observer, journal, throttle,
+            small_file_size)
+
+def diff_events(add_set, remove_set, update_set, move_set=()):
+    """Turns diff_walk() results into iter_diff() events, removals first.
+
+    Moves come right after the removals, which may clear their destinations.
+    """
+    return chain((('remove', item) for item in remove_set),
+                    (('move', item) for item in move_set),
+                    (('add', item) for item in add_set),
+                    (('update', item) for item in update_set - add_set))
+
+def backup_stream(base, backup, events, workers=1, index=None,
+                    delta_threshold=None, copy_method=None, path_filter=None,
+                    observer=None, journal=None, throttle=None,
+                    small_file_size=None):
+    """Applies (action, relpath) events, e.g. from iter_diff(), to backup.
+
+    Removals run on the calling thread as they arrive, so they finish before
+    any later copy to the same path starts.  Copies run on a pool of up to
+    workers threads with a bounded number in flight, so copying overlaps with
+    producing events and memory does not grow with the number of changes.  Fed
+    by iter_diff() with several workers this forms one pipeline of bounded
+    stages, scanning, comparing and copying with many round trips in flight, as
+    main() runs it for --apply.  An item that fails, including 'error' events
+    from the scan, is recorded in the returned BackupStats instead of aborting
+    the backup.  An index is updated after each entry that was successfully
+    backed up.  Updated files of at least delta_threshold bytes only have their
+    changed blocks rewritten, see delta_copy().  Files are copied with
+    copy_method, and entries excluded by path_filter are skipped within copied
+    directories, see copy_to_backup().  Each entry copied or removed is
+    reported to observer, see Observer, and marked done in journal, which is
+    cleared once a backup ends without failures.  Every file copied and entry
+    removed is paced by throttle, see Throttle.  A ('move', (old, new)) event
+    renames old to new in the backup, or falls back to removing old and copying
+    new if the rename fails.  With small_file_size, regular files of at most
+    that many bytes, including those below added directories, are not copied
+    one task each but in batches of up to SMALL_FILE_BATCH files of the same
+    directory, see copy_small_files(); an added directory is then created up
+    front and copied as batches and single large files, spread over the
+    workers.
+    """
+    stats = BackupStats()
+    copy_kwargs = {}
+    if copy_method is not None:
+        copy_kwargs.update(method=copy_method, stats=stats)
+    if path_filter is not None:
+        copy_kwargs['path_filter'] = path_filter
+    if throttle is not None:
+        copy_kwargs['throttle'] = throttle
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        action_of = {}
+        batches = {}
+
+        def finish(item, result, seconds):
+            action = action_of.pop(item)
+            if isinstance(result, OSError):
+                stats.failures.append((item, result))
+                return
+            stats.copied += 1
+            stats.bytes += result
+            if index is not None:
+                index.add(backup, item)
+            if journal is not None:
+                journal.complete(action, item)
+            if observer is not None:
+                observer.entry_copied(item, result, seconds)
+
+        def finish_tree(tree, result=None):
+            if result is not None:
+                tree.done(result)
+                tree.pending -= 1
+            if tree.walked and not tree.pending:
+                finish(tree.item, tree.finish(base, backup), tree.seconds)
+
+        def collect(done):
+            #in submission order, so that an exception raised by one task
+            #leaves every earlier finished one recorded, e.g. in journal
+            for future in [future for future in futures if future in done]:
+                kind, task = futures.pop(future)
+                try:
+                    result, seconds = future.result()
+                except OSError as e:
+                    result, seconds = e, 0.0
+                if kind == 'item':
+                    finish(task, result, seconds)
+                elif kind == 'file':
+                    task.seconds += seconds
+                    finish_tree(task, result)
+                else:
+                    rel_dir, tree, files = task
+                    if isinstance(result, OSError):
+                        result = [(name, result, 0.0) for inode, name in files]
+                    if tree is not None:
+                        tree.seconds += seconds
+                    for name, file_result, file_seconds in result:
+                        if tree is None:
+                            finish(os.path.join(rel_dir, name), file_result,
+                                    file_seconds)
+                        else:
+                            finish_tree(tree, file_result)
+
+        def submit(kind, task, fn, *args, **kwargs):
+            if len(futures) >= workers * 4:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = executor.submit(timed_call, fn, *args, **kwargs)
+            futures[future] = (kind, task)
+
+        def submit_batch(rel_dir):
+            tree, files = batches.pop(rel_dir)
+            submit('batch', (rel_dir, tree, files), copy_small_files, base,
+                    backup, rel_dir, files, method=copy_method, stats=stats,
+                    throttle=throttle)
+
+        def batch_file(rel_dir, name, inode, tree=None):
+            #bound the batches filling up, submitting the oldest
+            if rel_dir not in batches and len(batches) >= workers * 4:
+                submit_batch(next(iter(batches)))
+            files = batches.setdefault(rel_dir, (tree, []))[1]
+            files.append((inode, name))
+            if len(files) >= SMALL_FILE_BATCH:
+                submit_batch(rel_dir)
+
+        def copy_tree(item):
+            tree = TreeCopy(item)
+            failures = []
+            try:
+                os.makedirs(os.path.join(backup, item), exist_ok=True)
+                tree.dirs.append(item)
+                for relpath, entry_stat in walk_tree(base, path_filter,
+                        failures, item):
+                    if stat.S_ISDIR(entry_stat.st_mode):
+                        os.makedirs(os.path.join(backup, relpath),
+                                exist_ok=True)
+                        tree.dirs.append(relpath)
+                        continue
+                    tree.pending += 1
+                    if (stat.S_ISREG(entry_stat.st_mode)
+                            and entry_stat.st_size <= small_file_size):
+                        batch_file(*split_rel_path(relpath), entry_stat.st_ino,
+                                tree)
+                    else:
+                        submit('file', tree, copy_to_backup, base, backup,
+                                relpath, **copy_kwargs)
+            except OSError as e:
+                failures.append((item, e))
+            for relpath, error in failures:
+                tree.done(error)
+            for rel_dir in [rel_dir for rel_dir, (batch_tree, files)
+                    in batches.items() if batch_tree is tree]:
+                submit_batch(rel_dir)
+            tree.walked = True
+            finish_tree(tree)
+
+        fallbacks = []
+        for action, item in with_fallbacks(events, fallbacks):
+            if action == 'error':
+                stats.failures.append(item)
+            elif action == 'move':
+                old, new = item
+                try:
+                    os.rename(os.path.join(backup, old),
+                            os.path.join(backup, new))
+                except OSError:
+                    fallbacks.extend([('remove', old), ('add', new)])
+                else:
+                    stats.moved += 1
+                    if index is not None:
+                        index.remove(old)
+                        index.add(backup, new)
+                    if journal is not None:
+                        journal.complete(action, item)
+            elif action == 'remove':
+                try:
+                    if throttle is not None:
+                        throttle.wait()
+                    _, seconds = timed_call(remove_from_backup, backup, item)
+                    if throttle is not None:
+                        throttle.charge(0, seconds)
+                except OSError as e:
+                    stats.failures.append((item, e))
+                else:
+                    stats.removed += 1
+                    if index is not None:
+                        index.remove(item)
+                    if journal is not None:
+                        journal.complete(action, item)
+                    if observer is not None:
+                        observer.entry_removed(item, seconds)
+            elif action in ('add', 'update'):
+                action_of[item] = action
+                delta = action == 'update' and delta_threshold is not None
+                if small_file_size is not None and not delta:
+                    if item.endswith(os.path.sep):
+                        copy_tree(item)
+                        continue
+                    try:
+                        item_stat = os.stat(os.path.join(base, item))
+                    except OSError:
+                        item_stat = None
+                    if (item_stat is not None
+                            and stat.S_ISREG(item_stat.st_mode)
+                            and item_stat.st_size <= small_file_size):
+                        batch_file(*split_rel_path(item), item_stat.st_ino)
+                        continue
+                if delta:
+                    submit('item', item, update_in_backup, base, backup, item,
+                            delta_threshold, **copy_kwargs)
+                else:
+                    submit('item', item, copy_to_backup, base, backup, item,
+                            **copy_kwargs)
+        while batches:
+            submit_batch(next(iter(batches)))
+        collect(list(futures))
+
+    if index is not None:
+        index.finish_dirs(item for item, error in stats.failures)
+    if journal is not None and not stats.failures:
+        journal.clear()
+    stats.finish()
+    if observer is not None:
+        observer.phase_done('backup', stats.elapsed)
+    return stats
+
+def with_fallbacks(events, fallbacks):
+    """Yields events, each time first yielding what was added to fallbacks."""
+    for event in events:
+        while fallbacks:
+            yield fallbacks.pop(0)
+        yield event
+    while fallbacks:
+        yield fallbacks.pop(0)
+
+def do_backup_targets(base, backups, diff_sets, workers=1, path_filter=None,
+                        observer=None, throttle=None):
+    """Applies diff_walk_targets() results to each backup, reading base once.
+
+    The removals run first, one backup after the other, see backup_stream().
+    Then each entry added or updated in any of the backups is copied to all
+    of them that need it by one task, see copy_to_backups(), on a pool of up
+    to workers threads with a bounded number in flight.  An entry below a
+    directory added to another backup is copied by that directory's task.
+    Returns a BackupStats for each backup.
+    """
+    all_stats = []
+    targets_of = {}
+    for target, (backup, (add_set, remove_set, update_set)) in enumerate(
+            zip(backups, diff_sets)):
+        all_stats.append(backup_stream(base, backup,
+                (('remove', item) for item in remove_set), observer=observer,
+                throttle=throttle))
+        for item in chain(add_set, update_set - add_set):
+            targets_of.setdefault(item, []).append(target)
+
+    #tasks map each copied entry to the targets needing all of it, to None,
+    #or to the entries below it they need
+    tasks = {}
+    for item in sorted(targets_of,
+            key=lambda item: item.rstrip(os.path.sep).count(os.path.sep)):
+        root = next((parent for parent in rel_path_parents(item)
+                if parent in tasks), None)
+        for target in targets_of[item]:
+            if root is None:
+                tasks.setdefault(item, {})[target] = None
+            else:
+                tasks[root].setdefault(target, set()).add(item)
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+
+        def collect(done):
+            for future in done:
+                item, parts = futures.pop(future)
+                try:
+                    (sizes, failures), seconds = future.result()
+                except OSError as e:
+                    sizes, seconds = [0] * len(parts), 0.0
+                    failures = dict.fromkeys(range(len(parts)), e)
+                for i, (target, items) in enumerate(parts.items()):
+                    stats = all_stats[target]
+                    items = [item] if items is None else sorted(items)
+                    if i in failures:
+                        stats.failures.extend((part, failures[i])
+                                for part in items)
+                        continue
+                    stats.copied += len(items)
+                    stats.bytes += sizes[i]
+                    if observer is not None:
+                        #bytes are only known per task
+                        for n, part in enumerate(items):
+                            observer.entry_copied(part, 0 if n else sizes[i],
+                                    seconds)
+
+        for item, parts in sorted(tasks.items()):
+            if len(futures) >= workers * 4:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = executor.submit(timed_call, copy_to_backups, base,
+                    [backups[target] for target in parts], item, path_filter,
+                    throttle, list(parts.values()))
+            futures[future] = (item, parts)
+        collect(list(futures))
+
+    for stats in all_stats:
+        stats.finish()
+    if observer is not None:
+        observer.phase_done('backup', perf_counter() - start)
+    return all_stats
+
+def watch_backup(base, backup, interval=WATCH_INTERVAL, workers=1,
+                    compare=None, path_filter=None, observer=None,
+                    throttle=None, delta_threshold=None, copy_method=None,
+                    small_file_size=None):
+    """Keeps backup in sync with base, yielding a BackupStats for each batch.
+
+    The first batch is a full diff_walk() and do_backup().  Then base is
+    watched for changes, see open_watcher(); the directories changed within
+    interval seconds of the first change are compared and backed up as one
+    batch, see diff_changed_dirs(), so the lag depends on the rate of change
+    rather than on the size of the tree.  If changes were lost, or with the
+    polling fallback, the whole tree is compared instead.  Batches without
+    differences are not yielded.  The watch ends when the generator is closed.
+    """
+    base = os.path.abspath(base)
+    backup = os.path.abspath(backup)
+    watcher = open_watcher(base, interval, path_filter)
+    try:
+        dirty = None
+        first = True
+        while True:
+            if dirty is None:
+                diff_sets = diff_walk(base, backup, workers, compare=compare,
+                        path_filter=path_filter, observer=observer)
+            else:
+                diff_sets = diff_changed_dirs(base, backup, dirty, compare,
+                        path_filter, observer)
+            if first or any(diff_sets):
+                yield do_backup(base, backup, *diff_sets, workers=workers,
+                        delta_threshold=delta_threshold,
+                        copy_method=copy_method,
+                        path_filter=path_filter, observer=observer,
+                        throttle=throttle, small_file_size=small_file_size)
+            first = False
+
+            dirty = watcher.read()
+            deadline = perf_counter() + interval
+            while dirty is not None and perf_counter() < deadline:
+                changes = watcher.read(deadline - perf_counter())
+                dirty = None if changes is None else dirty | changes
+    finally:
+        watcher.close()
+
+def open_watcher(base, interval, path_filter=None):
+    """Returns an InotifyWatcher for base, or a PollingWatcher if that fails."""
+    try:
+        return InotifyWatcher(base, path_filter)
+    except OSError as e:
+        print('Warning: cannot watch {} ({}), rescanning every {}s'.format(base,
+                e, interval))
+        return PollingWatcher(interval)
+
+class InotifyWatcher:
+    """Watches every directory of base for changes with Linux inotify.
+
+    Called through ctypes, with a watch per directory, added as directories
+    are created or moved in and removed as they are moved out.  Directories
+    excluded by path_filter or reached through symbolic links are not
+    watched.  Raises OSError if inotify is not available or a directory
+    cannot be watched, e.g. beyond the fs.inotify.max_user_watches limit.
+    """
+    def __init__(self, base, path_filter=None):
+        self.libc = (None if ctypes is None
+                else ctypes.CDLL(None, use_errno=True))
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify not available')
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                ctypes.c_uint32]
+        self.base = base
+        self.path_filter = path_filter
+        self.watches = {}
+        self.fd = self.check(self.libc.inotify_init1(os.O_NONBLOCK
+                | os.O_CLOEXEC))
+        try:
+            self.add_watches('')
+        except OSError:
+            self.close()
+            raise
+
+    def check(self, result, path=None):
+        if result < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code), path)
+        return result
+
+    def add_watches(self, rel_dir):
+        """Watches rel_dir and the directories below it."""
+        pending = [rel_dir]
+        while pending:
+            rel_path = pending.pop()
+            path = os.path.join(self.base, rel_path)
+            try:
+                wd = self.check(self.libc.inotify_add_watch(self.fd,
+                        os.fsencode(path), INOTIFY_MASK | IN_ONLYDIR), path)
+                entries = scan_dir(path)
+            except (FileNotFoundError, NotADirectoryError):
+                #gone again, its parent's events cover that
+                continue
+            self.watches[wd] = rel_path
+            if self.path_filter is not None:
+                entries = self.path_filter.filter_entries(rel_path, entries)
+            pending.extend(entry_rel_path(rel_path, entry)
+                    for entry in entries.values()
+                    if entry.is_dir(follow_symlinks=False))
+
+    def remove_watches(self, rel_dir):
+        """Stops watching rel_dir and the directories below it."""
+        for wd, rel_path in list(self.watches.items()):
+            if rel_path.startswith(rel_dir):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read(self, timeout=None):
+        """Waits up to timeout seconds, or indefinitely, for changes.
+
+        Returns the set of the relative paths of the directories whose
+        entries changed, or None if events were lost and the whole tree must
+        be compared.  That includes a new directory that could not be
+        watched, e.g. unreadable or beyond the watch limit.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        dirty = set()
+        lost = False
+        while True:
+            try:
+                data = os.read(self.fd, INOTIFY_BUFFER_SIZE)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data,
+                        offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                rel_dir = self.watches.get(wd)
+                if mask & IN_Q_OVERFLOW:
+                    lost = True
+                elif rel_dir is None:
+                    continue
+                elif mask & IN_IGNORED:
+                    del self.watches[wd]
+                else:
+                    dirty.add(rel_dir)
+                    if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                        try:
+                            self.add_watches(os.path.join(rel_dir, name, ''))
+                        except OSError as e:
+                            print('Warning: could not watch {}: {}'.format(
+                                    os.path.join(rel_dir, name), e))
+                            lost = True
+                    elif mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                        self.remove_watches(os.path.join(rel_dir, name, ''))
+        return None if lost else dirty
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """Stands in for InotifyWatcher where inotify is not available.
+
+    read() waits for interval seconds, then asks for the whole tree to be
+    compared.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+
+    def read(self, timeout=None):
+        sleep(self.interval if timeout is None else min(timeout, self.interval))
+        return None
+
+    def close(self):
+        pass
+
+def timed_call(fn, *args, **kwargs):
+    """Calls fn, returning its result and the seconds it took."""
+    start = perf_counter()
+    result = fn(*args, **kwargs)
+    return result, perf_counter() - start
+
+class Throttle:
+    """Token buckets pacing a backup to bytes_per_sec and ops_per_sec.
+
+    wait() is called before each file copy or removal and charge() after it,
+    with the bytes written, so a large file puts the byte bucket in debt and
+    holds back the next operation.  Either limit may be None.  Each bucket
+    holds at most one second's worth of tokens, bounding bursts.  If adaptive,
+    the limits are scaled down, to THROTTLE_MIN_SCALE at most, while the time
+    per byte written rises well above the fastest seen, e.g. because the
+    disks are busy with other work, and scaled back up as it recovers.
+    """
+    def __init__(self, bytes_per_sec=None, ops_per_sec=None, adaptive=False):
+        self.lock = Lock()
+        self.limits = {'bytes': bytes_per_sec, 'ops': ops_per_sec}
+        self.tokens = {name: limit or 0 for name, limit in self.limits.items()}
+        self.adaptive = adaptive
+        self.scale = 1.0
+        self.latency = None
+        self.baseline = None
+        self.last_refill = self.last_adapt = perf_counter()
+
+    def wait(self):
+        """Blocks until an operation may start, then takes its token."""
+        while True:
+            with self.lock:
+                self.refill()
+                delay = self.delay()
+                if delay <= 0:
+                    if self.limits['ops']:
+                        self.tokens['ops'] -= 1
+                    return
+            sleep(delay)
+
+    def charge(self, nbytes, seconds):
+        """Takes nbytes tokens for an operation that took seconds."""
+        with self.lock:
+            if self.limits['bytes']:
+                self.tokens['bytes'] -= nbytes
+            if self.adaptive:
+                self.adapt(seconds / max(nbytes, THROTTLE_MIN_BYTES))
+
+    def refill(self):
+        now = perf_counter()
+        for name, limit in self.limits.items():
+            if limit:
+                rate = limit * self.scale
+                self.tokens[name] = min(rate, self.tokens[name]
+                        + (now - self.last_refill) * rate)
+        self.last_refill = now
+
+    def delay(self):
+        """Returns the seconds until no bucket is short of tokens."""
+        delay = 0.0
+        if self.limits['ops']:
+            delay = max(delay, (1 - self.tokens['ops'])
+                    / (self.limits['ops'] * self.scale))
+        if self.limits['bytes']:
+            delay = max(delay, -self.tokens['bytes']
+                    / (self.limits['bytes'] * self.scale))
+        return delay
+
+    def adapt(self, latency):
+        self.latency = latency if self.latency is None else (
+                0.8 * self.latency + 0.2 * latency)
+        now = perf_counter()
+        if self.baseline is None:
+            self.baseline = self.latency
+        if now - self.last_adapt < THROTTLE_ADAPT_INTERVAL:
+            self.baseline = min(self.baseline, self.latency)
+            return
+        self.last_adapt = now
+        if self.latency > 2 * self.baseline:
+            self.scale = max(self.scale / 2, THROTTLE_MIN_SCALE)
+        elif self.latency < 1.25 * self.baseline:
+            self.scale = min(self.scale * 1.25, 1.0)
+        #let the baseline creep up, so one lucky fast copy is not the target
+        #forever
+        self.baseline = min(self.latency, self.baseline * 1.05)
+
+class BackupStats:
+    """Counts what backup_stream() did and how fast it went.
+
+    A directory copied as a whole counts as one copied entry.
+    """
+    def __init__(self):
+        self.copied = 0
+        self.removed = 0
+        self.moved = 0
+        self.linked = 0
+        self.bytes = 0
+        self.failures = []
+        self.methods = {}
+        self.lock = Lock()
+        self.start_time = time()
+        self.elapsed = 0.0
+
+    def count_method(self, method):
+        """Counts a file copied with the copy_file() method named method."""
+        with self.lock:
+            self.methods[method] = self.methods.get(method, 0) + 1
+
+    def finish(self):
+        self.elapsed = time() - self.start_time
+
+    @property
+    def files_per_sec(self):
+        return self.copied / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_sec(self):
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+class TreeCopy:
+    """Tracks a directory backup_stream() copies as several small file batches.
+
+    dirs are created before their files are copied, and their metadata is
+    copied by finish() once no copy of the tree is pending.
+    """
+    def __init__(self, item):
+        self.item = item
+        self.dirs = []
+        self.pending = 0
+        self.walked = False
+        self.bytes = 0
+        self.error = None
+        self.seconds = 0.0
+
+    def done(self, result):
+        """Records the bytes of a file copied, or an OSError."""
+        if isinstance(result, OSError):
+            self.error = self.error or result
+        else:
+            self.bytes += result
+
+    def finish(self, base, backup):
+        """Copies the directories' metadata, returning bytes or the error."""
+        for rel_dir in reversed(self.dirs):
+            try:
+                shutil.copystat(os.path.join(base, rel_dir),
+                        os.path.join(backup, rel_dir))
+            except OSError as e:
+                self.done(e)
+        return self.error or self.bytes
+
+class Observer:
+    """Receives progress callbacks from diff_walk() and do_backup().
+
+    Subclass it and override the methods of interest.  dir_listed() may be
+    called from worker threads.
+    """
+    def dir_listed(self, rel_path, entries, stat_calls, seconds):
+        """Called after comparing a directory pair holding entries entries."""
+
+    def entry_copied(self, relpath, copied_bytes, seconds):
+        """Called after an entry, possibly a whole directory, was copied."""
+
+    def entry_removed(self, relpath, seconds):
+        """Called after an entry was removed from the backup."""
+
+    def phase_done(self, phase, seconds):
+        """Called when the 'walk' or 'backup' phase finished."""
+
+class Metrics(Observer):
+    """Observer that counts what was done and keeps the slowest entries."""
+    def __init__(self, slowest=10):
+        self.lock = Lock()
+        self.slowest = slowest
+        self.counters = {'dirs_listed': 0, 'entries_listed': 0, 'stat_calls': 0,
+                        'entries_copied': 0, 'bytes_copied': 0,
+                        'entries_removed': 0}
+        self.phases = {}
+        self.slowest_dirs = []
+        self.slowest_entries = []
+
+    def dir_listed(self, rel_path, entries, stat_calls, seconds):
+        with self.lock:
+            self.counters['dirs_listed'] += 1
+            self.counters['entries_listed'] += entries
+            self.counters['stat_calls'] += stat_calls
+            self.keep_slowest(self.slowest_dirs, seconds, rel_path)
+
+    def entry_copied(self, relpath, copied_bytes, seconds):
+        with self.lock:
+            self.counters['entries_copied'] += 1
+            self.counters['bytes_copied'] += copied_bytes
+            self.keep_slowest(self.slowest_entries, seconds, relpath)
+
+    def entry_removed(self, relpath, seconds):
+        with self.lock:
+            self.counters['entries_removed'] += 1
+            self.keep_slowest(self.slowest_entries, seconds, relpath)
+
+    def phase_done(self, phase, seconds):
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def keep_slowest(self, heap, seconds, relpath):
+        #a min-heap of the slowest entries so far, the fastest of them first
+        if len(heap) < self.slowest:
+            heapq.heappush(heap, (seconds, relpath))
+        elif seconds > heap[0][0]:
+            heapq.heapreplace(heap, (seconds, relpath))
+
+    def as_dict(self):
+        """Returns the metrics as a JSON serializable dict."""
+        with self.lock:
+            return {'counters': dict(self.counters),
+                    'phases': dict(self.phases),
+                    'slowest_dirs': [{'path': path, 'seconds': seconds}
+                        for seconds, path in sorted(self.slowest_dirs,
+                            reverse=True)],
+                    'slowest_entries': [{'path': path, 'seconds': seconds}
+                        for seconds, path in sorted(self.slowest_entries,
+                            reverse=True)]}
+
+class DiffResult:
+    """Compact store of the relative paths a walk found, each with its action.
+
+    Rather than one string per path, directory prefixes and entry names are
+    interned once, and each directory holds arrays of the name ids and action
+    codes of its entries.  Adding appends to the arrays; they are sorted by
+    name id, dropping repeated entries, the first time they are read, after
+    which looking a path up is a binary search that builds no strings.  A path
+    added twice keeps its first action.  view() gives set-like access to the
+    paths of one action.
+    """
+    ACTIONS = ('add', 'remove', 'update', 'newer')
+
+    def __init__(self):
+        self.dirs = ['']
+        self.dir_ids = {'': 0}
+        self.names = []
+        self.name_ids = {}
+        self.groups = {}
+        self.unsorted = set()
+        self.counts = dict.fromkeys(self.ACTIONS, 0)
+
+    def add(self, action, relpath):
+        parent, name = split_rel_path(relpath)
+        dir_id = self.intern_dir(parent)
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        name_ids, actions = self.groups.setdefault(
+                dir_id, (array('I'), array('B')))
+        name_ids.append(name_id)
+        actions.append(self.ACTIONS.index(action))
+        self.unsorted.add(dir_id)
+        self.counts[action] += 1
+
+    def intern_dir(self, rel_path):
+        dir_id = self.dir_ids.get(rel_path)
+        if dir_id is None:
+            #intern every ancestor too, so sorted iteration can reach rel_path
+            self.intern_dir(parent_rel_path(rel_path))
+            dir_id = self.dir_ids[rel_path] = len(self.dirs)
+            self.dirs.append(rel_path)
+        return dir_id
+
+    def find(self, dir_id, name_id):
+        """Returns the action code of a stored entry, or None."""
+        if dir_id not in self.groups:
+            return None
+        if dir_id in self.unsorted:
+            self.sort_group(dir_id)
+        name_ids, actions = self.groups[dir_id]
+        i = bisect_left(name_ids, name_id)
+        if i < len(name_ids) and name_ids[i] == name_id:
+            return actions[i]
+        return None
+
+    def sort_group(self, dir_id):
+        name_ids, actions = self.groups[dir_id]
+        #a stable sort keeps the first of repeated entries first
+        order = sorted(range(len(name_ids)), key=name_ids.__getitem__)
+        sorted_ids = array('I')
+        sorted_actions = array('B')
+        for i in order:
+            if sorted_ids and sorted_ids[-1] == name_ids[i]:
+                self.counts[self.ACTIONS[actions[i]]] -= 1
+                continue
+            sorted_ids.append(name_ids[i])
+            sorted_actions.append(actions[i])
+        self.groups[dir_id] = (sorted_ids, sorted_actions)
+        self.unsorted.discard(dir_id)
+
+    def count(self, action):
+        for dir_id in list(self.unsorted):
+            self.sort_group(dir_id)
+        return self.counts[action]
+
+    def discard(self, action, relpath):
+        """Drops relpath if it is stored with action."""
+        parent, name = split_rel_path(relpath)
+        dir_id = self.dir_ids.get(parent)
+        name_id = self.name_ids.get(name)
+        if (dir_id is None or name_id is None
+                or self.find(dir_id, name_id) != self.ACTIONS.index(action)):
+            return
+        name_ids, actions = self.groups[dir_id]
+        actions[bisect_left(name_ids, name_id)] = DISCARDED
+        self.counts[action] -= 1
+
+    def contains(self, action, relpath):
+        parent, name = split_rel_path(relpath)
+        dir_id = self.dir_ids.get(parent)
+        name_id = self.name_ids.get(name)
+        if dir_id is None or name_id is None:
+            return False
+        return self.find(dir_id, name_id) == self.ACTIONS.index(action)
+
+    def iter_sorted(self, action):
+        """Yields the paths of action in sorted order, one directory at a time.
+
+        Every path below a directory sorts right after the directory itself,
+        so sorting each directory's entries and subdirectories by name and
+        descending depth first gives the same order as sorting all paths.
+        """
+        code = self.ACTIONS.index(action)
+        for dir_id in list(self.unsorted):
+            self.sort_group(dir_id)
+        subdirs = {}
+        for dir_id, rel_path in enumerate(self.dirs[1:], 1):
+            parent, name = split_rel_path(rel_path)
+            subdirs.setdefault(self.dir_ids[parent], []).append(
+                    (name, 1, dir_id))
+
+        stack = [iter([('', 1, 0)])]
+        while stack:
+            item = next(stack[-1], None)
+            if item is None:
+                stack.pop()
+                continue
+            name, is_subdir, dir_id = item
+            if not is_subdir:
+                yield self.dirs[dir_id] + name
+                continue
+            entries = list(subdirs.get(dir_id, ()))
+            name_ids, actions = self.groups.get(dir_id, ((), ()))
+            entries.extend((self.names[name_id], 0, dir_id)
+                    for name_id, entry_code in zip(name_ids, actions)
+                    if entry_code == code)
+            entries.sort()
+            stack.append(iter(entries))
+
+    def view(self, action):
+        return DiffSetView(self, action)
+
+DISCARDED = 255
+
+class DiffSetView(Set):
+    """Read-only set of the paths of one action in a DiffResult.
+
+    Iteration is in sorted order.  Set operations return plain sets.
+    """
+    def __init__(self, result, action):
+        self.result = result
+        self.action = action
+
+    def __contains__(self, relpath):
+        return (isinstance(relpath, str)
+                and self.result.contains(self.action, relpath))
+
+    def __iter__(self):
+        return self.result.iter_sorted(self.action)
+
+    def __len__(self):
+        return self.result.count(self.action)
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, set(self))
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return set(iterable)
+
+    __hash__ = None
+
+def split_rel_path(relpath):
+    """Splits relpath into its parent directory and its name.
+
+    Both keep their trailing separators, e.g. 'a/b/' gives ('a/', 'b/').
+    """
+    head, sep, _ = relpath.rstrip(os.path.sep).rpartition(os.path.sep)
+    parent = head + sep
+    return parent, relpath[len(parent):]
 
 def build_backup_path_set(paths):
-    """Build a set of paths that excludes all files belew any directory.
+    """Build a set of paths that excludes all files below any directory.
 
-    E.g. would exclude hello/world.txt if hello/ is in paths
+    E.g. would exclude hello/world.txt if hello/ is in paths.  Directories are
+    marked by a trailing path separator.  Sorting places every path directly
+    after any directory that prefixes it, so a single sweep collapses each
+    subtree in O(n log n) rather than rescanning the list for every path.
     """
-    path_set = set(paths)
-    for path in paths:
-        exclude_subtree = set(filterfalse(lambda p: p.startswith(path), paths))
-        exclude_subtree.add(path)
-        path_set &= exclude_subtree
+    path_set = set()
+    subtree_root = None
+    for path in sorted(set(paths)):
+        if subtree_root is not None and path.startswith(subtree_root):
+            continue
+        path_set.add(path)
+        subtree_root = path if path.endswith(os.path.sep) else None
     return path_set
 
+class BackupIndex:
+    """On-disk SQLite record of the backup tree, so it need not be listed.
+
+    Every entry of the backup is stored by its relative path (directories
+    with a trailing separator) with its type, size and mtime in ns.  For a
+    directory the mtime is instead the base directory's mtime as of the last
+    backup that fully synced its listing, or NULL if unknown; base directories
+    whose mtime still matches are not re-listed.  Rows are only written after
+    the backup itself changed, so after a crash the index can lag behind the
+    backup but never claims entries it does not hold.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.pending_dirs = {}
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                    'path TEXT PRIMARY KEY, parent TEXT, '
+                    'is_dir INTEGER NOT NULL, size INTEGER NOT NULL, '
+                    'mtime_ns INTEGER)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS entries_parent '
+                    'ON entries (parent)')
+
+    @property
+    def built(self):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM entries WHERE path = ''"
+                    ).fetchone() is not None
+
+    def close(self):
+        self.db.close()
+
+    def clear(self):
+        """Empties the index, recording an empty but fully known backup."""
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM entries')
+            self.db.execute("INSERT INTO entries VALUES ('', NULL, 1, 0, NULL)")
+        self.pending_dirs.clear()
+
+    def rebuild(self, backup):
+        """Replaces the index contents with a fresh walk of the backup tree."""
+        backup = os.path.abspath(backup)
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM entries')
+            self.db.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?)',
+                    walk_index_rows(backup, ''))
+        self.pending_dirs.clear()
+
+    def scan_dir(self, rel_path):
+        """Lists the indexed backup directory rel_path like scan_dir()."""
+        with self.lock:
+            rows = self.db.execute('SELECT path, is_dir, size, mtime_ns '
+                    'FROM entries WHERE parent = ?', (rel_path,)).fetchall()
+        entries = {}
+        for path, is_dir, size, mtime_ns in rows:
+            name = os.path.basename(path.rstrip(os.path.sep))
+            entries[name] = StatEntry(name, index_stat(is_dir, size, mtime_ns))
+        return entries
+
+    def scan_base_dir(self, base, rel_path, indexed_entries):
+        """Lists rel_path of base, reusing indexed_entries if unchanged."""
+        path = os.path.join(base, rel_path)
+        mtime_ns = os.stat(path).st_mtime_ns
+        with self.lock:
+            row = self.db.execute('SELECT mtime_ns FROM entries WHERE path = ?',
+                    (rel_path,)).fetchone()
+        if row is None or row[0] != mtime_ns:
+            self.pending_dirs[rel_path] = mtime_ns
+            return scan_dir(path)
+
+        entries = {}
+        for name in indexed_entries:
+            try:
+                entries[name] = StatEntry(
+                        name, os.stat(os.path.join(path, name)))
+            except FileNotFoundError:
+                pass
+        return entries
+
+    def add(self, backup, relpath):
+        """Records relpath, and everything below it, as present in backup."""
+        with self.lock, self.db:
+            self.remove_rows(relpath)
+            self.db.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?)',
+                    walk_index_rows(backup, relpath))
+
+    def remove(self, relpath):
+        """Records relpath, and everything below it, as gone from the backup."""
+        with self.lock, self.db:
+            self.remove_rows(relpath)
+
+    def remove_rows(self, relpath):
+        self.db.execute('DELETE FROM entries WHERE path = ?', (relpath,))
+        if relpath.endswith(os.path.sep):
+            #every path below relpath sorts between 'relpath/' and 'relpath0'
+            end = relpath[:-1] + chr(ord(os.path.sep) + 1)
+            self.db.execute('DELETE FROM entries WHERE path > ? AND path < ?',
+                    (relpath, end))
+
+    def finish_dirs(self, failed_items=()):
+        """Records the base mtimes of directories listed by the last diff_walk.
+
+        Directories that failed, or that have a failed direct child, keep their
+        old mtime so they are listed again on the next run.
+        """
+        failed_dirs = set()
+        for item in failed_items:
+            failed_dirs.add(parent_rel_path(item))
+            if item == '' or item.endswith(os.path.sep):
+                failed_dirs.add(item)
+        with self.lock, self.db:
+            self.db.executemany(
+                    'UPDATE entries SET mtime_ns = ? WHERE path = ?',
+                    ((mtime_ns, rel_path)
+                        for rel_path, mtime_ns in self.pending_dirs.items()
+                        if rel_path not in failed_dirs))
+        self.pending_dirs.clear()
+
+def walk_index_rows(backup, relpath):
+    """Yields BackupIndex rows for relpath of backup and everything below it.
+
+    Directories are yielded with an unknown (NULL) base mtime.
+    """
+    path = os.path.join(backup, relpath)
+    parent = parent_rel_path(relpath) if relpath else None
+    path_stat = os.stat(path)
+    if not stat.S_ISDIR(path_stat.st_mode):
+        yield (relpath, parent, 0, path_stat.st_size, path_stat.st_mtime_ns)
+        return
+
+    yield (relpath, parent, 1, 0, None)
+    for entry in scan_dir(path).values():
+        if is_dir_entry(entry):
+            yield from walk_index_rows(backup, entry_rel_path(relpath, entry))
+        else:
+            entry_stat = entry.stat()
+            yield (entry_rel_path(relpath, entry), relpath, 0,
+                    entry_stat.st_size, entry_stat.st_mtime_ns)
+
+def index_stat(is_dir, size, mtime_ns):
+    """Builds the subset of an os.stat_result that diff_dir() compares."""
+    mode = stat.S_IFDIR if is_dir else stat.S_IFREG
+    mtime_ns = mtime_ns or 0
+    return SimpleNamespace(st_mode=mode, st_size=size, st_mtime_ns=mtime_ns,
+            st_mtime=mtime_ns / 1e9)
+
+def parent_rel_path(relpath):
+    """Returns the relative directory holding relpath, '' for the root."""
+    parent = os.path.dirname(relpath.rstrip(os.path.sep))
+    return os.path.join(parent, '') if parent else ''
+
 def get_rel_path(base, path):
     path = path[len(base):]
     if path.startswith(os.path.sep):
         path = path[1:]
     return path
 
+class Journal:
+    """SQLite write-ahead journal of the changes one backup run applies.
+
+    start() records every change as pending before the first is applied, and
+    backup_stream() marks each one done as soon as it succeeded, so after an
+    interruption pending() yields exactly what is left, in the original
+    order, without rescanning either tree.  Redoing a change that completed
+    just before a crash is harmless, as copies and removals are idempotent.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS run '
+                    '(base TEXT, backup TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS operations ('
+                    'seq INTEGER PRIMARY KEY, action TEXT NOT NULL, '
+                    'path TEXT NOT NULL, done INTEGER NOT NULL DEFAULT 0, '
+                    'UNIQUE (action, path))')
+
+    def close(self):
+        self.db.close()
+
+    def start(self, base, backup, events):
+        """Replaces the journal with a new run applying events to backup."""
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM run')
+            self.db.execute('DELETE FROM operations')
+            self.db.execute('INSERT INTO run VALUES (?, ?)',
+                    (os.path.abspath(base), os.path.abspath(backup)))
+            self.db.executemany('INSERT OR IGNORE INTO operations '
+                    '(action, path) VALUES (?, ?)',
+                    ((action, journal_path(item))
+                        for action, item in events if action != 'error'))
+
+    @property
+    def run(self):
+        """Returns the (base, backup) of the journaled run, or None."""
+        with self.lock:
+            return self.db.execute('SELECT base, backup FROM run').fetchone()
+
+    def pending(self, batch_size=1000):
+        """Yields the (action, relpath) changes not yet done, in order."""
+        seq = 0
+        while True:
+            with self.lock:
+                rows = self.db.execute('SELECT seq, action, path '
+                        'FROM operations '
+                        'WHERE done = 0 AND seq > ? ORDER BY seq LIMIT ?',
+                        (seq, batch_size)).fetchall()
+            if not rows:
+                return
+            for seq, action, path in rows:
+                if action == 'move':
+                    yield (action, tuple(path.split('\0')))
+                else:
+                    yield (action, path)
+
+    def complete(self, action, relpath):
+        with self.lock, self.db:
+            self.db.execute('UPDATE operations SET done = 1 '
+                    'WHERE action = ? AND path = ?',
+                    (action, journal_path(relpath)))
+
+    def clear(self):
+        """Forgets the run, once all of it was applied."""
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM run')
+            self.db.execute('DELETE FROM operations')
+
+def journal_path(item):
+    """Returns the journal's path column for an event item.
+
+    The (old, new) pair of a move is joined by a NUL, which no path contains.
+    """
+    return '\0'.join(item) if isinstance(item, tuple) else item
+
 #TODO symbolic link copying and testing
-def copy_to_backup(base, backup, relpath):
+def copy_to_backup(base, backup, relpath, method=None, stats=None,
+                    path_filter=None, throttle=None):
+    """Copies relpath from base to backup, returning the number of bytes copied.
+
+    Files are copied with shutil.copy2, or with copy_file() if a copy method is
+    given, in which case the methods used are counted in stats.  Either way
+    a file is copied to a temporary file that then replaces the backup, so an
+    interrupted copy never leaves a partial file in its place.  Entries below
+    a copied directory that path_filter excludes are not copied.  Each file
+    copied is paced by throttle.
+    """
     base_path = os.path.join(base, relpath)
     backup_path = os.path.join(backup, relpath)
+
+    def copy_and_count(src, dst):
+        if throttle is not None:
+            throttle.wait()
+        start = perf_counter()
+        if method is None:
+            def write(partial):
+                shutil.copy2(src, partial)
+                copy_owner(src, partial)
+            replace_atomically(dst, write)
+        else:
+            used = copy_file(src, dst, method)
+            if stats is not None:
+                stats.count_method(used)
+        sizes.append(os.path.getsize(dst))
+        if throttle is not None:
+            throttle.charge(sizes[-1], perf_counter() - start)
+        return dst
+
+    sizes = []
     if os.path.isfile(base_path):
-        shutil.copy2(base_path, backup_path)
+        copy_and_count(base_path, backup_path)
+        return sizes[0]
     elif os.path.isdir(base_path):
-        shutil.copytree(base_path, backup_path)
+        shutil.copytree(base_path, backup_path, copy_function=copy_and_count,
+                ignore=copytree_ignore(base, path_filter), dirs_exist_ok=True)
+        return sum(sizes)
     else:
         print('Warning: copying {} not supported.'.format(base_path))
+        return 0
+
+def copytree_ignore(base, path_filter=None):
+    """Returns a shutil.copytree() ignore function for copying below base.
+
+    It leaves out the entries path_filter excludes and, with a warning,
+    directory links that loop, see is_link_loop().
+    """
+    filter_ignore = None if path_filter is None else path_filter.ignore(base)
+
+    def ignore(path, names):
+        ignored = set() if filter_ignore is None else filter_ignore(path, names)
+        walk_ids = None
+        for name in names:
+            link_path = os.path.join(path, name)
+            if (name in ignored or not os.path.islink(link_path)
+                    or not os.path.isdir(link_path)):
+                continue
+            if walk_ids is None:
+                walk_ids = walk_dir_ids(base, get_rel_path(base, path))
+            if is_link_loop(link_path, path, walk_ids):
+                print('Warning: not copying symbolic link loop {}'.format(
+                        link_path))
+                ignored.add(name)
+        return ignored
+    return ignore
+
+def update_in_backup(base, backup, relpath, delta_threshold, method=None,
+                        stats=None, path_filter=None, throttle=None):
+    """Updates relpath in backup, delta copying files of delta_threshold bytes.
+
+    Returns the number of bytes written.
+    """
+    base_path = os.path.join(base, relpath)
+    backup_path = os.path.join(backup, relpath)
+    if (os.path.isfile(backup_path) and os.path.isfile(base_path)
+            and os.path.getsize(base_path) >= delta_threshold):
+        if throttle is None:
+            return delta_copy(base_path, backup_path)
+        throttle.wait()
+        written, seconds = timed_call(delta_copy, base_path, backup_path)
+        throttle.charge(written, seconds)
+        return written
+    return copy_to_backup(base, backup, relpath, method, stats, path_filter,
+            throttle)
+
+def copy_to_backups(base, backups, relpath, path_filter=None, throttle=None,
+                    parts=None):
+    """Copies relpath from base to each of backups, reading every file once.
+
+    parts, if given, holds for each backup either None, to copy all of
+    relpath, or the set of relative paths below the directory relpath that
+    backup needs, subtree roots as diff_walk() gives them.  Returns (sizes,
+    failures), the bytes copied to each backup and a dict with the OSError of
+    each index in backups the copy failed for; the other copies are still
+    completed.  Errors reading base are raised.  Entries below a copied
+    directory that path_filter excludes are not copied.  Each file copied is
+    paced by throttle, charged for the bytes written to all backups.
+    """
+    sizes = [0] * len(backups)
+    failures = {}
+
+    def wanted(rel_path):
+        return [i for i in range(len(backups)) if i not in failures
+                and (parts is None or parts[i] is None or rel_path in parts[i]
+                    or any(parent in parts[i]
+                        for parent in rel_path_parents(rel_path)))]
+
+    def each_backup(fn, rel_path):
+        for i in wanted(rel_path):
+            try:
+                fn(os.path.join(base, rel_path),
+                        os.path.join(backups[i], rel_path))
+            except OSError as e:
+                failures[i] = e
+
+    def copy_file_once(rel_file):
+        dsts = {i: os.path.join(backups[i], rel_file) for i in wanted(rel_file)}
+        if not dsts:
+            return
+        if throttle is not None:
+            throttle.wait()
+        start = perf_counter()
+        size, errors = fan_out_file(os.path.join(base, rel_file), dsts)
+        failures.update(errors)
+        for i in dsts:
+            if i not in errors:
+                sizes[i] += size
+        if throttle is not None:
+            throttle.charge(size * (len(dsts) - len(errors)),
+                    perf_counter() - start)
+
+    if os.path.isfile(os.path.join(base, relpath)):
+        copy_file_once(relpath)
+        return sizes, failures
+    elif not os.path.isdir(os.path.join(base, relpath)):
+        print('Warning: copying {} not supported.'.format(
+                os.path.join(base, relpath)))
+        return sizes, failures
+
+    pending = [relpath]
+    dirs = []
+    while pending and len(failures) < len(backups):
+        rel_dir = pending.pop()
+        each_backup(lambda src, dst: os.makedirs(dst, exist_ok=True), rel_dir)
+        dirs.append(rel_dir)
+        entries = scan_dir(os.path.join(base, rel_dir))
+        for name, entry in sorted(entries.items()):
+            rel_entry = entry_rel_path(rel_dir, entry)
+            if path_filter is not None and path_filter.excluded(rel_entry):
+                continue
+            if is_dir_entry(entry):
+                pending.append(rel_entry)
+            else:
+                copy_file_once(rel_entry)
+    for rel_dir in reversed(dirs):
+        each_backup(shutil.copystat, rel_dir)
+    return sizes, failures
+
+def rel_path_parents(relpath):
+    """Yields the directories relpath is below, innermost first."""
+    parent = split_rel_path(relpath)[0]
+    while parent:
+        yield parent
+        parent = split_rel_path(parent)[0]
+
+def delta_copy(src, dst, block_size=DELTA_BLOCK_SIZE):
+    """Updates dst in place to match src, only writing the blocks that differ.
+
+    Returns the number of bytes written.  The metadata is copied last, so an
+    interrupted update still looks out of date on the next run.
+    """
+    written = 0
+    offset = 0
+    with open(src, 'rb') as src_file, open(dst, 'r+b') as dst_file:
+        while True:
+            block = src_file.read(block_size)
+            if not block:
+                break
+            if dst_file.read(len(block)) != block:
+                dst_file.seek(offset)
+                dst_file.write(block)
+                written += len(block)
+            offset += len(block)
+        dst_file.truncate(offset)
+    shutil.copystat(src, dst)
+    copy_owner(src, dst)
+    return written
+
+def copy_file(src, dst, method='auto'):
+    """Copies the contents and metadata of src to dst, returning the method.
+
+    method is one of COPY_METHODS.  'auto' tries copy_file_range, a reflink,
+    sendfile and finally a buffered copy, moving on whenever the platform or
+    filesystem does not support one or copies fewer bytes than src holds.  A
+    method chosen explicitly must work.  The copy is written to a temporary
+    file that replaces dst once complete.
+    """
+    methods = COPY_METHODS[1:] if method == 'auto' else (method,)
+
+    def copy_contents(partial):
+        with open(src, 'rb') as src_file, open(partial, 'wb') as dst_file:
+            src_stat = os.fstat(src_file.fileno())
+            size = src_stat.st_size
+            for used in methods:
+                try:
+                    COPY_FUNCTIONS[used](src_file.fileno(), dst_file.fileno(),
+                            size)
+                    break
+                except OSError as e:
+                    if method != 'auto' or not (isinstance(e, ShortCopyError)
+                            or e.errno in COPY_FALLBACK_ERRNOS):
+                        raise
+                    dst_file.truncate(0)
+                    dst_file.seek(0)
+                    src_file.seek(0)
+        shutil.copystat(src, partial)
+        copy_owner(src, partial, src_stat)
+        return used
+
+    return replace_atomically(dst, copy_contents)
+
+def copy_owner(src, dst, src_stat=None):
+    """Gives dst, a path or file descriptor, the owner and group of src.
+
+    Only root can, so this does nothing otherwise.  The mode is restored
+    afterwards, as changing the owner clears the setuid and setgid bits.
+    """
+    if not PRESERVE_OWNER:
+        return
+    src_stat = src_stat or os.stat(src)
+    if (src_stat.st_uid, src_stat.st_gid) == (os.geteuid(), os.getegid()):
+        return
+    os.chown(dst, src_stat.st_uid, src_stat.st_gid)
+    if src_stat.st_mode & (stat.S_ISUID | stat.S_ISGID):
+        os.chmod(dst, stat.S_IMODE(src_stat.st_mode))
+
+def replace_atomically(dst, write):
+    """Calls write with a temporary path next to dst, then renames it to dst.
+
+    Returns what write returned.  The temporary file is removed if write
+    fails, leaving any existing dst untouched.
+    """
+    fd, partial = tempfile.mkstemp(dir=os.path.dirname(dst) or '.',
+            prefix='.elfi-', suffix='.part')
+    os.close(fd)
+    try:
+        result = write(partial)
+        os.replace(partial, dst)
+    except BaseException:
+        try:
+            os.remove(partial)
+        except OSError:
+            pass
+        raise
+    return result
+
+def fan_out_file(src, dsts):
+    """Copies the contents and metadata of src to each path in the dict dsts.
+
+    src is read once, each block being written to every copy before the next
+    is read.  Like copy_file(), each copy is written to a temporary file that
+    replaces its destination once complete.  Returns the size of src and a
+    dict with the OSError of each key of dsts whose copy failed; errors
+    reading src are raised.
+    """
+    failures = {}
+    partials = {}
+
+    def discard(key):
+        partial, dst_file = partials.pop(key)
+        dst_file.close()
+        try:
+            os.remove(partial)
+        except OSError:
+            pass
+
+    try:
+        for key, dst in dsts.items():
+            try:
+                fd, partial = tempfile.mkstemp(dir=os.path.dirname(dst) or '.',
+                        prefix='.elfi-', suffix='.part')
+            except OSError as e:
+                failures[key] = e
+            else:
+                partials[key] = (partial, open(fd, 'wb'))
+        size = 0
+        with open(src, 'rb') as src_file:
+            while partials:
+                block = src_file.read(COPY_BUFFER_SIZE)
+                if not block:
+                    break
+                size += len(block)
+                for key, (partial, dst_file) in list(partials.items()):
+                    try:
+                        dst_file.write(block)
+                    except OSError as e:
+                        failures[key] = e
+                        discard(key)
+        for key, (partial, dst_file) in list(partials.items()):
+            try:
+                dst_file.close()
+                shutil.copystat(src, partial)
+                copy_owner(src, partial)
+                os.replace(partial, dsts[key])
+            except OSError as e:
+                failures[key] = e
+                discard(key)
+            else:
+                del partials[key]
+    finally:
+        for key in list(partials):
+            discard(key)
+    return size, failures
+
+def copy_small_files(base, backup, rel_dir, files, method=None, stats=None,
+                        throttle=None):
+    """Copies small files from the directory rel_dir of base to the backup one.
+
+    files holds (inode, name) pairs.  The files are read in inode order, which
+    on most filesystems keeps the reads close together on disk, and both
+    directories are opened once so that each system call looks up a single
+    name, see copy_small_file().  Returns (name, bytes copied or OSError,
+    seconds) for each file.  If a copy method is given the files are counted
+    as 'batched' in stats.  Each file is paced by throttle.
+    """
+    results = []
+    src_dir = os.open(os.path.join(base, rel_dir), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        dst_dir = os.open(os.path.join(backup, rel_dir),
+                os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        os.close(src_dir)
+        raise
+    try:
+        for n, (inode, name) in enumerate(sorted(files)):
+            partial = '.elfi-{}-{}-{}.part'.format(os.getpid(), get_ident(), n)
+            if throttle is not None:
+                throttle.wait()
+            start = perf_counter()
+            try:
+                size = copy_small_file(src_dir, dst_dir, name, partial)
+            except OSError as e:
+                results.append((name, e, perf_counter() - start))
+                continue
+            seconds = perf_counter() - start
+            if throttle is not None:
+                throttle.charge(size, seconds)
+            if method is not None and stats is not None:
+                stats.count_method('batched')
+            results.append((name, size, seconds))
+    finally:
+        os.close(src_dir)
+        os.close(dst_dir)
+    return results
+
+def copy_small_file(src_dir, dst_dir, name, partial):
+    """Copies the file name between the directories open as src_dir and dst_dir.
+
+    The file is read with a single read() and written to partial in dst_dir,
+    which then replaces name, as replace_atomically() does.  The mode and
+    times come from the source's fstat(), and extended attributes are copied
+    as shutil.copy2() copies them.  Returns the number of bytes copied.
+    """
+    src_fd = os.open(name, os.O_RDONLY | os.O_CLOEXEC, dir_fd=src_dir)
+    try:
+        src_stat = os.fstat(src_fd)
+        data = b''
+        while len(data) < src_stat.st_size:
+            block = os.read(src_fd, src_stat.st_size - len(data))
+            if not block:
+                break
+            data += block
+        dst_fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+                | os.O_CLOEXEC, 0o600, dir_fd=dst_dir)
+        try:
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(dst_fd, view):]
+                copy_xattrs(src_fd, dst_fd)
+                copy_owner(None, dst_fd, src_stat)
+                os.fchmod(dst_fd, stat.S_IMODE(src_stat.st_mode))
+                os.utime(dst_fd,
+                        ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+            finally:
+                os.close(dst_fd)
+            os.replace(partial, name, src_dir_fd=dst_dir, dst_dir_fd=dst_dir)
+        except BaseException:
+            try:
+                os.remove(partial, dir_fd=dst_dir)
+            except OSError:
+                pass
+            raise
+    finally:
+        os.close(src_fd)
+    return len(data)
+
+def copy_xattrs(src_fd, dst_fd):
+    """Copies the extended attributes of the open file src_fd to dst_fd."""
+    if not hasattr(os, 'listxattr'):
+        return
+    try:
+        for name in os.listxattr(src_fd):
+            os.setxattr(dst_fd, name, os.getxattr(src_fd, name))
+    except OSError as e:
+        if e.errno not in XATTR_IGNORED_ERRNOS:
+            raise
+
+class ShortCopyError(OSError):
+    """Raised when a copy method stops before copying the whole file."""
+    def __init__(self, copied, size):
+        super().__init__(errno.EIO,
+                'copied {} of {} bytes'.format(copied, size))
+
+def copy_range(src_fd, dst_fd, size):
+    copied = 0
+    while copied < size:
+        count = os.copy_file_range(src_fd, dst_fd, size - copied)
+        if count == 0:
+            raise ShortCopyError(copied, size)
+        copied += count
+
+def copy_reflink(src_fd, dst_fd, size):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflinks not supported')
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+def copy_sendfile(src_fd, dst_fd, size):
+    copied = 0
+    while copied < size:
+        count = os.sendfile(dst_fd, src_fd, copied, size - copied)
+        if count == 0:
+            raise ShortCopyError(copied, size)
+        copied += count
+
+def copy_buffered(src_fd, dst_fd, size):
+    while True:
+        block = os.read(src_fd, COPY_BUFFER_SIZE)
+        if not block:
+            break
+        os.write(dst_fd, block)
+
+def missing_copy_function(src_fd, dst_fd, size):
+    raise OSError(errno.ENOSYS, 'copy method not available on this platform')
+
+COPY_METHODS = ('auto', 'copy_file_range', 'reflink', 'sendfile', 'buffered')
+COPY_FUNCTIONS = {
+    'copy_file_range': copy_range if hasattr(os, 'copy_file_range')
+                        else missing_copy_function,
+    'reflink': copy_reflink,
+    'sendfile': copy_sendfile if hasattr(os, 'sendfile')
+                        else missing_copy_function,
+    'buffered': copy_buffered,
+}
+XATTR_IGNORED_ERRNOS = {errno.EPERM, errno.ENOTSUP, errno.ENODATA, errno.EINVAL,
+                        errno.EACCES}
+COPY_FALLBACK_ERRNOS = {errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                        errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY,
+                        errno.EBADF, errno.ETXTBSY}
 
 #TODO symbolic link removal and testing
 def remove_from_backup(backup, relpath):
@@ -113,20 +2414,739 @@ def remove_from_backup(backup, relpath):
     else:
         print('Warning: removing {} not supported.'.format(backup_path))
 
+def archive_stream(base, archive_path, events, compression='gz', index=None,
+                    path_filter=None):
+    """Writes the entries added or updated by events into a tar archive.
+
+    The archive is compressed with one of ARCHIVE_COMPRESSIONS on a pipeline
+    of threads, see CompressingWriter.  Removed entries are not archived but
+    listed, along with the added and updated ones, in a final ARCHIVE_MANIFEST
+    member.  The archive is written to a temporary file and linked to
+    archive_path when complete, raising FileExistsError rather than replacing
+    an existing archive; only then is the index updated with the archived
+    entries, so an index tracking the archived state is never ahead of the
+    archives.  Entries below an archived directory that path_filter excludes
+    are left out.  An entry that cannot be read is recorded as a failure, but
+    one failing after its member was partly written, e.g. a file shrinking
+    while read, leaves the stream unreadable from there on, so the whole
+    archive is then abandoned and the error raised.  Returns a BackupStats
+    with the uncompressed bytes archived.
+    """
+    stats = BackupStats()
+    manifest = {'add': [], 'update': [], 'remove': []}
+    compressor = ARCHIVE_COMPRESSIONS[compression]()
+    item_sizes = []
+    #the member being added and the stream offset it starts at
+    current = []
+
+    def count_bytes(tarinfo):
+        name = tarinfo.name
+        if tarinfo.isdir():
+            name = os.path.join(name, '')
+        if path_filter is not None and path_filter.excluded(name):
+            return None
+        item_sizes.append(tarinfo.size)
+        current[:] = [tarinfo, tar.offset]
+        return tarinfo
+
+    def member_broken():
+        """Returns whether the stream ends in a partly written member."""
+        if not current:
+            return False
+        tarinfo, offset = current
+        return (tar.fileobj.pos != offset
+                and (not tar.members or tar.members[-1] is not tarinfo))
+
+    fd, partial_path = tempfile.mkstemp(
+            dir=os.path.dirname(archive_path) or '.', prefix='.elfi-',
+            suffix='.part')
+    try:
+        with open(fd, 'wb') as archive_file:
+            writer = CompressingWriter(archive_file, compressor)
+            try:
+                with tarfile.open(fileobj=writer, mode='w|', dereference=True,
+                                    format=tarfile.PAX_FORMAT) as tar:
+                    for action, item in events:
+                        if action == 'error':
+                            stats.failures.append(item)
+                        elif action == 'remove':
+                            manifest['remove'].append(item)
+                            stats.removed += 1
+                        elif action in ('add', 'update'):
+                            item_sizes.clear()
+                            current.clear()
+                            try:
+                                tar.add(os.path.join(base, item), arcname=item,
+                                        filter=count_bytes)
+                            except OSError as e:
+                                if member_broken():
+                                    raise
+                                stats.failures.append((item, e))
+                            else:
+                                manifest[action].append(item)
+                                stats.copied += 1
+                                stats.bytes += sum(item_sizes)
+
+                    manifest_data = json.dumps({action: sorted(items)
+                            for action, items in manifest.items()},
+                            indent=1).encode()
+                    tarinfo = tarfile.TarInfo(ARCHIVE_MANIFEST)
+                    tarinfo.size = len(manifest_data)
+                    tarinfo.mtime = time()
+                    tar.addfile(tarinfo, io.BytesIO(manifest_data))
+            finally:
+                writer.close()
+            archive_file.flush()
+            os.fsync(archive_file.fileno())
+        os.link(partial_path, archive_path)
+    finally:
+        os.remove(partial_path)
+
+    if index is not None:
+        for item in manifest['remove']:
+            index.remove(item)
+        for item in manifest['add'] + manifest['update']:
+            index.add(base, item)
+        index.finish_dirs(item for item, error in stats.failures)
+    stats.finish()
+    return stats
+
+class CompressingWriter:
+    """Write-only file object that compresses and writes on background threads.
+
+    Written data is batched into ARCHIVE_CHUNK_SIZE chunks and handed through
+    bounded queues to a compressing thread and then a writing thread, so that
+    reading the source files, compressing and writing the archive overlap.
+    compressor is any object with compress() and flush() methods.
+    """
+    def __init__(self, fileobj, compressor):
+        self.fileobj = fileobj
+        self.compressor = compressor
+        self.buffer = bytearray()
+        self.chunks = Queue(maxsize=ARCHIVE_QUEUE_SIZE)
+        self.compressed = Queue(maxsize=ARCHIVE_QUEUE_SIZE)
+        self.error = None
+        self.threads = [Thread(target=self.compress_chunks, daemon=True),
+                        Thread(target=self.write_chunks, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= ARCHIVE_CHUNK_SIZE:
+            self.put_buffer()
+        return len(data)
+
+    def put_buffer(self):
+        if self.error is not None:
+            raise self.error
+        self.chunks.put(bytes(self.buffer))
+        self.buffer.clear()
+
+    def close(self):
+        """Flushes the remaining data and waits for it to be written."""
+        if self.threads:
+            self.chunks.put(bytes(self.buffer))
+            self.buffer.clear()
+            self.chunks.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+        if self.error is not None:
+            raise self.error
+
+    def compress_chunks(self):
+        #keep draining after an error so the producer never blocks forever
+        while True:
+            chunk = self.chunks.get()
+            try:
+                if chunk is None:
+                    self.compressed.put(self.compressor.flush())
+                    self.compressed.put(None)
+                    return
+                if self.error is None:
+                    self.compressed.put(self.compressor.compress(chunk))
+            except Exception as e:
+                self.error = self.error or e
+
+    def write_chunks(self):
+        while True:
+            data = self.compressed.get()
+            if data is None:
+                return
+            try:
+                if self.error is None:
+                    self.fileobj.write(data)
+            except Exception as e:
+                self.error = self.error or e
+
+class NullCompressor:
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+def gzip_compressor():
+    #wbits of 16 + MAX_WBITS makes zlib write a gzip header and trailer
+    return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+ARCHIVE_COMPRESSIONS = {
+    'none': NullCompressor,
+    'gz': gzip_compressor,
+    'bz2': bz2.BZ2Compressor,
+    'xz': lzma.LZMACompressor,
+}
+if zstandard is not None:
+    ARCHIVE_COMPRESSIONS['zst'] = (
+            lambda: zstandard.ZstdCompressor().compressobj())
+
+def archive_name(compression):
+    """Returns a file name for a new archive, timestamped to the nanosecond."""
+    return timestamped_name('.tar' if compression == 'none'
+            else '.tar.' + compression)
+
+def timestamped_name(suffix):
+    """Returns elfi-<local time>-<ns><suffix>, sorting in creation order."""
+    now_ns = time_ns()
+    return '{}-{:09d}{}'.format(strftime('elfi-%Y%m%d-%H%M%S',
+            localtime(now_ns // 1000000000)), now_ns % 1000000000, suffix)
+
+def snapshot_backup(base, backup, workers=1, compare=None, path_filter=None,
+                    observer=None, copy_method=None, throttle=None,
+                    small_file_size=None):
+    """Adds a new snapshot of base to backup, a directory of dated snapshots.
+
+    Base is compared against the latest snapshot, every file that did not
+    change is hard-linked from it and only the added and updated entries
+    are copied, so a snapshot costs a metadata operation per entry plus the
+    changed data.  The snapshot is built in a hidden partial directory and
+    renamed into place when done; partial directories left by interrupted
+    runs are deleted.  Returns the snapshot's name and a BackupStats.
+    """
+    backup = os.path.abspath(backup)
+    os.makedirs(backup, exist_ok=True)
+    for name in os.listdir(backup):
+        if name.startswith('.') and name.endswith(SNAPSHOT_PARTIAL_SUFFIX):
+            shutil.rmtree(os.path.join(backup, name))
+
+    snapshots = list_snapshots(backup)
+    name = timestamped_name('')
+    partial = os.path.join(backup, '.' + name + SNAPSHOT_PARTIAL_SUFFIX)
+    os.makedirs(partial)
+    linked = 0
+    if snapshots:
+        previous = os.path.join(backup, snapshots[-1])
+        add_set, remove_set, update_set = diff_walk(base, previous, workers,
+                compare=compare, path_filter=path_filter, observer=observer)
+        linked = link_tree(previous, partial, remove_set | update_set)
+        changed = add_set | update_set
+    else:
+        changed = diff_walk(base, partial, workers, path_filter=path_filter,
+                observer=observer)[0]
+
+    stats = backup_stream(base, partial, (('add', item) for item in changed),
+            workers, copy_method=copy_method, path_filter=path_filter,
+            observer=observer, throttle=throttle,
+            small_file_size=small_file_size)
+    stats.linked = linked
+    shutil.copystat(base if os.path.isdir(base) else os.path.dirname(base),
+            partial)
+    os.rename(partial, os.path.join(backup, name))
+    return name, stats
+
+def list_snapshots(backup):
+    """Returns the names of the snapshots in backup, oldest first."""
+    return sorted(name for name in os.listdir(backup)
+            if name.startswith('elfi-')
+            and os.path.isdir(os.path.join(backup, name)))
+
+def link_tree(src, dst, skip=()):
+    """Recreates the tree src in dst, hard-linking its files.
+
+    Entries in skip, relative paths as diff_walk() gives them, are left out
+    along with everything below them.  Directory metadata is copied after
+    their contents are linked.  Returns the number of files linked.
+    """
+    linked = 0
+    pending = [('', False)]
+    while pending:
+        rel_path, visited = pending.pop()
+        if visited:
+            shutil.copystat(os.path.join(src, rel_path),
+                    os.path.join(dst, rel_path))
+            continue
+        pending.append((rel_path, True))
+        for entry in scan_dir(os.path.join(src, rel_path)).values():
+            relpath = entry_rel_path(rel_path, entry)
+            if relpath in skip:
+                continue
+            if is_dir_entry(entry):
+                os.mkdir(os.path.join(dst, relpath))
+                pending.append((relpath, False))
+            else:
+                os.link(entry.path, os.path.join(dst, relpath),
+                        follow_symlinks=False)
+                linked += 1
+    return linked
+
+def prune_snapshots(backup, keep_last=0, keep_daily=0, keep_weekly=0,
+                    keep_monthly=0):
+    """Deletes the snapshots no keep option retains, returning their names.
+
+    keep_last keeps the latest snapshots, and keep_daily, keep_weekly and
+    keep_monthly the latest snapshot of each of that many of the latest days,
+    ISO weeks and months holding one.  The latest snapshot is always kept.
+    """
+    snapshots = list_snapshots(backup)[::-1]
+    kept = set(snapshots[:max(keep_last, 1)])
+    for count, period in ((keep_daily, '%Y-%m-%d'), (keep_weekly, '%G-%V'),
+                            (keep_monthly, '%Y-%m')):
+        periods = set()
+        for name in snapshots:
+            if len(periods) >= count:
+                break
+            key = strftime(period, snapshot_time(name))
+            if key not in periods:
+                periods.add(key)
+                kept.add(name)
+
+    pruned = [name for name in snapshots if name not in kept]
+    for name in pruned:
+        shutil.rmtree(os.path.join(backup, name))
+    return pruned
+
+def snapshot_time(name):
+    """Returns the local time a timestamped_name() snapshot was made."""
+    return strptime(name[len('elfi-'):len('elfi-YYYYmmdd-HHMMSS')],
+            '%Y%m%d-%H%M%S')
+
+class ChunkStore:
+    """Content-addressed backup store with one manifest per backup run.
+
+    File contents are split into STORE_CHUNK_SIZE chunks, each stored once
+    under objects/ by its BLAKE2b digest, so duplicated, renamed and moved
+    files take no extra space.  Every run writes a manifest to manifests/
+    that maps each relative path to its type, size, mtime, mode and chunk
+    digests, so any run can be restored on its own.  Objects and manifests
+    are written through temporary files, so an interrupted run leaves no
+    partial ones behind.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        self.manifests = os.path.join(root, 'manifests')
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.manifests, exist_ok=True)
+        #striped by digest, see put()
+        self.locks = [Lock() for i in range(64)]
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest[2:])
+
+    def put(self, data):
+        """Stores data, returning its digest and the number of bytes written.
+
+        Threads storing the same chunk at once wait for each other, so the
+        chunk is written and counted once.
+        """
+        digest = hashlib.blake2b(data, digest_size=32).hexdigest()
+        path = self.object_path(digest)
+
+        def write(partial):
+            with open(partial, 'wb') as f:
+                f.write(data)
+        with self.locks[int(digest[:2], 16) % len(self.locks)]:
+            if os.path.exists(path):
+                return digest, 0
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            replace_atomically(path, write)
+        return digest, len(data)
+
+    def get(self, digest):
+        with open(self.object_path(digest), 'rb') as f:
+            return f.read()
+
+    def manifest_names(self):
+        """Returns the names of all manifests, oldest first."""
+        return sorted(name for name in os.listdir(self.manifests)
+                if name.endswith(STORE_MANIFEST_SUFFIX))
+
+    def load_manifest(self, name=None):
+        """Returns the entries of manifest name, by default the latest one.
+
+        Returns an empty dict if the store holds no manifest yet.
+        """
+        if name is None:
+            names = self.manifest_names()
+            if not names:
+                return {}
+            name = names[-1]
+        with gzip.open(os.path.join(self.manifests, name), 'rt') as f:
+            return json.load(f)
+
+    def save_manifest(self, entries):
+        """Writes entries as a new manifest, returning its name."""
+        name = timestamped_name(STORE_MANIFEST_SUFFIX)
+
+        def write(partial):
+            with gzip.open(partial, 'wt') as f:
+                json.dump(entries, f, separators=(',', ':'))
+        replace_atomically(os.path.join(self.manifests, name), write)
+        return name
+
+def store_backup(base, store, workers=1, path_filter=None):
+    """Backs the base tree up into store, a ChunkStore, as a new manifest.
+
+    Files whose size and mtime match the latest manifest reuse its chunks
+    without being read.  Other files are read and hashed on up to workers
+    threads, and only the chunks not yet in the store are written.  Returns a
+    BackupStats where copied counts the files read, bytes the bytes written
+    to the store and removed the paths gone since the latest manifest.
+    Entries that could not be read or listed keep what the latest manifest
+    holds for them, so a failure never drops them from the new one.
+    """
+    stats = BackupStats()
+    base = os.path.abspath(base)
+    previous = store.load_manifest()
+    entries = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+
+        def collect(done):
+            for future in done:
+                relpath, entry = futures.pop(future)
+                try:
+                    entry['chunks'], written = future.result()
+                except OSError as e:
+                    stats.failures.append((relpath, e))
+                else:
+                    entries[relpath] = entry
+                    stats.copied += 1
+                    stats.bytes += written
+
+        for relpath, entry_stat in walk_tree(base, path_filter, stats.failures):
+            entry = {'type': 'file', 'size': entry_stat.st_size,
+                    'mtime_ns': entry_stat.st_mtime_ns,
+                    'mode': stat.S_IMODE(entry_stat.st_mode)}
+            if stat.S_ISDIR(entry_stat.st_mode):
+                entry.update(type='dir', size=0)
+                entries[relpath] = entry
+                continue
+            old = previous.get(relpath)
+            if (old is not None and old['type'] == 'file'
+                    and old['size'] == entry['size']
+                    and old['mtime_ns'] == entry['mtime_ns']):
+                entry['chunks'] = old['chunks']
+                entries[relpath] = entry
+                continue
+            if len(futures) >= workers * 4:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = executor.submit(store_file, store,
+                    os.path.join(base, relpath))
+            futures[future] = (relpath, entry)
+        collect(list(futures))
+
+    failed = {relpath for relpath, error in stats.failures}
+    if failed:
+        for relpath, old in previous.items():
+            if relpath not in entries and ('' in failed or relpath in failed
+                    or any(parent in failed
+                        for parent in rel_path_parents(relpath))):
+                entries[relpath] = old
+    stats.removed = len(previous.keys() - entries.keys())
+    store.save_manifest(entries)
+    stats.finish()
+    return stats
+
+def store_file(store, path):
+    """Stores the chunks of the file at path, returning (digests, written)."""
+    digests = []
+    written = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(STORE_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest, chunk_written = store.put(chunk)
+            digests.append(digest)
+            written += chunk_written
+    return digests, written
+
+def walk_tree(base, path_filter=None, failures=None, root=''):
+    """Yields (relpath, stat) for every entry below base, following symlinks.
+
+    With root, only the entries below the directory root of base are
+    walked.  Directories are yielded before their contents, and the entries
+    of a directory one after the other.  Entries that cannot be
+    listed or stat'ed, and symlink loops, are appended to failures as
+    (relpath, OSError) and skipped.
+    """
+    pending = [root]
+    while pending:
+        rel_path = pending.pop()
+        path = os.path.join(base, rel_path)
+        try:
+            entries = scan_dir(path)
+        except OSError as e:
+            if failures is not None:
+                failures.append((rel_path, e))
+            continue
+        if path_filter is not None:
+            entries = path_filter.filter_entries(rel_path, entries)
+        for name, entry in sorted(entries.items()):
+            relpath = entry_rel_path(rel_path, entry)
+            try:
+                if (entry.is_symlink() and is_dir_entry(entry)
+                        and is_link_loop(os.path.join(path, name), path,
+                            walk_dir_ids(base, rel_path))):
+                    raise OSError(errno.ELOOP, 'symbolic link loop',
+                            os.path.join(path, name))
+                entry_stat = entry.stat()
+            except OSError as e:
+                if failures is not None:
+                    failures.append((relpath, e))
+                continue
+            yield relpath, entry_stat
+            if is_dir_entry(entry):
+                pending.append(relpath)
+
+def store_restore(store, target, name=None):
+    """Recreates the tree of manifest name, by default the latest, in target.
+
+    Returns the number of entries restored.
+    """
+    entries = store.load_manifest(name)
+    os.makedirs(target, exist_ok=True)
+    #parents sort before their contents
+    for relpath in sorted(entries):
+        entry = entries[relpath]
+        path = os.path.join(target, relpath)
+        if entry['type'] == 'dir':
+            os.makedirs(path, exist_ok=True)
+            continue
+
+        def write(partial):
+            with open(partial, 'wb') as f:
+                for digest in entry['chunks']:
+                    f.write(store.get(digest))
+        replace_atomically(path, write)
+        os.chmod(path, entry['mode'])
+        os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+    #directory metadata last, deepest first, as restoring their contents
+    #changes it
+    for relpath in sorted(entries, reverse=True):
+        entry = entries[relpath]
+        if entry['type'] == 'dir':
+            path = os.path.join(target, relpath)
+            os.chmod(path, entry['mode'])
+            os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+    return len(entries)
+
 def newer(path1, path2):
-    return int(os.path.getmtime(path1)) > int(os.path.getmtime(path2))
+    return newer_stat(os.stat(path1), os.stat(path2))
+
+def newer_stat(stat1, stat2):
+    return stat1.st_mtime_ns > stat2.st_mtime_ns
+
+def compare_mtime(base_path, backup_path, base_stat, backup_stat):
+    """Compares two versions of a file by their mtimes in ns.
+
+    Returns 'update' if the backup is out of date, 'newer' if the backup is
+    newer than the original, and None otherwise.  This is the default policy
+    of diff_dir(); like the others in COMPARE_POLICIES it only looks at the
+    stat results the walk already has, so it costs no system calls.
+    """
+    if newer_stat(base_stat, backup_stat):
+        return 'update'
+    elif newer_stat(backup_stat, base_stat):
+        return 'newer'
+    return None
+
+def compare_mtime_seconds(base_path, backup_path, base_stat, backup_stat):
+    """Compares two versions of a file by their mtimes in whole seconds.
+
+    For backups on filesystems that keep coarser times than base, e.g. FAT
+    or some network filesystems.
+    """
+    base_seconds = base_stat.st_mtime_ns // 1000000000
+    backup_seconds = backup_stat.st_mtime_ns // 1000000000
+    if base_seconds > backup_seconds:
+        return 'update'
+    elif backup_seconds > base_seconds:
+        return 'newer'
+    return None
+
+def compare_size_mtime(base_path, backup_path, base_stat, backup_stat):
+    """Like compare_mtime(), but also updates files whose size differs."""
+    change = compare_mtime(base_path, backup_path, base_stat, backup_stat)
+    if change is None and base_stat.st_size != backup_stat.st_size:
+        return 'update'
+    return change
+
+def compare_ctime(base_path, backup_path, base_stat, backup_stat):
+    """Like compare_mtime(), but also updates files changed after their copy.
+
+    A copy's ctime is when it was made, so a later ctime of the original
+    means it changed since, catching contents rewritten with the mtime
+    restored as well as changed permissions.
+    """
+    change = compare_mtime(base_path, backup_path, base_stat, backup_stat)
+    if change is None and base_stat.st_ctime_ns > backup_stat.st_ctime_ns:
+        return 'update'
+    return change
+
+def compare_attributes(base_path, backup_path, base_stat, backup_stat):
+    """Like compare_mtime(), but also updates files whose permissions differ.
+
+    So do their owners and groups, but only when copies keep them, that is
+    when made as root, see copy_owner(); otherwise a file owned by another
+    user would be updated on every run.
+    """
+    change = compare_mtime(base_path, backup_path, base_stat, backup_stat)
+    if change is not None:
+        return change
+    if stat.S_IMODE(base_stat.st_mode) != stat.S_IMODE(backup_stat.st_mode):
+        return 'update'
+    if PRESERVE_OWNER and ((base_stat.st_uid, base_stat.st_gid)
+            != (backup_stat.st_uid, backup_stat.st_gid)):
+        return 'update'
+    return None
+
+COMPARE_POLICIES = {
+    'mtime': compare_mtime,
+    'mtime_s': compare_mtime_seconds,
+    'size_mtime': compare_size_mtime,
+    'ctime': compare_ctime,
+    'attrs': compare_attributes,
+}
+#need stat fields BackupIndex does not keep
+INDEXLESS_POLICIES = ('ctime', 'attrs')
+
+def hash_compare(hash_cache):
+    """Returns a compare function that finds updates by size and content hash.
+
+    Only files of equal size are hashed, and hash_cache keeps unchanged files
+    from being read again.
+    """
+    def compare(base_path, backup_path, base_stat, backup_stat):
+        if base_stat.st_size != backup_stat.st_size:
+            return 'update'
+        if not hasattr(backup_stat, 'st_ino'):
+            #indexed entries lack the identity the cache is keyed by
+            backup_stat = os.stat(backup_path)
+        if (hash_cache.digest(base_path, base_stat)
+                != hash_cache.digest(backup_path, backup_stat)):
+            return 'update'
+        return None
+    return compare
+
+class HashCache:
+    """SQLite cache of file content digests.
 
-def print_diff_walk(add_set, remove_set, update_set):
-    """Prints the changes detected by diff_walk()."""
+    A digest is reused while the file's path, size, mtime_ns, inode and ctime_ns
+    are unchanged; ctime catches a file rewritten in place with its mtime
+    restored, as shutil.copy2 does.  Files larger than HASH_CHUNK_SIZE are
+    hashed in chunks read in parallel on a pool of workers threads.
+    """
+    def __init__(self, path=':memory:', workers=4):
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                    'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                    'inode INTEGER, ctime_ns INTEGER, digest TEXT)')
+
+    def close(self):
+        self.executor.shutdown()
+        self.db.close()
+
+    def digest(self, path, file_stat):
+        """Returns the digest of path, whose current stat is file_stat."""
+        key = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino,
+                file_stat.st_ctime_ns)
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime_ns, inode, ctime_ns, '
+                    'digest FROM hashes WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[:4] == key:
+            return row[4]
+
+        digest = hash_file(path, file_stat.st_size, self.executor)
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO hashes '
+                    'VALUES (?, ?, ?, ?, ?, ?)', (path,) + key + (digest,))
+        return digest
+
+def new_hash():
+    if xxhash is not None:
+        return xxhash.xxh3_128()
+    return hashlib.blake2b(digest_size=16)
+
+def hash_file(path, size, executor=None):
+    """Returns a hex content digest of path, which is size bytes long.
+
+    Larger files are hashed as the digest of the digests of their
+    HASH_CHUNK_SIZE chunks, which are read and hashed in parallel on executor.
+    """
+    with open(path, 'rb') as f:
+        if size <= HASH_CHUNK_SIZE:
+            file_hash = new_hash()
+            file_hash.update(f.read())
+            return file_hash.hexdigest()
+
+        fd = f.fileno()
+        def hash_chunk(offset):
+            chunk_hash = new_hash()
+            chunk_hash.update(os.pread(fd, HASH_CHUNK_SIZE, offset))
+            return chunk_hash.digest()
+
+        offsets = range(0, size, HASH_CHUNK_SIZE)
+        chunk_digests = executor.map(hash_chunk, offsets) if executor else map(
+                hash_chunk, offsets)
+        file_hash = new_hash()
+        for chunk_digest in chunk_digests:
+            file_hash.update(chunk_digest)
+        return file_hash.hexdigest()
+
+def print_diff_walk(add_set, remove_set, update_set, move_set=()):
+    """Prints the changes detected by diff_walk().
+
+    The sets are printed in their iteration order, which diff_walk() keeps
+    sorted.
+    """
     print('To be added to backup:')
-    for item in sorted(add_set):
+    for item in add_set:
         print('    {}'.format(item))
     print('To be removed from backup:')
-    for item in sorted(remove_set):
+    for item in remove_set:
         print('    {}'.format(item))
     print('To be updated in backup:')
-    for item in sorted(update_set):
+    for item in update_set:
         print('    {}'.format(item))
+    if move_set:
+        print('To be moved in backup:')
+        for old, new in move_set:
+            print('    {} -> {}'.format(old, new))
+
+def print_backup_stats(stats):
+    """Prints the summary returned by do_backup() or backup_stream()."""
+    print('Copied {} entries ({} bytes), removed {} entries in {:.2f}s'.format(
+            stats.copied, stats.bytes, stats.removed, stats.elapsed))
+    if stats.moved:
+        print('    moved {} entries'.format(stats.moved))
+    if stats.linked:
+        print('    hard-linked {} unchanged files'.format(stats.linked))
+    print('    {:.1f} files/s, {:.1f} bytes/s'.format(stats.files_per_sec,
+            stats.bytes_per_sec))
+    if stats.methods:
+        print('    copied with {}'.format(', '.join(
+                '{} ({})'.format(method, count)
+                for method, count in sorted(stats.methods.items()))))
+    for item, error in sorted(stats.failures, key=lambda failure: failure[0]):
+        print('Warning: backing up {} failed: {}'.format(item, error))
 
 def print_walk(base):
     """Prints the result of walking starting at the path argument."""
@@ -137,11 +3157,380 @@ def print_walk(base):
         print('files:\t{}'.format(files))
         print()
 
+def parse_size(size):
+    """Parses a byte count such as 4096, 64K or 1.5G."""
+    size = size.strip().upper().rstrip('B')
+    suffix = size[-1:] if size[-1:] in SIZE_SUFFIXES else ''
+    try:
+        number = float(size[:len(size) - len(suffix)])
+        return int(number * SIZE_SUFFIXES[suffix])
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid size: {}'.format(size))
+
+def positive_seconds(value):
+    """Parses a positive number of seconds."""
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = 0.0
+    if not seconds > 0:
+        raise argparse.ArgumentTypeError(
+                'must be a positive number: {}'.format(value))
+    return seconds
+
+def positive_int(value):
+    """Parses a count of at least one."""
+    try:
+        count = int(value)
+    except ValueError:
+        count = 0
+    if count < 1:
+        raise argparse.ArgumentTypeError(
+                'must be a positive integer: {}'.format(value))
+    return count
+
+def parse_regex(value):
+    try:
+        re.compile(value)
+    except re.error as e:
+        raise argparse.ArgumentTypeError(
+                'invalid regex: {}: {}'.format(value, e))
+    return value
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+            description='Compare a directory tree against its backup.')
+    parser.add_argument('base', help='directory tree to back up')
+    parser.add_argument('backup', help='backup of the base directory tree')
+    parser.add_argument('-j', '--jobs', type=positive_int, default=1,
+            help='number of directories to compare and files to copy '
+                'concurrently (default: 1)')
+    parser.add_argument('-a', '--apply', action='store_true',
+            help='copy and remove entries so the backup matches base')
+    parser.add_argument('--index', metavar='FILE',
+            help='compare against an index of the backup kept in FILE instead '
+                'of listing the backup tree; keep FILE outside the backup')
+    parser.add_argument('--rebuild-index', action='store_true',
+            help='reconstruct the index from the backup tree before comparing')
+    parser.add_argument('--compare',
+            choices=sorted(COMPARE_POLICIES) + ['hash'], default='mtime',
+            help='detect updated files by mtime in ns, in whole seconds '
+                '(mtime_s), by size and mtime, also by a ctime later than the '
+                'copy\'s, also by permissions and owner (attrs), or by size '
+                'and content hash (default: mtime)')
+    parser.add_argument('--hash-cache', metavar='FILE',
+            help='keep content hashes in FILE between runs, required by '
+                '--compare=hash')
+    parser.add_argument('--detect-moves', action='store_true',
+            help='rename entries that were moved or renamed in base within '
+                'the backup instead of removing and copying them again')
+    parser.add_argument('--delta-threshold', type=parse_size, metavar='SIZE',
+            help='rewrite only the changed blocks of updated files of at least '
+                'SIZE bytes, e.g. 64M')
+    parser.add_argument('--copy-method', choices=COPY_METHODS, default='auto',
+            help='how file contents are copied; auto falls back from '
+                'copy_file_range to reflink, sendfile and buffered '
+                '(default: auto)')
+    parser.add_argument('--small-files', type=parse_size, metavar='SIZE',
+            help='copy files of at most SIZE bytes, e.g. 16K, in batches per '
+                'directory, read in inode order with fewer system calls each')
+    parser.add_argument('--exclude', action='append', default=[],
+            metavar='PATTERN',
+            help='leave out entries matching the gitignore-style glob PATTERN, '
+                'e.g. node_modules/ or /build/*.o; may be repeated')
+    parser.add_argument('--include', action='append', default=[],
+            metavar='PATTERN',
+            help='keep entries matching PATTERN even if excluded, unless an '
+                'enclosing directory is excluded; may be repeated')
+    parser.add_argument('--exclude-regex', action='append', default=[],
+            type=parse_regex, metavar='REGEX',
+            help='leave out entries whose relative path, ending with a '
+                'separator for directories, matches REGEX; may be repeated')
+    parser.add_argument('--include-regex', action='append', default=[],
+            type=parse_regex, metavar='REGEX',
+            help='keep entries matching REGEX even if excluded; '
+                'may be repeated')
+    parser.add_argument('--target', action='append', default=[], metavar='DIR',
+            help='also back up to DIR, can be repeated; base is walked and '
+                'each changed file read only once for all backups')
+    parser.add_argument('--watch', action='store_true',
+            help='back up, then keep watching base and back up its changes '
+                'until interrupted; implies --apply')
+    parser.add_argument('--interval', type=positive_seconds,
+            default=WATCH_INTERVAL, metavar='SECONDS',
+            help='with --watch, back up the changes made within SECONDS of '
+                'the first one together (default: {:g})'.format(WATCH_INTERVAL))
+    parser.add_argument('--snapshot', action='store_true',
+            help='instead of mirroring, add a new dated snapshot directory to '
+                'backup, hard-linking unchanged files from the latest one; '
+                'requires --apply')
+    for period in ('last', 'daily', 'weekly', 'monthly'):
+        parser.add_argument('--keep-' + period, type=positive_int, default=0,
+                metavar='N',
+                help='after a --snapshot, keep the {} snapshots and delete '
+                    'older ones not kept by another --keep option'.format(
+                    'N latest' if period == 'last' else
+                    'latest of each of the N latest {} periods'.format(period)))
+    parser.add_argument('--store', action='store_true',
+            help='instead of mirroring, keep backup as a deduplicating store '
+                'of content-addressed chunks with a manifest per run; '
+                'requires --apply or --restore')
+    parser.add_argument('--restore', metavar='MANIFEST',
+            help="restore MANIFEST, or 'latest', from the --store in backup "
+                'into the base directory')
+    parser.add_argument('--archive', choices=sorted(ARCHIVE_COMPRESSIONS),
+            metavar='COMPRESSION',
+            help='instead of mirroring, write the changes as a new tar archive '
+                'in the backup directory, compressed with one of {} (requires '
+                '--index to track what was archived)'.format(
+                ', '.join(sorted(ARCHIVE_COMPRESSIONS))))
+    parser.add_argument('--bwlimit', type=parse_size, metavar='SIZE',
+            help='copy at most SIZE bytes per second, e.g. 50M')
+    parser.add_argument('--ops-limit', type=positive_int, metavar='N',
+            help='copy or remove at most N entries per second')
+    parser.add_argument('--adaptive-throttle', action='store_true',
+            help='lower the --bwlimit and --ops-limit rates while copies slow '
+                'down, e.g. because other work keeps the disks busy')
+    parser.add_argument('--journal', metavar='FILE',
+            help='record the changes to apply in FILE before applying them, so '
+                'an interrupted --apply can be resumed')
+    parser.add_argument('--resume', action='store_true',
+            help='finish the changes left pending in the --journal by an '
+                'interrupted run, without comparing the trees again')
+    parser.add_argument('--stats', metavar='FILE',
+            help="write counters, phase times and the slowest directories and "
+                "entries as JSON to FILE, '-' for stdout")
+    parser.add_argument('--profile', metavar='FILE',
+            help='profile the run with cProfile and save the stats to FILE')
+    parser.add_argument('--trace-memory', action='store_true',
+            help='trace allocations with tracemalloc and add the peak and top '
+                'allocation sites to the --stats output')
+    args = parser.parse_args(argv)
+    if args.trace_memory and not args.stats:
+        parser.error('--trace-memory requires --stats')
+    if args.rebuild_index and not args.index:
+        parser.error('--rebuild-index requires --index')
+    if args.archive and not args.index:
+        parser.error('--archive requires --index')
+    if args.archive and args.rebuild_index:
+        parser.error('--rebuild-index cannot rebuild an archive index')
+    if args.compare == 'hash' and not args.hash_cache:
+        parser.error('--compare=hash requires --hash-cache')
+    if args.index and args.compare in INDEXLESS_POLICIES:
+        parser.error('--compare={} cannot be combined with --index'.format(
+                args.compare))
+    if args.archive and args.compare == 'hash':
+        parser.error('--compare=hash needs a mirrored backup, not --archive')
+    keep = (args.keep_last, args.keep_daily, args.keep_weekly,
+            args.keep_monthly)
+    if args.snapshot and not args.apply:
+        parser.error('--snapshot requires --apply')
+    if any(keep) and not args.snapshot:
+        parser.error('--keep-* options require --snapshot')
+    if args.snapshot and (args.archive or args.store or args.index
+            or args.journal or args.detect_moves or args.delta_threshold):
+        parser.error('--snapshot cannot be combined with --archive, --store, '
+                '--index, --journal, --detect-moves or --delta-threshold')
+    if args.watch and (args.archive or args.store or args.snapshot
+            or args.target or args.index or args.journal or args.detect_moves):
+        parser.error('--watch cannot be combined with --archive, --store, '
+                '--snapshot, --target, --index, --journal or --detect-moves')
+    if args.small_files is not None and (args.archive or args.store
+            or args.target):
+        parser.error('--small-files cannot be combined with --archive, --store '
+                'or --target')
+    if args.target and (args.archive or args.store or args.snapshot
+            or args.index or args.journal or args.detect_moves
+            or args.delta_threshold or args.copy_method != 'auto'):
+        parser.error('--target cannot be combined with --archive, --store, '
+                '--snapshot, --index, --journal, --detect-moves, '
+                '--delta-threshold or --copy-method')
+    if args.store and not (args.apply or args.restore):
+        parser.error('--store requires --apply or --restore')
+    if args.restore and not args.store:
+        parser.error('--restore requires --store')
+    if args.detect_moves and (args.archive or args.store):
+        parser.error('--detect-moves needs a mirrored backup')
+    if args.store and (args.archive or args.index or args.journal):
+        parser.error('--store cannot be combined with --archive, --index or '
+                '--journal')
+    if args.adaptive_throttle and not (args.bwlimit or args.ops_limit):
+        parser.error('--adaptive-throttle requires --bwlimit or --ops-limit')
+    if args.resume and not args.journal:
+        parser.error('--resume requires --journal')
+    if args.journal and not (args.apply or args.resume):
+        parser.error('--journal requires --apply or --resume')
+    if args.journal and args.archive:
+        parser.error('--journal needs a mirrored backup, not --archive')
+    return args
+
+def main(args, observer=None):
+    """Runs the command line parsed by parse_args(), returning exit status."""
+    index = BackupIndex(args.index) if args.index else None
+    if args.rebuild_index:
+        index.rebuild(args.backup)
+    elif args.archive and not index.built:
+        index.clear()
+    compare = COMPARE_POLICIES.get(args.compare)
+    if args.compare == 'hash':
+        compare = hash_compare(HashCache(args.hash_cache, workers=args.jobs))
+    path_filter = None
+    if args.exclude or args.exclude_regex:
+        path_filter = PathFilter(args.exclude, args.include, args.exclude_regex,
+                args.include_regex)
+    if args.store:
+        store = ChunkStore(args.backup)
+        if args.restore:
+            count = store_restore(store, args.base,
+                    None if args.restore == 'latest' else args.restore)
+            print('Restored {} entries'.format(count))
+            return 0
+        stats = store_backup(args.base, store, workers=args.jobs,
+                path_filter=path_filter)
+        print_backup_stats(stats)
+        return 1 if stats.failures else 0
+    journal = Journal(args.journal) if args.journal else None
+    throttle = None
+    if args.bwlimit or args.ops_limit:
+        throttle = Throttle(args.bwlimit, args.ops_limit,
+                args.adaptive_throttle)
+    if args.snapshot:
+        name, stats = snapshot_backup(args.base, args.backup, workers=args.jobs,
+                compare=compare, path_filter=path_filter, observer=observer,
+                copy_method=args.copy_method, throttle=throttle,
+                small_file_size=args.small_files)
+        print('Created snapshot {}'.format(name))
+        print_backup_stats(stats)
+        if any((args.keep_last, args.keep_daily, args.keep_weekly,
+                args.keep_monthly)):
+            for pruned in prune_snapshots(args.backup, args.keep_last,
+                    args.keep_daily, args.keep_weekly, args.keep_monthly):
+                print('Deleted snapshot {}'.format(pruned))
+        return 1 if stats.failures else 0
+    if args.watch:
+        try:
+            for stats in watch_backup(args.base, args.backup, args.interval,
+                    workers=args.jobs, compare=compare, path_filter=path_filter,
+                    observer=observer, throttle=throttle,
+                    delta_threshold=args.delta_threshold,
+                    copy_method=args.copy_method,
+                    small_file_size=args.small_files):
+                print_backup_stats(stats)
+        except KeyboardInterrupt:
+            pass
+        return 0
+    if args.target:
+        backups = [args.backup] + args.target
+        all_diff_sets = diff_walk_targets(args.base, backups, workers=args.jobs,
+                compare=compare, path_filter=path_filter, observer=observer)
+        for backup, diff_sets in zip(backups, all_diff_sets):
+            print('{}:'.format(backup))
+            print_diff_walk(*diff_sets)
+        if not args.apply:
+            return 0
+        all_stats = do_backup_targets(args.base, backups, all_diff_sets,
+                workers=args.jobs, path_filter=path_filter, observer=observer,
+                throttle=throttle)
+        for backup, stats in zip(backups, all_stats):
+            print('{}:'.format(backup))
+            print_backup_stats(stats)
+        return 1 if any(stats.failures for stats in all_stats) else 0
+    if args.resume:
+        run = journal.run
+        if run is None:
+            print('Nothing to resume in {}'.format(args.journal))
+            return 0
+        if run != (os.path.abspath(args.base), os.path.abspath(args.backup)):
+            print('Error: {} belongs to a backup of {} to {}'.format(
+                    args.journal, *run))
+            return 2
+        stats = backup_stream(args.base, args.backup, journal.pending(),
+                workers=args.jobs, index=index,
+                delta_threshold=args.delta_threshold,
+                copy_method=args.copy_method, path_filter=path_filter,
+                observer=observer, journal=journal, throttle=throttle,
+                small_file_size=args.small_files)
+        print_backup_stats(stats)
+        return 1 if stats.failures else 0
+    if args.apply and not args.detect_moves and journal is None:
+        #copy while the walk goes on, printing the changes once applied
+        result = DiffResult()
+        errors = []
+        events = record_diff(iter_diff(args.base, args.backup,
+                workers=args.jobs, index=index, compare=compare,
+                path_filter=path_filter, observer=observer), result, errors)
+        if args.archive:
+            archive_path = os.path.join(args.backup, archive_name(args.archive))
+            stats = archive_stream(args.base, archive_path, events,
+                    compression=args.archive, index=index,
+                    path_filter=path_filter)
+        else:
+            stats = backup_stream(args.base, args.backup, events,
+                    workers=args.jobs, index=index,
+                    delta_threshold=args.delta_threshold,
+                    copy_method=args.copy_method, path_filter=path_filter,
+                    observer=observer, throttle=throttle,
+                    small_file_size=args.small_files)
+        print_diff_warnings(result, errors)
+        print_diff_walk(result.view('add'), result.view('remove'),
+                result.view('update'))
+        print_backup_stats(stats)
+        return 1 if stats.failures else 0
+    #moves need the whole diff, and a journal records it before applying it
+    diff_sets = diff_walk(args.base, args.backup, workers=args.jobs,
+            index=index, compare=compare, path_filter=path_filter,
+            observer=observer, detect_moves=args.detect_moves)
+    print_diff_walk(*diff_sets)
+    if args.apply and args.archive:
+        archive_path = os.path.join(args.backup, archive_name(args.archive))
+        stats = archive_stream(args.base, archive_path, diff_events(*diff_sets),
+                compression=args.archive, index=index, path_filter=path_filter)
+        print_backup_stats(stats)
+        return 1 if stats.failures else 0
+    elif args.apply:
+        stats = do_backup(args.base, args.backup, *diff_sets[:3],
+                workers=args.jobs, index=index,
+                delta_threshold=args.delta_threshold,
+                copy_method=args.copy_method, path_filter=path_filter,
+                observer=observer, journal=journal, throttle=throttle,
+                move_set=diff_sets[3] if args.detect_moves else (),
+                small_file_size=args.small_files)
+        print_backup_stats(stats)
+        return 1 if stats.failures else 0
+    return 0
+
+def profiled_main(args):
+    """Runs main(), with the --stats, --profile and --trace-memory options."""
+    metrics = Metrics() if args.stats else None
+    profiler = cProfile.Profile() if args.profile else None
+    if args.trace_memory:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    start = perf_counter()
+    try:
+        return main(args, metrics)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if metrics is not None:
+            metrics.phase_done('total', perf_counter() - start)
+            write_stats(args.stats, metrics.as_dict())
+
+def write_stats(path, stats):
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+        stats['memory'] = {'current': current, 'peak': peak,
+                'top': [str(statistic) for statistic in top]}
+        tracemalloc.stop()
+    if path == '-':
+        json.dump(stats, sys.stdout, indent=1)
+        print()
+    else:
+        with open(path, 'w') as f:
+            json.dump(stats, f, indent=1)
+
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print('usage: elfi.py base_path backup_path')
-        exit(1)
-    base = sys.argv[1]
-    backup = sys.argv[2]
-    print_diff_walk(*diff_walk(base, backup))
-    exit(0)
+    exit(profiled_main(parse_args()))
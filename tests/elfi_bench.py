@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter, sleep
+from types import SimpleNamespace
+from unittest.mock import patch
+
+#import module with relative path when invoked from command line
+sys.path.insert(0, os.path.realpath(os.path.abspath(
+                    os.path.join('/'.join(sys.argv[0].split('/')[:-1]),
+                    '..' #relative path to elfi module
+                ))))
+import elfi
+sys.path.pop(0)
+
+def make_path_list(count, fanout=10, dir_ratio=0.05, seed=0):
+    """Builds a shuffled list of count relative paths like diff_walk output.
+
+    Roughly dir_ratio of the entries are directories (trailing separator)
+    and each is followed by some paths below it, so that collapsing has
+    real subtrees to remove.
+    """
+    rng = random.Random(seed)
+    paths = []
+    dirs = ['']
+    while len(paths) < count:
+        parent = rng.choice(dirs)
+        name = 'd{}'.format(len(paths))
+        if rng.random() < dir_ratio:
+            path = os.path.join(parent, name, '')
+            dirs.append(path)
+        else:
+            path = os.path.join(parent, 'f{}.txt'.format(len(paths)))
+        paths.append(path)
+        if len(dirs) > fanout * 100:
+            dirs.pop(1)
+    rng.shuffle(paths)
+    return paths
+
+def bench(name, fn, *args, repeat=3, nbytes=None):
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        fn(*args)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    if nbytes is None:
+        print('{:<40} {:>10.4f}s'.format(name, best))
+    else:
+        print('{:<40} {:>10.4f}s {:>10.1f} MB/s'.format(name, best,
+                nbytes / best / 1024 / 1024))
+    return best
+
+def bench_build_backup_path_set(sizes=(10000, 100000, 1000000)):
+    for size in sizes:
+        paths = make_path_list(size)
+        bench('build_backup_path_set[{}]'.format(size),
+                elfi.build_backup_path_set, paths)
+
+def bench_diff_result(count=1000000):
+    """Compares the memory and sorted iteration time of a set and a DiffResult.
+
+    Each path is decoded afresh, as diff_walk builds a new string per path.
+    """
+    encoded = [path.encode() for path in make_path_list(count)]
+
+    def memory(build):
+        tracemalloc.start()
+        result = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return result, size
+
+    def build_set():
+        return {path.decode() for path in encoded}
+
+    def build_result():
+        result = elfi.DiffResult()
+        for path in encoded:
+            result.add('add', path.decode())
+        return result.view('add')
+
+    for name, build, iterate in (('set', build_set, sorted),
+                                ('DiffResult', build_result, iter)):
+        paths, size = memory(build)
+        print('{:<40} {:>10.1f} MB'.format('{}[{}] memory'.format(name, count),
+                size / 1024 / 1024))
+        bench('{}[{}] sorted iteration'.format(name, count),
+                lambda: sum(1 for _ in iterate(paths)))
+
+def bench_compare_entries(sizes=(10000, 200000), changed=0.01):
+    """Times compare_entries() on one directory of each size in sizes.
+
+    The listings are built from StatEntry objects, so only the join of the
+    two listings is timed, not the file system.  A fraction changed of the
+    entries is added, removed and updated each.
+    """
+    def entries(names, mtime):
+        return {name: elfi.StatEntry(name, SimpleNamespace(st_mode=stat.S_IFREG,
+                st_size=0, st_mtime_ns=mtime)) for name in names}
+
+    rng = random.Random(0)
+    for size in sizes:
+        names = ['f{:x}'.format(rng.getrandbits(64)) for i in range(size)]
+        count = int(size * changed)
+        base = entries(names[count:], 1)
+        base.update(entries(names[count:count * 2], 2))
+        backup = entries(names[:size - count], 1)
+        bench('compare_entries[{}]'.format(size), elfi.compare_entries,
+                'base', 'backup', '', base, backup)
+
+def make_wide_tree(root, dir_count, files_per_dir, fanout=10):
+    """Creates dir_count directories holding files_per_dir empty files each."""
+    dirs = [root]
+    for i in range(dir_count):
+        parent = dirs[i // fanout]
+        path = os.path.join(parent, 'd{}'.format(i))
+        os.makedirs(path)
+        dirs.append(path)
+        for j in range(files_per_dir):
+            open(os.path.join(path, 'f{}'.format(j)), 'wb').close()
+
+def bench_diff_walk_workers(dir_count=1000, files_per_dir=100, latency=0.002,
+                            workers=(1, 4, 16, 64)):
+    """Times diff_walk of identical trees where each listing costs latency s."""
+    tmp = tempfile.mkdtemp()
+    try:
+        base = os.path.join(tmp, 'base')
+        backup = os.path.join(tmp, 'backup')
+        make_wide_tree(base, dir_count, files_per_dir)
+        shutil.copytree(base, backup)
+
+        scan_dir = elfi.scan_dir
+        def slow_scan_dir(path):
+            sleep(latency)
+            return scan_dir(path)
+
+        with patch('elfi.scan_dir', slow_scan_dir):
+            for count in workers:
+                bench('diff_walk[{}x{}, workers={}]'.format(dir_count,
+                        files_per_dir, count), elfi.diff_walk, base, backup,
+                        count, repeat=1)
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_path_filter(dir_count=200, files_per_dir=20, excluded_ratio=9,
+                        path_count=100000):
+    """Times diff_walk with and without pruning subtrees that hold most files.
+
+    Each directory holds files_per_dir files of its own and a node_modules
+    subdirectory with excluded_ratio times as many, so excluding node_modules/
+    leaves out 90% of the files by default.  The matcher alone is also timed
+    on path_count paths.
+    """
+    tmp = tempfile.mkdtemp()
+    try:
+        base = os.path.join(tmp, 'base')
+        backup = os.path.join(tmp, 'backup')
+        make_wide_tree(base, dir_count, files_per_dir)
+        for i in range(dir_count):
+            path = os.path.join(base, 'd{}'.format(i), 'node_modules')
+            os.makedirs(path, exist_ok=True)
+            for j in range(files_per_dir * excluded_ratio):
+                open(os.path.join(path, 'm{}.js'.format(j)), 'wb').close()
+        shutil.copytree(base, backup)
+
+        path_filter = elfi.PathFilter(['node_modules/', '*.pyc', '/build/'],
+                exclude_regexes=[r'\.cache/'])
+        bench('diff_walk[unfiltered]', elfi.diff_walk, base, backup)
+        bench('diff_walk[node_modules/ excluded]', elfi.diff_walk, base, backup,
+                1, None, None, path_filter)
+    finally:
+        shutil.rmtree(tmp)
+
+    paths = make_path_list(path_count)
+    bench('PathFilter.excluded[{}]'.format(path_count),
+            lambda: [path_filter.excluded(path) for path in paths])
+
+def bench_copy_methods(file_size=256 * 1024 * 1024, file_count=4,
+                       root='/dev/shm'):
+    """Times copy_file() with each copy method on large files in a tmpfs."""
+    tmp = tempfile.mkdtemp(dir=root if os.path.isdir(root) else None)
+    try:
+        srcs = []
+        for i in range(file_count):
+            src = os.path.join(tmp, 'src{}'.format(i))
+            with open(src, 'wb') as f:
+                f.write(os.urandom(file_size))
+            srcs.append(src)
+
+        def copy_all(method):
+            used = set()
+            for src in srcs:
+                used.add(elfi.copy_file(src, src + '.copy', method))
+                os.remove(src + '.copy')
+            return used
+
+        for method in elfi.COPY_METHODS:
+            try:
+                used = copy_all(method)
+            except OSError as e:
+                print('{:<40} unsupported: {}'.format(
+                        'copy_file[{}]'.format(method), e))
+                continue
+            bench('copy_file[{}: {}]'.format(method, ', '.join(sorted(used))),
+                    copy_all, method, nbytes=file_size * file_count)
+    finally:
+        shutil.rmtree(tmp)
+
+#(size in bytes, weight) pairs, roughly a source tree with some larger assets
+DEFAULT_SIZES = ((0, 10), (512, 40), (4096, 35), (65536, 15))
+SYNTHETIC_MTIME_NS = 1500000000 * 1000000000
+
+def make_synthetic_tree(root, files=10000, depth=3, fanout=10,
+                        sizes=DEFAULT_SIZES, changed=0.01, added=0.01,
+                        removed=0.01, seed=0):
+    """Creates root/base and an out of date root/backup of about files files.
+
+    The directories form a tree depth levels deep with fanout subdirectories
+    each, and files are spread across them at random with sizes drawn from
+    sizes.  The backup starts as an identical copy, then the given fractions
+    of files are changed (replaced with a later mtime), added to or removed
+    from base.  To halve the writes, backup files start out as hard links to
+    the base files; changes replace the base file rather than rewrite it.  The
+    same seed always builds the same trees.  Returns the counts of each kind
+    of change.
+    """
+    rng = random.Random(seed)
+    base = os.path.join(root, 'base')
+    backup = os.path.join(root, 'backup')
+    dirs = ['']
+    level = ['']
+    for _ in range(depth):
+        level = [os.path.join(parent, 'd{}'.format(i)) for parent in level
+                for i in range(fanout)]
+        dirs.extend(level)
+    for rel_dir in dirs:
+        os.makedirs(os.path.join(base, rel_dir))
+        os.makedirs(os.path.join(backup, rel_dir))
+
+    size_choices = [size for size, weight in sizes]
+    size_weights = [weight for size, weight in sizes]
+    data = rng.getrandbits(8 * max(size_choices) * 2).to_bytes(
+            max(size_choices) * 2, 'little') if max(size_choices) else b''
+
+    def write(path, size, mtime_ns):
+        offset = rng.randrange(len(data) - size + 1) if data else 0
+        with open(path, 'wb') as f:
+            f.write(data[offset:offset + size])
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    relpaths = []
+    for i in range(files):
+        relpath = os.path.join(rng.choice(dirs), 'f{}'.format(i))
+        size = rng.choices(size_choices, size_weights)[0]
+        write(os.path.join(base, relpath), size, SYNTHETIC_MTIME_NS)
+        os.link(os.path.join(base, relpath), os.path.join(backup, relpath))
+        relpaths.append(relpath)
+
+    counts = {'changed': int(files * changed), 'added': int(files * added),
+                'removed': int(files * removed)}
+    rng.shuffle(relpaths)
+    later_ns = SYNTHETIC_MTIME_NS + 10 * 1000000000
+    for relpath in relpaths[:counts['changed']]:
+        os.remove(os.path.join(base, relpath))
+        write(os.path.join(base, relpath),
+                rng.choices(size_choices, size_weights)[0], later_ns)
+    removed_end = counts['changed'] + counts['removed']
+    for relpath in relpaths[counts['changed']:removed_end]:
+        os.remove(os.path.join(base, relpath))
+    for i in range(counts['added']):
+        relpath = os.path.join(rng.choice(dirs), 'new{}'.format(i))
+        write(os.path.join(base, relpath),
+                rng.choices(size_choices, size_weights)[0], later_ns)
+    return counts
+
+def timed(phases, name, fn, *args, **kwargs):
+    start = perf_counter()
+    result = fn(*args, **kwargs)
+    phases[name] = perf_counter() - start
+    return result
+
+def bench_scale(files=100000, depth=3, fanout=10, changed=0.01, added=0.01,
+                removed=0.01, workers=1, seed=0, root=None):
+    """Times each phase of a backup of a synthetic tree, returning a dict.
+
+    The phases are building the tree, diff_walk, build_backup_path_set on
+    every path found, do_backup and a final diff_walk of the synced trees.
+    """
+    params = {'files': files, 'depth': depth, 'fanout': fanout,
+                'changed': changed, 'added': added, 'removed': removed,
+                'workers': workers, 'seed': seed}
+    phases = {}
+    tmp = tempfile.mkdtemp(dir=root)
+    try:
+        base = os.path.join(tmp, 'base')
+        backup = os.path.join(tmp, 'backup')
+        expected = timed(phases, 'generate', make_synthetic_tree, tmp, files,
+                depth, fanout, changed=changed, added=added, removed=removed,
+                seed=seed)
+        add_set, remove_set, update_set = timed(phases, 'diff_walk',
+                elfi.diff_walk, base, backup, workers)
+        timed(phases, 'build_backup_path_set', elfi.build_backup_path_set,
+                list(add_set | remove_set | update_set))
+        stats = timed(phases, 'do_backup', elfi.do_backup, base, backup,
+                add_set, remove_set, update_set, workers)
+        remaining = timed(phases, 'diff_walk_synced', elfi.diff_walk, base,
+                backup, workers)
+    finally:
+        shutil.rmtree(tmp)
+
+    return {'params': params, 'phases': phases, 'expected': expected,
+            'found': {'added': len(add_set), 'removed': len(remove_set),
+                        'updated': len(update_set)},
+            'backup': {'copied': stats.copied, 'removed': stats.removed,
+                        'bytes': stats.bytes, 'failures': len(stats.failures)},
+            'remaining': sum(len(diff_set) for diff_set in remaining)}
+
+#sub-4KB files, as in source checkouts and maildirs
+SMALL_SIZES = ((0, 5), (512, 45), (2048, 30), (4000, 20))
+
+def bench_small_files(files=500000, depth=3, fanout=10, workers=1,
+                        small_file_size=4096, seed=0, root=None):
+    """Times a full backup of a tree of small files, returning a result dict.
+
+    The backup is made with shutil.copy2, with copy_file() and with the
+    small file batches of backup_stream(), each into an empty backup, and
+    reported in files/s.
+    """
+    params = {'files': files, 'depth': depth, 'fanout': fanout,
+                'workers': workers, 'small_file_size': small_file_size,
+                'seed': seed}
+    modes = (('copy2', {}), ('copy_file', {'copy_method': 'auto'}),
+            ('batched', {'copy_method': 'auto',
+                         'small_file_size': small_file_size}))
+    results = {}
+    tmp = tempfile.mkdtemp(dir=root)
+    try:
+        base = os.path.join(tmp, 'base')
+        backup = os.path.join(tmp, 'backup')
+        make_synthetic_tree(tmp, files, depth, fanout, SMALL_SIZES, changed=0,
+                added=0, removed=0, seed=seed)
+        for name, kwargs in modes:
+            shutil.rmtree(backup)
+            os.mkdir(backup)
+            diff_sets = elfi.diff_walk(base, backup, workers)
+            start = perf_counter()
+            stats = elfi.do_backup(base, backup, *diff_sets, workers, **kwargs)
+            elapsed = perf_counter() - start
+            results[name] = {'seconds': elapsed,
+                    'files_per_sec': files / elapsed,
+                    'failures': len(stats.failures)}
+            print('{:<40} {:>10.4f}s {:>10.0f} files/s'.format(
+                    'do_backup[{} files, {}]'.format(files, name), elapsed,
+                    files / elapsed), file=sys.stderr)
+    finally:
+        shutil.rmtree(tmp)
+    return {'params': params, 'modes': results}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark elfi.')
+    parser.add_argument('suite', nargs='?', choices=('micro', 'scale', 'small'),
+            default='micro',
+            help='micro benchmarks of single functions, per-phase timings of a '
+                'backup of a synthetic tree, or files/s of a full backup of a '
+                'tree of small files (default: micro)')
+    parser.add_argument('--files', type=int, action='append',
+            help='files in the synthetic tree, may be repeated (default: '
+                '100000, or 500000 for small)')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=10)
+    parser.add_argument('--changed', type=float, default=0.01,
+            help='fraction of files changed in base')
+    parser.add_argument('--added', type=float, default=0.01,
+            help='fraction of files added to base')
+    parser.add_argument('--removed', type=float, default=0.01,
+            help='fraction of files removed from base')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--root', help='directory to build the trees in')
+    parser.add_argument('--json', metavar='FILE',
+            help='write the results as JSON to FILE instead of stdout')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.suite == 'micro':
+        bench_build_backup_path_set()
+        bench_diff_result()
+        bench_compare_entries()
+        bench_diff_walk_workers()
+        bench_path_filter()
+        bench_copy_methods()
+    else:
+        if args.suite == 'scale':
+            results = [bench_scale(files, args.depth, args.fanout, args.changed,
+                    args.added, args.removed, args.jobs, args.seed, args.root)
+                    for files in args.files or [100000]]
+        else:
+            results = [bench_small_files(files, args.depth, args.fanout,
+                    args.jobs, seed=args.seed, root=args.root)
+                    for files in args.files or [500000]]
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=1)
+        else:
+            json.dump(results, sys.stdout, indent=1)
+            print()
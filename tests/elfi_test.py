@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
+import errno
 import os
 import shutil
+import stat
 import sys
 from testfixtures import tempdir
 import unittest
 from unittest.mock import patch
-from time import time
+from time import sleep, time
+from types import SimpleNamespace
 
 #import module with relative path when invoked from command line
 sys.path.insert(0, os.path.realpath(os.path.abspath(
@@ -19,7 +22,8 @@ sys.path.insert(0, os.path.realpath(os.path.abspath(
                     os.path.join('/'.join(sys.argv[0].split('/')[:-1]),
                     '.' #relative path to maketree module
                 ))))
-from maketree import make_dir_tree, build_path_set_dirtree
+from maketree import (make_dir_tree, build_path_set_dirtree,
+        build_path_set_walk, dir_tree_matches)
 sys.path.pop(0)
 
 class TestElfi(unittest.TestCase):
@@ -285,6 +289,326 @@ class TestElfi(unittest.TestCase):
         self.assertRmCallsEqual(d, rm, rel_path_set)
         self.assertNotCalled(cp, 'cp', 'Should only remove from backup.')
 
+    @tempdir()
+    def test_TypeChanged(self, d):
+        dirtree =    ('foo.txt', ('hello', ('test.py',)), 'world')
+        base_tree =  ('foo.txt', 'hello', ('world', ('test.c',)))
+
+        self.initTempDir(d, dirtree)
+        shutil.rmtree(d.getpath(self.base))
+        make_dir_tree(d, base_tree, relpath=self.base)
+
+        abs_base = d.getpath(self.base)
+        abs_backup = d.getpath(self.backup)
+
+        diff_sets = elfi.diff_walk(abs_base, abs_backup)
+        self.assertEqual(diff_sets[0], {'hello', 'world/'},
+                        'New types should be added.')
+        self.assertEqual(diff_sets[1], {'hello/', 'world'},
+                        'Old types should be removed.')
+
+        elfi.do_backup(abs_base, abs_backup, *diff_sets)
+
+        self.assertTrue(dir_tree_matches(abs_backup, base_tree))
+
+    @tempdir()
+    def test_ParallelWalk(self, d):
+        dirtree =    ('foo.txt', 'blah.txt',
+                        ('hello', (
+                            'test.py', 'test.c',
+                            ('world', ('foo', 'banana')),
+                            ('sub', ('bar',)),
+                        )),
+                        ('alpha', (('beta', ('gamma',)),)),
+                    )
+        self.initTempDir(d, dirtree)
+        self.touchTree(d, ('blah.txt',
+                            ('hello', ('new.txt', ('world', ('foo',))))),
+                        relpath=self.base)
+        os.remove(d.getpath(os.path.join(self.base, 'alpha', 'beta', 'gamma')))
+        shutil.rmtree(d.getpath(os.path.join(self.base, 'hello', 'sub')))
+
+        abs_base = d.getpath(self.base)
+        abs_backup = d.getpath(self.backup)
+
+        serial_sets = elfi.diff_walk(abs_base, abs_backup)
+        for workers in (2, 8):
+            parallel_sets = elfi.diff_walk(abs_base, abs_backup,
+                    workers=workers)
+            self.assertEqual(parallel_sets, serial_sets)
+        self.assertEqual(serial_sets, ({'hello/new.txt'},
+                                        {'alpha/beta/gamma', 'hello/sub/'},
+                                        {'blah.txt', 'hello/world/foo'}))
+
+    @tempdir()
+    def test_BoundedWalk(self, d):
+        for i in range(50):
+            d.makedir('base/dir{}'.format(i))
+            d.makedir('backup/dir{}'.format(i))
+
+        calls = []
+        diff_dir = elfi.diff_dir
+        def counting_diff_dir(*args):
+            calls.append(args[2])
+            return diff_dir(*args)
+
+        with patch('elfi.diff_dir', side_effect=counting_diff_dir):
+            walk = elfi.walk_dir_diffs(d.getpath(self.base),
+                    d.getpath(self.backup), workers=2)
+            self.assertEqual(next(walk)[0], '')
+            next(walk)
+            sleep(0.2)
+            self.assertEqual(len(calls), 1 + 2 * 4,
+                            'Walk ran ahead of its consumer.')
+            self.assertEqual(len(list(walk)), 49)
+
+    @tempdir()
+    def test_ApplyStreams(self, d):
+        for i in range(10):
+            d.write('base/dir{}/f.txt'.format(i), b'data')
+            d.makedir('backup/dir{}'.format(i))
+        abs_base = d.getpath(self.base)
+        abs_backup = d.getpath(self.backup)
+
+        calls = []
+        diff_dir = elfi.diff_dir
+        def slow_diff_dir(*args):
+            sleep(0.02)
+            calls.append(('diff', args[2]))
+            return diff_dir(*args)
+
+        copy_to_backup = elfi.copy_to_backup
+        def recording_copy(base, backup, relpath, **kwargs):
+            calls.append(('copy', relpath))
+            return copy_to_backup(base, backup, relpath, **kwargs)
+
+        with patch('elfi.diff_dir', side_effect=slow_diff_dir), \
+                patch('elfi.copy_to_backup', side_effect=recording_copy), \
+                patch('elfi.diff_walk', side_effect=AssertionError), \
+                patch('builtins.print') as mock_print:
+            status = elfi.main(elfi.parse_args(
+                    [abs_base, abs_backup, '--apply']))
+        self.assertEqual(status, 0)
+        self.assertEqual(build_path_set_walk(abs_backup),
+                        build_path_set_walk(abs_base))
+        self.assertLess(calls.index(('copy', 'dir0/f.txt')),
+                        calls.index(('diff', 'dir9/')),
+                        'Copying should start before the walk ends.')
+        self.assertIn(unittest.mock.call('    dir9/f.txt'),
+                        mock_print.call_args_list)
+
+    @tempdir()
+    def test_ParallelBackup(self, d):
+        dirtree =    ('foo.txt', 'blah.txt', 'a.txt',
+                        ('hello', ('test.py', ('world', ('foo', 'banana')))),
+                        'alpha'
+                    )
+        d.makedir(self.backup)
+        make_dir_tree(d, dirtree, relpath=self.base)
+        d.write(os.path.join(self.base, 'a.txt'), b'hello world')
+        d.write(os.path.join(self.backup, 'stale.txt'), b'')
+
+        abs_base = d.getpath(self.base)
+        abs_backup = d.getpath(self.backup)
+
+        copy2 = shutil.copy2
+        def failing_copy2(src, dst, **kwargs):
+            if os.path.basename(src) == 'blah.txt':
+                raise PermissionError('denied')
+            return copy2(src, dst, **kwargs)
+
+        diff_sets = elfi.diff_walk(abs_base, abs_backup)
+        with patch('elfi.shutil.copy2', side_effect=failing_copy2):
+            stats = elfi.do_backup(abs_base, abs_backup, *diff_sets, workers=4)
+
+        self.assertEqual([item for item, error in stats.failures], ['blah.txt'])
+        self.assertEqual(stats.copied, len(diff_sets[0]) - 1)
+        self.assertEqual(stats.removed, 1)
+        self.assertEqual(stats.bytes, len(b'hello world'))
+        self.assertEqual(build_path_set_walk(abs_backup),
+                        build_path_set_dirtree(dirtree) - {'blah.txt'})
+
+    @tempdir()
+    def test_StreamingBackup(self, d):
+        dirtree = tuple('file{}.txt'.format(i) for i in range(10)) + (
+                    ('hello', ('test.py', ('world', ('foo',)))),)
+        d.makedir(self.backup)
+        make_dir_tree(d, dirtree, relpath=self.base)
+        d.write(os.path.join(self.backup, 'hello'), b'')
+
+        abs_base = d.getpath(self.base)
+        abs_backup = d.getpath(self.backup)
+
+        events = list(elfi.iter_diff(abs_base, abs_backup))
+        self.assertLess(events.index(('remove', 'hello')),
+                        events.index(('add', 'hello/')),
+                        'Type changes should be removed before being added.')
+
+        copied_while_scanning = []
+        def stream():
+            for event in elfi.iter_diff(abs_base, abs_backup):
+                yield event
+            copied_while_scanning.extend(os.listdir(abs_backup))
+
+        stats = elfi.backup_stream(abs_base, abs_backup, stream(), workers=1)
+
+        self.assertEqual(stats.failures, [])
+        self.assertEqual(stats.copied, 11)
+        self.assertTrue(copied_while_scanning,
+                        'Copies should overlap the scan.')
+        self.assertTrue(dir_tree_matches(abs_backup, dirtree))
+
+    @tempdir()
+    def test_SymlinksFollowed(self, d):
+        d.write('base/target/a.txt', b'a')
+        d.write('base/file.txt', b'file')
+        d.makedir('backup')
+        os.symlink('target', d.getpath('base/dirlink'))
+        os.symlink('file.txt', d.getpath('base/filelink'))
+
+        abs_base = d.getpath(self.base)
+        abs_backup = d.getpath(self.backup)
+
+        diff_sets = elfi.diff_walk(abs_base, abs_backup)
+        self.assertEqual(diff_sets[0],
+                        {'target/', 'file.txt', 'dirlink/', 'filelink'})
+        elfi.do_backup(abs_base, abs_backup, *diff_sets)
+        self.assertEqual(elfi.diff_walk(abs_base, abs_backup),
+                        (set(), set(), set()),
+                        'Symlinks should converge after one backup.')
+
+        os.symlink('..', d.getpath('base/target/loop'))
+        events = list(elfi.iter_diff(abs_base, abs_backup))
+        self.assertEqual(sorted((action, item[0]) for action, item in events),
+                        [('error', 'dirlink/loop/'), ('error', 'target/loop/')])
+
+    @tempdir()
+    def test_MutualSymlinks(self, d):
+        d.write('base/A/f', b'f')
+        d.write('base/B/g', b'g')
+        os.symlink(os.path.join('..', 'B'), d.getpath('base/A/to_b'))
+        os.symlink(os.path.join('..', 'A'), d.getpath('base/B/to_a'))
+        abs_base = d.getpath(self.base)
+
+        for kwargs in ({}, {'small_file_size': 100}):
+            abs_backup = d.getpath('backup{}'.format(len(kwargs)))
+            diff_sets = elfi.diff_walk(abs_base, abs_backup)
+            self.assertEqual(diff_sets[0], {'A/', 'B/'})
+            with patch('builtins.print'):
+                stats = elfi.do_backup(abs_base, abs_backup, *diff_sets,
+                        **kwargs)
+            self.assertEqual(build_path_set_walk(abs_backup),
+                            {'A/', 'A/f', 'A/to_b/', 'A/to_b/g', 'B/', 'B/g',
+                            'B/to_a/', 'B/to_a/f'}, kwargs)
+
+            events = list(elfi.iter_diff(abs_base, abs_backup))
+            self.assertEqual(
+                    sorted((action, item[0]) for action, item in events),
+                    [('error', 'A/to_b/to_a/'), ('error', 'B/to_a/to_b/')])
+
+    @tempdir()
+    def test_UnreadableDirectory(self, d):
+        d.write('base/ok/f', b'')
+        d.write('base/locked/g', b'')
+        d.makedir('backup/ok')
+        d.makedir('backup/locked')
+
+        abs_base = d.getpath(self.base)
+        abs_backup = d.getpath(self.backup)
+        locked = os.path.join(d.getpath('base/locked'), '')
+
+        scan_dir = elfi.scan_dir
+        def locked_scan_dir(path):
+            if os.path.join(path, '') == locked:
+                raise PermissionError(elfi.errno.EACCES, 'Permission denied',
+                        path)
+            return scan_dir(path)
+
+        with patch('elfi.scan_dir', side_effect=locked_scan_dir):
+            self.assertEqual(elfi.diff_walk(abs_base, abs_backup)[0], {'ok/f'})
+            stats = elfi.backup_stream(abs_base, abs_backup,
+                    elfi.iter_diff(abs_base, abs_backup))
+
+        self.assertEqual(stats.copied, 1)
+        self.assertEqual([item for item, error in stats.failures], ['locked/'])
+
+    @tempdir()
+    def test_MovesDetected(self, d):
+        dirtree =    ('foo.txt', 'blah.txt',
+                        ('hello', ('test.py', ('world', ('foo', 'banana')))),
+                        ('alpha', ('beta',)),
+                    )
+        self.initTempDir(d, dirtree)
+        d.write('base/foo.txt', b'foo')
+        d.write('backup/foo.txt', b'foo')
+        shutil.copystat(d.getpath('base/blah.txt'), d.getpath('base/foo.txt'))
+        shutil.copystat(d.getpath('base/blah.txt'), d.getpath('backup/foo.txt'))
+        os.rename(d.getpath('base/hello'), d.getpath('base/alpha/hello'))
+        os.rename(d.getpath('base/foo.txt'), d.getpath('base/alpha/bar.txt'))
+        #same immediate entries, but a changed file deeper down
+        shutil.copytree(d.getpath('base/alpha/hello'), d.getpath('base/copy'))
+        d.write('base/copy/world/foo', b'changed')
+        shutil.copystat(d.getpath('base/alpha/hello/world'),
+                        d.getpath('base/copy/world'))
+
+        abs_base = d.getpath(self.base)
+        abs_backup = d.getpath(self.backup)
+        add_set, remove_set, update_set, move_set = elfi.diff_walk(abs_base,
+                abs_backup, detect_moves=True)
+        self.assertEqual(move_set, {('hello/', 'alpha/hello/'),
+                                    ('foo.txt', 'alpha/bar.txt')})
+        self.assertEqual(add_set, {'copy/'})
+        self.assertEqual(remove_set, set())
+        self.assertEqual(elfi.diff_walk(abs_base, abs_backup)[0],
+                        {'copy/', 'alpha/hello/', 'alpha/bar.txt'},
+                        'Moves should only be detected on request.')
+
+        with patch('elfi.copy_to_backup', wraps=elfi.copy_to_backup) as cp:
+            stats = elfi.do_backup(abs_base, abs_backup, add_set, remove_set,
+                    update_set, move_set=move_set)
+        self.assertEqual(stats.failures, [])
+        self.assertEqual((stats.moved, stats.copied), (2, 1))
+        self.assertEqual([call[0][2] for call in cp.call_args_list], ['copy/'])
+        self.assertEqual(elfi.diff_walk(abs_base, abs_backup),
+                        (set(), set(), set()))
+
+    @tempdir()
+    def test_MoveFallback(self, d):
+        d.write('base/new.txt', b'data')
+        d.write('backup/old.txt', b'data')
+        shutil.copystat(d.getpath('base/new.txt'), d.getpath('backup/old.txt'))
+        abs_base = d.getpath(self.base)
+        abs_backup = d.getpath(self.backup)
+        journal = elfi.Journal(d.getpath('journal.db'))
+
+        diff_sets = elfi.diff_walk(abs_base, abs_backup, detect_moves=True)
+        self.assertEqual(diff_sets[3], {('old.txt', 'new.txt')})
+        journal.start(abs_base, abs_backup, elfi.diff_events(*diff_sets))
+        self.assertEqual(list(journal.pending()),
+                        [('move', ('old.txt', 'new.txt'))])
+
+        with patch('elfi.os.rename',
+                side_effect=OSError(elfi.errno.EXDEV, 'cross')):
+            stats = elfi.backup_stream(abs_base, abs_backup, journal.pending(),
+                    journal=journal)
+        self.assertEqual((stats.moved, stats.removed, stats.copied), (0, 1, 1))
+        self.assertEqual(os.listdir(abs_backup), ['new.txt'])
+
+    @tempdir()
+    def test_SameSizeAndMtimeNotMoved(self, d):
+        d.write('base/new.txt', b'new!')
+        d.write('backup/old.txt', b'old!')
+        #e.g. extracted from a tar archive, with whole second mtimes
+        for path in ('base/new.txt', 'backup/old.txt'):
+            os.utime(d.getpath(path), (1500000000, 1500000000))
+        abs_base = d.getpath(self.base)
+        abs_backup = d.getpath(self.backup)
+
+        add_set, remove_set, update_set, move_set = elfi.diff_walk(abs_base,
+                abs_backup, detect_moves=True)
+        self.assertEqual(move_set, set())
+        self.assertEqual((add_set, remove_set), ({'new.txt'}, {'old.txt'}))
+
     @patch('elfi.remove_from_backup', autospec=True)
     @patch('elfi.copy_to_backup', autospec=True)
     @tempdir()
@@ -359,6 +683,1261 @@ class TestElfi(unittest.TestCase):
             self.assertIn(args, target_list, reason)
 
 
+class TestBackupIndex(unittest.TestCase):
+    def setUp(self):
+        self.base = 'base'
+        self.backup = 'backup'
+        self.dirtree =    ('foo.txt', 'blah.txt',
+                            ('hello', (
+                                'test.py', 'test.c',
+                                ('world', ('foo', 'banana')),
+                            )),
+                            ('alpha', (('beta', ('gamma',)),)),
+                        )
+
+    def syncWithIndex(self, d, index):
+        abs_base = d.getpath(self.base)
+        abs_backup = d.getpath(self.backup)
+        diff_sets = elfi.diff_walk(abs_base, abs_backup, index=index)
+        stats = elfi.do_backup(abs_base, abs_backup, *diff_sets, index=index)
+        self.assertEqual(stats.failures, [])
+        return diff_sets
+
+    def scannedPaths(self, fn, *args, **kwargs):
+        scanned = []
+        scan_dir = elfi.scan_dir
+        def recording_scan_dir(path):
+            scanned.append(path)
+            return scan_dir(path)
+        with patch('elfi.scan_dir', side_effect=recording_scan_dir):
+            result = fn(*args, **kwargs)
+        return result, scanned
+
+    @tempdir()
+    def test_IndexMatchesListing(self, d):
+        make_dir_tree(d, self.dirtree, relpath=self.base)
+        index = elfi.BackupIndex(d.getpath('index.db'))
+        self.syncWithIndex(d, index)
+        self.assertTrue(dir_tree_matches(d.getpath(self.backup), self.dirtree))
+
+        later = int(round((time() + 10) * 1000000000))
+        os.utime(d.getpath('base/hello/test.c'), ns=(later, later))
+        d.write('base/hello/world/new.txt', b'')
+        shutil.rmtree(d.getpath('base/alpha/beta'))
+
+        abs_base = d.getpath(self.base)
+        abs_backup = d.getpath(self.backup)
+        expected = elfi.diff_walk(abs_base, abs_backup)
+        diff_sets, scanned = self.scannedPaths(elfi.diff_walk, abs_base,
+                abs_backup, index=index)
+        self.assertEqual(diff_sets, expected)
+        self.assertEqual(diff_sets, ({'hello/world/new.txt'}, {'alpha/beta/'},
+                                        {'hello/test.c'}))
+        for path in scanned:
+            self.assertFalse(path.startswith(abs_backup), 'Backup was listed.')
+
+    @tempdir()
+    def test_UnchangedDirsNotListed(self, d):
+        make_dir_tree(d, self.dirtree, relpath=self.base)
+        index = elfi.BackupIndex(d.getpath('index.db'))
+        self.syncWithIndex(d, index)
+        #directories copied whole are listed once before their mtime is known
+        self.syncWithIndex(d, index)
+
+        diff_sets, scanned = self.scannedPaths(self.syncWithIndex, d, index)
+        self.assertEqual(diff_sets, (set(), set(), set()))
+        self.assertEqual(scanned, [])
+
+    @tempdir()
+    def test_RebuildIndex(self, d):
+        make_dir_tree(d, self.dirtree, relpath=self.base)
+        make_dir_tree(d, self.dirtree, relpath=self.backup)
+        d.write('backup/hello/stale.txt', b'')
+        index = elfi.BackupIndex(d.getpath('index.db'))
+        index.rebuild(d.getpath(self.backup))
+        index.close()
+
+        index = elfi.BackupIndex(d.getpath('index.db'))
+        self.assertTrue(index.built)
+        diff_sets = self.syncWithIndex(d, index)
+        self.assertEqual(diff_sets, (set(), {'hello/stale.txt'}, set()))
+        self.assertEqual(index.scan_dir('hello/').keys(),
+                        {'test.py', 'test.c', 'world'})
+
+
+class TestHashCompare(unittest.TestCase):
+    @tempdir()
+    def test_HashCompare(self, d):
+        mtime = int(round((time() - 10) * 1000000000))
+        for path, content in (('base/same.txt', b'same'),
+                                ('backup/same.txt', b'same'),
+                                ('base/changed.txt', b'new!'),
+                                ('backup/changed.txt', b'old!'),
+                                ('base/touched.txt', b'same'),
+                                ('backup/touched.txt', b'same'),
+                                ('base/resized.txt', b'longer'),
+                                ('backup/resized.txt', b'short')):
+            d.write(path, content)
+            os.utime(d.getpath(path), ns=(mtime, mtime))
+        later = mtime + 5000000000
+        os.utime(d.getpath('base/touched.txt'), ns=(later, later))
+
+        abs_base = d.getpath('base')
+        abs_backup = d.getpath('backup')
+        cache = elfi.HashCache()
+        compare = elfi.hash_compare(cache)
+
+        self.assertEqual(elfi.diff_walk(abs_base, abs_backup)[2],
+                        {'touched.txt'})
+        self.assertEqual(
+                elfi.diff_walk(abs_base, abs_backup, compare=compare)[2],
+                {'changed.txt', 'resized.txt'})
+
+        hash_file = elfi.hash_file
+        with patch('elfi.hash_file', side_effect=hash_file) as hash_mock:
+            elfi.diff_walk(abs_base, abs_backup, compare=compare)
+        self.assertFalse(hash_mock.called,
+                        'Unchanged files should not be rehashed.')
+        cache.close()
+
+    def test_HashCompareArgs(self):
+        with patch('sys.stderr'):
+            for argv in (['--compare=hash', 'base', 'backup'],
+                            ['-j', '0', 'base', 'backup']):
+                with self.assertRaises(SystemExit):
+                    elfi.parse_args(argv)
+        args = elfi.parse_args(['--compare=hash', '--hash-cache', 'h.db',
+                                'base', 'backup'])
+        self.assertEqual((args.compare, args.hash_cache, args.jobs),
+                        ('hash', 'h.db', 1))
+
+    @tempdir()
+    def test_ChunkedHash(self, d):
+        content = bytes(range(256)) * 41
+        d.write('big', content)
+        path = d.getpath('big')
+        whole = elfi.hash_file(path, len(content))
+        with patch('elfi.HASH_CHUNK_SIZE', 1000):
+            serial = elfi.hash_file(path, len(content))
+            with elfi.ThreadPoolExecutor(max_workers=4) as executor:
+                parallel = elfi.hash_file(path, len(content), executor)
+        self.assertEqual(serial, parallel)
+        self.assertNotEqual(serial, whole)
+
+
+class TestDeltaCopy(unittest.TestCase):
+    @tempdir()
+    def test_DeltaCopy(self, d):
+        old = b''.join(bytes([i]) * 100 for i in range(10))
+        new = bytearray(old)
+        new[250:260] = b'x' * 10
+        new[720:730] = b'y' * 10
+        d.write('src', bytes(new) + b'tail')
+        d.write('dst', old)
+
+        written = elfi.delta_copy(d.getpath('src'), d.getpath('dst'), 100)
+        self.assertEqual(written, 204,
+                        'Only changed and appended blocks should be written.')
+        self.assertEqual(d.read('dst'), bytes(new) + b'tail')
+        self.assertEqual(os.stat(d.getpath('dst')).st_mtime_ns,
+                        os.stat(d.getpath('src')).st_mtime_ns)
+
+        d.write('src', b'short')
+        elfi.delta_copy(d.getpath('src'), d.getpath('dst'), 100)
+        self.assertEqual(d.read('dst'), b'short')
+
+    @tempdir()
+    def test_DeltaThreshold(self, d):
+        d.write('base/big', b'b' * 64)
+        d.write('base/small', b's' * 8)
+        d.write('backup/big', b'a' * 64)
+        d.write('backup/small', b'a' * 8)
+
+        with patch('elfi.delta_copy', autospec=True, return_value=0) as delta:
+            stats = elfi.do_backup(d.getpath('base'), d.getpath('backup'),
+                    set(), set(), {'big', 'small'}, delta_threshold=32)
+        delta.assert_called_once_with(d.getpath('base/big'),
+                                      d.getpath('backup/big'))
+        self.assertEqual(d.read('backup/small'), b's' * 8)
+        self.assertEqual(stats.copied, 2)
+
+    def test_ParseSize(self):
+        self.assertEqual(elfi.parse_size('4096'), 4096)
+        self.assertEqual(elfi.parse_size('64k'), 64 * 1024)
+        self.assertEqual(elfi.parse_size('1.5G'), 3 * 1024 ** 3 // 2)
+
+
+class TestSortedDiff(unittest.TestCase):
+    def makeTrees(self, d):
+        old = 1500000000 * 1000000000
+        for relpath in ('a/one', 'a/b/two', 'a-b', 'c/d/e/three', 'c/four',
+                'x-1/five', 'z.txt'):
+            d.write('base/' + relpath, b'data')
+            d.write('backup/' + relpath, b'data')
+            os.utime(d.getpath('backup/' + relpath), ns=(old, old))
+        for relpath in ('a/b/new', 'a.txt', 'c/d/added/six', 'x', 'y/seven'):
+            d.write('base/' + relpath, b'data')
+        for relpath in ('a/gone', 'c/d/e/old/eight', 'x/nine', 'y', 'zz'):
+            d.write('backup/' + relpath, b'data')
+        return d.getpath('base'), d.getpath('backup')
+
+    @tempdir()
+    def test_SortedStream(self, d):
+        abs_base, abs_backup = self.makeTrees(d)
+        events = list(elfi.iter_diff(abs_base, abs_backup))
+        for action in ('add', 'remove', 'update'):
+            paths = [item for event, item in events if event == action]
+            self.assertEqual(paths, sorted(paths), action)
+        self.assertEqual([item for event, item in events if event == 'add'],
+                ['a.txt', 'a/b/new', 'c/d/added/', 'x', 'y/'])
+        self.assertEqual([item for event, item in events if event == 'remove'],
+                ['a/gone', 'c/d/e/old/', 'x/', 'y', 'zz'])
+        self.assertEqual(list(elfi.iter_diff(abs_base, abs_backup, workers=4)),
+                        events, 'Order should not depend on the workers.')
+
+    @tempdir()
+    def test_TypeChange(self, d):
+        abs_base, abs_backup = self.makeTrees(d)
+        events = list(elfi.iter_diff(abs_base, abs_backup))
+        #x-1/ sorts between x and x/, but x/ must still be removed first
+        self.assertLess(events.index(('remove', 'x/')),
+                        events.index(('add', 'x')))
+        self.assertLess(events.index(('remove', 'y')),
+                        events.index(('add', 'y/')))
+
+        stats = elfi.backup_stream(abs_base, abs_backup, iter(events))
+        self.assertEqual(stats.failures, [])
+        self.assertEqual(build_path_set_walk(abs_backup),
+                        build_path_set_walk(abs_base))
+
+    def test_MergeJoin(self):
+        def entries(names, mtime):
+            return {name: elfi.StatEntry(name, SimpleNamespace(
+                    st_mode=stat.S_IFREG, st_size=0, st_mtime_ns=mtime))
+                    for name in names}
+
+        base = entries(['f{}'.format(i) for i in range(0, 20000, 2)], 2)
+        backup = entries(['f{}'.format(i) for i in range(0, 20000, 3)], 1)
+        (add_list, remove_list, update_list, newer_list, errors,
+                subdirs), stat_calls = elfi.compare_entries('base', 'backup',
+                'dir/', base, backup)
+        self.assertEqual(add_list, sorted('dir/' + name
+                for name in base.keys() - backup.keys()))
+        self.assertEqual(remove_list, sorted('dir/' + name
+                for name in backup.keys() - base.keys()))
+        self.assertEqual(update_list, sorted('dir/' + name
+                for name in base.keys() & backup.keys()))
+        self.assertEqual((newer_list, errors, subdirs, stat_calls),
+                        ([], [], [], 0))
+
+    @tempdir()
+    def test_PrintDiffWalk(self, d):
+        abs_base, abs_backup = self.makeTrees(d)
+        diff_sets = elfi.diff_walk(abs_base, abs_backup)
+        with patch('builtins.print') as mock_print:
+            elfi.print_diff_walk(*diff_sets)
+        lines = [call[0][0] for call in mock_print.call_args_list]
+        added = lines[1:lines.index('To be removed from backup:')]
+        self.assertEqual(added,
+                        ['    ' + item for item in sorted(diff_sets[0])])
+
+class TestComparePolicies(unittest.TestCase):
+    def makeCopy(self, d, relpath='f.txt', data=b'data'):
+        d.write('base/' + relpath, data)
+        os.makedirs(d.getpath('backup'), exist_ok=True)
+        shutil.copy2(d.getpath('base/' + relpath),
+                     d.getpath('backup/' + relpath))
+        return d.getpath('base/' + relpath), d.getpath('backup/' + relpath)
+
+    def compare(self, policy, base_path, backup_path):
+        return elfi.COMPARE_POLICIES[policy](base_path, backup_path,
+                os.stat(base_path), os.stat(backup_path))
+
+    @tempdir()
+    def test_SubSecondMtime(self, d):
+        base_path, backup_path = self.makeCopy(d)
+        second = 1500000000 * 1000000000
+        os.utime(backup_path, ns=(second, second + 1000))
+        os.utime(base_path, ns=(second, second + 2000))
+        self.assertEqual(self.compare('mtime', base_path, backup_path),
+                        'update')
+        self.assertEqual(self.compare('mtime', backup_path, base_path), 'newer')
+        self.assertIsNone(self.compare('mtime_s', base_path, backup_path))
+        self.assertTrue(elfi.newer(base_path, backup_path))
+        self.assertEqual(elfi.diff_walk(d.getpath('base'), d.getpath('backup')),
+                        (set(), set(), {'f.txt'}))
+
+    @tempdir()
+    def test_Policies(self, d):
+        base_path, backup_path = self.makeCopy(d)
+        for policy in elfi.COMPARE_POLICIES:
+            self.assertIsNone(self.compare(policy, base_path, backup_path),
+                            policy)
+
+        #let the coarse ctime clock move past the copy's
+        sleep(0.05)
+        mtime_ns = os.stat(base_path).st_mtime_ns
+        with open(base_path, 'ab') as f:
+            f.write(b'more')
+        os.utime(base_path, ns=(mtime_ns, mtime_ns))
+        self.assertEqual([policy for policy in sorted(elfi.COMPARE_POLICIES)
+                        if self.compare(policy, base_path, backup_path)],
+                        ['ctime', 'size_mtime'])
+
+        base_path, backup_path = self.makeCopy(d, 'g.txt')
+        sleep(0.05)
+        os.chmod(base_path, 0o600)
+        self.assertEqual([policy for policy in sorted(elfi.COMPARE_POLICIES)
+                        if self.compare(policy, base_path, backup_path)],
+                        ['attrs', 'ctime'])
+
+    @tempdir()
+    def test_OwnerKept(self, d):
+        if not elfi.PRESERVE_OWNER:
+            self.skipTest('needs root')
+        base_path, backup_path = self.makeCopy(d)
+        os.chown(base_path, 1234, 1234)
+        os.chmod(base_path, 0o4755)
+        abs_base, abs_backup = d.getpath('base'), d.getpath('backup')
+        diff_sets = elfi.diff_walk(abs_base, abs_backup,
+                compare=elfi.compare_attributes)
+        self.assertEqual(diff_sets, (set(), set(), {'f.txt'}))
+        for kwargs in ({}, {'copy_method': 'auto'}, {'small_file_size': 100}):
+            os.chown(backup_path, 0, 0)
+            stats = elfi.do_backup(abs_base, abs_backup, *diff_sets, **kwargs)
+            self.assertEqual(stats.failures, [])
+            backup_stat = os.stat(backup_path)
+            self.assertEqual((backup_stat.st_uid, backup_stat.st_gid,
+                            stat.S_IMODE(backup_stat.st_mode)),
+                            (1234, 1234, 0o4755))
+        self.assertEqual(elfi.diff_walk(abs_base, abs_backup,
+                        compare=elfi.compare_attributes), (set(), set(), set()))
+
+    def test_OwnerIgnoredWithoutRoot(self):
+        def file_stat(uid, mode=0o644):
+            return SimpleNamespace(st_mode=stat.S_IFREG | mode, st_size=4,
+                    st_mtime_ns=1500000000 * 1000000000, st_uid=uid, st_gid=uid)
+
+        for preserve_owner, change in ((False, None), (True, 'update')):
+            with patch('elfi.PRESERVE_OWNER', preserve_owner):
+                self.assertEqual(elfi.compare_attributes('base/f', 'backup/f',
+                                file_stat(1234), file_stat(0)), change)
+                self.assertEqual(elfi.compare_attributes('base/f', 'backup/f',
+                                file_stat(0, 0o600), file_stat(0)), 'update')
+
+    @tempdir()
+    def test_NoExtraStats(self, d):
+        d.write('base/a.txt', b'a')
+        d.write('base/hello/b.txt', b'b')
+        shutil.copytree(d.getpath('base'), d.getpath('backup'))
+        stat_calls = {}
+        for policy, compare in elfi.COMPARE_POLICIES.items():
+            metrics = elfi.Metrics()
+            with patch('os.stat', wraps=os.stat) as os_stat:
+                elfi.diff_walk(d.getpath('base'), d.getpath('backup'),
+                        compare=compare, observer=metrics)
+            stat_calls[policy] = (os_stat.call_count,
+                                metrics.counters['stat_calls'])
+        self.assertEqual(set(stat_calls.values()), {stat_calls['mtime']})
+
+    def test_CompareArgs(self):
+        for policy in ('mtime_s', 'size_mtime', 'ctime', 'attrs'):
+            self.assertEqual(elfi.parse_args(['--compare', policy, 'base',
+                            'backup']).compare, policy)
+        for argv in (['--compare', 'ctime', '--index', 'i.db'],
+                    ['--compare', 'attrs', '--index', 'i.db'],
+                    ['--compare', 'size']):
+            with patch('sys.stderr'), self.assertRaises(SystemExit):
+                elfi.parse_args(['base', 'backup'] + argv)
+
+
+class TestSmallFiles(unittest.TestCase):
+    @tempdir()
+    def test_SmallFileBatches(self, d):
+        for i in range(5):
+            d.write('base/f{}.txt'.format(i), b'x' * i)
+        d.write('base/hello/world.txt', b'world')
+        d.write('base/hello/big.bin', b'b' * 1000)
+        d.write('base/new/a/b.txt', b'b')
+        d.write('base/new/c.bin', b'c' * 1000)
+        d.makedir('base/new/empty')
+        os.chmod(d.getpath('base/f1.txt'), 0o640)
+        d.write('backup/hello/world.txt', b'old')
+        os.utime(d.getpath('backup/hello/world.txt'), (0, 0))
+        d.write('backup/gone.txt', b'gone')
+        abs_base, abs_backup = d.getpath('base'), d.getpath('backup')
+
+        diff_sets = elfi.diff_walk(abs_base, abs_backup)
+        with patch('elfi.SMALL_FILE_BATCH', 2), \
+                patch('elfi.copy_small_files',
+                        wraps=elfi.copy_small_files) as batches:
+            stats = elfi.do_backup(abs_base, abs_backup, *diff_sets, workers=2,
+                    copy_method='auto', small_file_size=100)
+        self.assertEqual(stats.failures, [])
+        self.assertEqual((stats.copied, stats.removed), (8, 1))
+        self.assertEqual(stats.bytes, 10 + 5 + 1000 + 1 + 1000)
+        self.assertEqual(stats.methods['batched'], 7)
+        self.assertEqual(sum(len(call[0][3])
+                            for call in batches.call_args_list), 7)
+        for call in batches.call_args_list:
+            self.assertLessEqual(len(call[0][3]), 2)
+
+        self.assertEqual(build_path_set_walk(abs_backup),
+                        build_path_set_walk(abs_base))
+        self.assertEqual(elfi.diff_walk(abs_base, abs_backup),
+                        (set(), set(), set()))
+        self.assertEqual(d.read('backup/f4.txt'), b'xxxx')
+        self.assertEqual(d.read('backup/new/a/b.txt'), b'b')
+        for relpath in ('f1.txt', 'new/', 'new/a/', 'hello/world.txt'):
+            base_stat = os.stat(os.path.join(abs_base, relpath))
+            backup_stat = os.stat(os.path.join(abs_backup, relpath))
+            self.assertEqual((base_stat.st_mode, base_stat.st_mtime_ns),
+                            (backup_stat.st_mode, backup_stat.st_mtime_ns))
+
+    @tempdir()
+    def test_SmallFileFailure(self, d):
+        d.write('base/a.txt', b'a')
+        d.write('base/b.txt', b'b')
+        d.write('base/new/c.txt', b'c')
+        d.makedir('backup')
+        abs_base, abs_backup = d.getpath('base'), d.getpath('backup')
+        failing_inode = os.stat(d.getpath('base/b.txt')).st_ino
+        copy_xattrs = elfi.copy_xattrs
+
+        def failing_copy_xattrs(src_fd, dst_fd):
+            if os.fstat(src_fd).st_ino == failing_inode:
+                raise OSError(errno.EIO, 'failed')
+            copy_xattrs(src_fd, dst_fd)
+
+        diff_sets = elfi.diff_walk(abs_base, abs_backup)
+        with patch('elfi.copy_xattrs', side_effect=failing_copy_xattrs):
+            stats = elfi.do_backup(abs_base, abs_backup, *diff_sets,
+                    small_file_size=100)
+        self.assertEqual(stats.copied, 2)
+        self.assertEqual([item for item, error in stats.failures], ['b.txt'])
+        self.assertEqual(sorted(os.listdir(abs_backup)), ['a.txt', 'new'])
+        self.assertEqual(d.read('backup/new/c.txt'), b'c')
+
+    def test_SmallFileArgs(self):
+        args = elfi.parse_args(['--small-files', '4K', 'base', 'backup'])
+        self.assertEqual(args.small_files, 4096)
+        with patch('sys.stderr'), self.assertRaises(SystemExit):
+            elfi.parse_args(['--small-files', '4K', '--target', 'nas', 'base',
+                            'backup'])
+
+
+class TestCopyFile(unittest.TestCase):
+    @tempdir()
+    def test_CopyMethods(self, d):
+        content = os.urandom(3 * 1024 * 1024 + 17)
+        d.write('src', content)
+        src = d.getpath('src')
+        for method in elfi.COPY_METHODS:
+            dst = d.getpath('dst_' + method)
+            try:
+                used = elfi.copy_file(src, dst, method)
+            except OSError:
+                self.assertNotEqual(method, 'auto',
+                                    'auto should always fall back.')
+                continue
+            if method != 'auto':
+                self.assertEqual(used, method)
+            self.assertEqual(d.read(dst), content)
+            self.assertEqual(os.stat(dst).st_mtime_ns, os.stat(src).st_mtime_ns)
+
+    @tempdir()
+    def test_ShortCopy(self, d):
+        d.write('src', b'contents')
+
+        def short_copy(src_fd, dst_fd, size):
+            raise elfi.ShortCopyError(0, size)
+
+        with patch.dict('elfi.COPY_FUNCTIONS', {'copy_file_range': short_copy}):
+            self.assertEqual(elfi.copy_file(d.getpath('src'), d.getpath('dst')),
+                            'sendfile')
+            self.assertEqual(d.read('dst'), b'contents')
+            with self.assertRaises(elfi.ShortCopyError):
+                elfi.copy_file(d.getpath('src'), d.getpath('dst'),
+                               'copy_file_range')
+
+        with patch('elfi.os.sendfile', return_value=0):
+            with self.assertRaises(elfi.ShortCopyError):
+                elfi.copy_sendfile(0, 1, 8)
+
+    @tempdir()
+    def test_AutoFallback(self, d):
+        d.write('base/foo.txt', b'foo')
+        d.write('base/hello/world.txt', b'world')
+        d.makedir('backup')
+
+        def unsupported(src_fd, dst_fd, size):
+            os.write(dst_fd, b'partial')
+            raise OSError(elfi.errno.EXDEV, 'cross-device')
+
+        functions = dict(elfi.COPY_FUNCTIONS, copy_file_range=unsupported,
+                            reflink=unsupported)
+        with patch.dict('elfi.COPY_FUNCTIONS', functions):
+            stats = elfi.do_backup(d.getpath('base'), d.getpath('backup'),
+                    {'foo.txt', 'hello/'}, set(), set(), copy_method='auto')
+
+        self.assertEqual(stats.failures, [])
+        self.assertEqual(stats.methods, {'sendfile': 2})
+        self.assertEqual(d.read('backup/foo.txt'), b'foo')
+        self.assertEqual(d.read('backup/hello/world.txt'), b'world')
+
+
+class TestJournal(unittest.TestCase):
+    @tempdir()
+    def test_AtomicCopy(self, d):
+        d.write('src', b'new contents')
+        d.write('dst', b'old')
+
+        def failing_copy(src_fd, dst_fd, size):
+            os.write(dst_fd, b'partial')
+            raise OSError(elfi.errno.EIO, 'I/O error')
+
+        with patch.dict('elfi.COPY_FUNCTIONS', {'buffered': failing_copy}):
+            with self.assertRaises(OSError):
+                elfi.copy_file(d.getpath('src'), d.getpath('dst'), 'buffered')
+        self.assertEqual(d.read('dst'), b'old')
+        self.assertEqual(sorted(os.listdir(d.path)), ['dst', 'src'])
+
+        d.makedir('backup')
+        with patch('elfi.shutil.copystat', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                elfi.copy_to_backup(d.path, d.getpath('backup'), 'src')
+        self.assertEqual(os.listdir(d.getpath('backup')), [])
+
+        elfi.copy_file(d.getpath('src'), d.getpath('dst'))
+        self.assertEqual(d.read('dst'), b'new contents')
+
+    @tempdir()
+    def test_Resume(self, d):
+        dirtree = tuple('file{}.txt'.format(i) for i in range(6)) + (
+                    ('hello', ('world.txt',)),)
+        make_dir_tree(d, dirtree, relpath='base')
+        d.write('backup/stale.txt', b'')
+        abs_base = d.getpath('base')
+        abs_backup = d.getpath('backup')
+        journal = elfi.Journal(d.getpath('journal.db'))
+
+        class Crash(Exception):
+            pass
+
+        copy_to_backup = elfi.copy_to_backup
+        def crashing_copy(base, backup, relpath, **kwargs):
+            if relpath == 'file3.txt':
+                raise Crash()
+            return copy_to_backup(base, backup, relpath, **kwargs)
+
+        diff_sets = elfi.diff_walk(abs_base, abs_backup)
+        with patch('elfi.copy_to_backup', side_effect=crashing_copy):
+            with self.assertRaises(Crash):
+                elfi.do_backup(abs_base, abs_backup, *diff_sets,
+                               journal=journal)
+        journal.close()
+
+        journal = elfi.Journal(d.getpath('journal.db'))
+        self.assertEqual(journal.run, (abs_base, abs_backup))
+        pending = list(journal.pending())
+        self.assertIn(('add', 'file3.txt'), pending)
+        self.assertNotIn(('remove', 'stale.txt'), pending)
+        self.assertNotIn(('add', 'file0.txt'), pending)
+
+        stats = elfi.backup_stream(abs_base, abs_backup, journal.pending(),
+                journal=journal)
+        self.assertEqual(stats.failures, [])
+        self.assertEqual(stats.copied, len(pending))
+        self.assertTrue(dir_tree_matches(abs_backup, dirtree))
+        self.assertIsNone(journal.run)
+        self.assertEqual(list(journal.pending()), [])
+
+    def test_ResumeArgs(self):
+        for argv in (['--resume'], ['--journal', 'j.db'],
+                    ['--apply', '--journal', 'j.db', '--archive', 'gz',
+                        '--index', 'i.db']):
+            with patch('sys.stderr'), self.assertRaises(SystemExit):
+                elfi.parse_args(['base', 'backup'] + argv)
+        args = elfi.parse_args(['base', 'backup', '--resume', '--journal',
+                                'j.db'])
+        self.assertTrue(args.resume)
+
+
+class TestThrottle(unittest.TestCase):
+    def test_OpsLimit(self):
+        throttle = elfi.Throttle(ops_per_sec=200)
+        start = time()
+        for _ in range(300):
+            throttle.wait()
+        #the first 200 are the initial burst
+        self.assertGreaterEqual(time() - start, 0.45)
+
+    def test_BytesLimit(self):
+        throttle = elfi.Throttle(bytes_per_sec=1000)
+        throttle.wait()
+        throttle.charge(1500, 0.0)
+        start = time()
+        throttle.wait()
+        self.assertGreaterEqual(time() - start, 0.45)
+
+    def test_Adaptive(self):
+        throttle = elfi.Throttle(bytes_per_sec=1000000, adaptive=True)
+        with patch('elfi.THROTTLE_ADAPT_INTERVAL', 0):
+            for _ in range(5):
+                throttle.charge(1000000, 0.01)
+            self.assertEqual(throttle.scale, 1.0)
+            for _ in range(20):
+                throttle.charge(1000000, 1.0)
+            self.assertEqual(throttle.scale, elfi.THROTTLE_MIN_SCALE)
+            for _ in range(100):
+                throttle.charge(1000000, 0.01)
+            self.assertEqual(throttle.scale, 1.0)
+
+    @tempdir()
+    def test_ThrottledBackup(self, d):
+        d.write('base/foo.txt', b'foo')
+        d.write('base/hello/world.txt', b'world')
+        d.write('base/hello/sub/bar.txt', b'bar')
+        d.write('backup/stale.txt', b'')
+
+        class CountingThrottle(elfi.Throttle):
+            def charge(self, nbytes, seconds):
+                charges.append(nbytes)
+                super().charge(nbytes, seconds)
+
+        charges = []
+        abs_base = d.getpath('base')
+        abs_backup = d.getpath('backup')
+        stats = elfi.do_backup(abs_base, abs_backup,
+                *elfi.diff_walk(abs_base, abs_backup),
+                throttle=CountingThrottle(bytes_per_sec=1000000,
+                                          ops_per_sec=1000))
+        self.assertEqual(stats.failures, [])
+        self.assertEqual(sorted(charges), [0, 3, 3, 5])
+
+        with patch('sys.stderr'), self.assertRaises(SystemExit):
+            elfi.parse_args(['base', 'backup', '--adaptive-throttle'])
+        args = elfi.parse_args(['base', 'backup', '--bwlimit', '50M',
+                '--ops-limit', '100'])
+        self.assertEqual((args.bwlimit, args.ops_limit),
+                        (50 * 1024 * 1024, 100))
+
+
+class TestChunkStore(unittest.TestCase):
+    @tempdir()
+    def test_Deduplication(self, d):
+        d.write('base/a.bin', b'0123456789' * 3)
+        d.write('base/copy.bin', b'0123456789' * 3)
+        d.write('base/hello/b.txt', b'world')
+        d.makedir('base/empty')
+        abs_base = d.getpath('base')
+        store = elfi.ChunkStore(d.getpath('store'))
+
+        with patch('elfi.STORE_CHUNK_SIZE', 10):
+            stats = elfi.store_backup(abs_base, store, workers=2)
+            self.assertEqual(stats.failures, [])
+            self.assertEqual((stats.copied, stats.bytes), (3, 15))
+
+            stats = elfi.store_backup(abs_base, store)
+            self.assertEqual((stats.copied, stats.bytes, stats.removed),
+                            (0, 0, 0))
+
+            os.rename(d.getpath('base/hello'), d.getpath('base/moved'))
+            d.write('base/a.bin', b'0123456789' * 2 + b'abcdefghij')
+            later = int(round((time() + 10) * 1000000000))
+            os.utime(d.getpath('base/a.bin'), ns=(later, later))
+            stats = elfi.store_backup(abs_base, store)
+            self.assertEqual((stats.copied, stats.bytes, stats.removed),
+                            (2, 10, 2))
+
+        self.assertEqual(len(store.manifest_names()), 3)
+        manifest = store.load_manifest()
+        self.assertEqual(sorted(manifest), ['a.bin', 'copy.bin', 'empty/',
+                                            'moved/', 'moved/b.txt'])
+        self.assertEqual(len(manifest['a.bin']['chunks']), 3)
+
+        elfi.store_restore(store, d.getpath('restored'))
+        self.assertEqual(build_path_set_walk(d.getpath('restored')),
+                        build_path_set_walk(abs_base))
+        self.assertEqual(d.read('restored/a.bin'), d.read('base/a.bin'))
+        self.assertEqual(os.stat(d.getpath('restored/a.bin')).st_mtime_ns,
+                        later)
+
+        elfi.store_restore(store, d.getpath('first'), store.manifest_names()[0])
+        self.assertEqual(d.read('first/hello/b.txt'), b'world')
+
+    def test_StoreArgs(self):
+        for argv in (['--store'], ['--restore', 'latest'],
+                    ['--store', '--apply', '--index', 'i.db']):
+            with patch('sys.stderr'), self.assertRaises(SystemExit):
+                elfi.parse_args(['base', 'backup'] + argv)
+
+    @tempdir()
+    def test_FailedFileKept(self, d):
+        d.write('base/a.txt', b'first')
+        d.write('base/hello/b.txt', b'world')
+        abs_base = d.getpath('base')
+        store = elfi.ChunkStore(d.getpath('store'))
+        elfi.store_backup(abs_base, store)
+
+        d.write('base/a.txt', b'second')
+        d.write('base/hello/b.txt', b'changed')
+        store_file = elfi.store_file
+        def failing_store_file(store, path):
+            if path.endswith('a.txt'):
+                raise PermissionError(errno.EACCES, 'Permission denied', path)
+            return store_file(store, path)
+
+        scan_dir = elfi.scan_dir
+        def failing_scan_dir(path):
+            if path.rstrip(os.path.sep).endswith('hello'):
+                raise PermissionError(errno.EACCES, 'Permission denied', path)
+            return scan_dir(path)
+
+        with patch('elfi.store_file', side_effect=failing_store_file), \
+                patch('elfi.scan_dir', side_effect=failing_scan_dir):
+            stats = elfi.store_backup(abs_base, store)
+        self.assertEqual(len(stats.failures), 2)
+        self.assertEqual(stats.removed, 0)
+        self.assertEqual(sorted(store.load_manifest()), ['a.txt', 'hello/',
+                                                        'hello/b.txt'])
+
+        elfi.store_restore(store, d.getpath('restored'))
+        self.assertEqual(d.read('restored/a.txt'), b'first')
+        self.assertEqual(d.read('restored/hello/b.txt'), b'world')
+
+
+class TestTargets(unittest.TestCase):
+    @tempdir()
+    def test_FanOut(self, d):
+        d.write('base/foo.txt', b'foo')
+        d.write('base/hello/world.txt', b'world')
+        d.write('base/hello/new.txt', b'new')
+        d.write('base/alpha/beta.txt', b'beta')
+        d.write('nas/hello/world.txt', b'old')
+        os.utime(d.getpath('nas/hello/world.txt'), (0, 0))
+        d.write('nas/gone.txt', b'gone')
+        abs_base = d.getpath('base')
+        backups = [d.getpath('local'), d.getpath('nas')]
+
+        scanned = []
+        scan_dir = elfi.scan_dir
+        def recording_scan_dir(path):
+            scanned.append(path)
+            return scan_dir(path)
+        with patch('elfi.scan_dir', side_effect=recording_scan_dir):
+            diff_sets = elfi.diff_walk_targets(abs_base, backups, workers=2)
+        base_scans = [path for path in scanned if path.startswith(abs_base)]
+        self.assertEqual(len(base_scans), len(set(base_scans)))
+        self.assertEqual(diff_sets, [
+            ({'foo.txt', 'hello/', 'alpha/'}, set(), set()),
+            ({'foo.txt', 'alpha/', 'hello/new.txt'}, {'gone.txt'},
+                {'hello/world.txt'})])
+
+        read = []
+        fan_out_file = elfi.fan_out_file
+        def recording_fan_out_file(src, dsts):
+            read.append(src)
+            return fan_out_file(src, dsts)
+        with patch('elfi.fan_out_file', side_effect=recording_fan_out_file):
+            all_stats = elfi.do_backup_targets(abs_base, backups, diff_sets,
+                    workers=2)
+        self.assertEqual(sorted(read), sorted(os.path.join(abs_base, path)
+                        for path in ('foo.txt', 'hello/world.txt',
+                                    'hello/new.txt', 'alpha/beta.txt')))
+        self.assertEqual([(stats.copied, stats.removed, stats.bytes,
+                            stats.failures) for stats in all_stats],
+                        [(3, 0, 15, []), (4, 1, 15, [])])
+        for backup in backups:
+            self.assertEqual(build_path_set_walk(backup),
+                            build_path_set_walk(abs_base))
+        self.assertEqual(d.read('nas/hello/world.txt'), b'world')
+        self.assertEqual(elfi.diff_walk_targets(abs_base, backups),
+                        [(set(), set(), set())] * 2)
+
+    @tempdir()
+    def test_FanOutFailure(self, d):
+        d.write('base/foo.txt', b'foo' * 100)
+        d.makedir('ok')
+        dsts = {0: d.getpath('ok/foo.txt'), 1: d.getpath('missing/foo.txt')}
+        with patch('elfi.COPY_BUFFER_SIZE', 64):
+            size, failures = elfi.fan_out_file(d.getpath('base/foo.txt'), dsts)
+        self.assertEqual(size, 300)
+        self.assertEqual(list(failures), [1])
+        self.assertIsInstance(failures[1], FileNotFoundError)
+        self.assertEqual(d.read('ok/foo.txt'), b'foo' * 100)
+        self.assertEqual(os.listdir(d.getpath('ok')), ['foo.txt'])
+        self.assertEqual(os.stat(d.getpath('ok/foo.txt')).st_mtime_ns,
+                        os.stat(d.getpath('base/foo.txt')).st_mtime_ns)
+
+    def test_TargetArgs(self):
+        args = elfi.parse_args(['base', 'backup', '--target', 'nas',
+                                '--target', 'offsite'])
+        self.assertEqual(args.target, ['nas', 'offsite'])
+        for argv in (['--target', 'nas', '--snapshot', '-a'],
+                    ['--target', 'nas', '--copy-method', 'buffered']):
+            with patch('sys.stderr'), self.assertRaises(SystemExit):
+                elfi.parse_args(['base', 'backup'] + argv)
+
+
+class TestWatch(unittest.TestCase):
+    def writeChanges(self, d):
+        d.write('base/hello/new.txt', b'new')
+        os.remove(d.getpath('base/gone.txt'))
+        d.write('base/alpha/beta/gamma.txt', b'gamma')
+        d.write('base/foo.txt', b'changed')
+        later = int(round((time() + 10) * 1000000000))
+        os.utime(d.getpath('base/foo.txt'), ns=(later, later))
+        os.rename(d.getpath('base/hello/world'), d.getpath('base/moved'))
+
+    def makeTree(self, d):
+        d.write('base/foo.txt', b'foo')
+        d.write('base/gone.txt', b'gone')
+        d.write('base/hello/world/banana', b'banana')
+        return d.getpath('base'), d.getpath('backup')
+
+    @tempdir()
+    def test_ChangedDirs(self, d):
+        abs_base, abs_backup = self.makeTree(d)
+        elfi.do_backup(abs_base, abs_backup,
+                       *elfi.diff_walk(abs_base, abs_backup))
+        self.writeChanges(d)
+        d.write('base/alpha/beta/delta/epsilon', b'epsilon')
+
+        with patch('elfi.scan_dir', wraps=elfi.scan_dir) as scan_dir:
+            diff_sets = elfi.diff_changed_dirs(abs_base, abs_backup,
+                    {'', 'hello/', 'alpha/beta/', 'alpha/beta/delta/'})
+        self.assertEqual(diff_sets, ({'hello/new.txt', 'alpha/', 'moved/'},
+                                    {'gone.txt', 'hello/world/'}, {'foo.txt'}))
+        self.assertEqual(scan_dir.call_count, 4)
+
+    @tempdir()
+    def test_WatchInotify(self, d):
+        abs_base, abs_backup = self.makeTree(d)
+        try:
+            elfi.InotifyWatcher(abs_base).close()
+        except OSError:
+            self.skipTest('inotify not available')
+
+        with patch('elfi.diff_walk', wraps=elfi.diff_walk) as diff_walk:
+            batches = elfi.watch_backup(abs_base, abs_backup, interval=0.2)
+            self.assertEqual(next(batches).copied, 3)
+            self.writeChanges(d)
+            d.write('base/alpha/beta/delta/epsilon', b'epsilon')
+            stats = next(batches)
+            self.assertEqual((stats.copied, stats.removed, stats.failures),
+                            (4, 2, []))
+            self.assertEqual(build_path_set_walk(abs_backup),
+                            build_path_set_walk(abs_base))
+
+            d.write('base/alpha/beta/delta/zeta', b'zeta')
+            stats = next(batches)
+            self.assertEqual((stats.copied, stats.removed), (1, 0))
+            self.assertEqual(d.read('backup/alpha/beta/delta/zeta'), b'zeta')
+            batches.close()
+        self.assertEqual(diff_walk.call_count, 1)
+
+    @tempdir()
+    def test_WatchLimit(self, d):
+        abs_base, abs_backup = self.makeTree(d)
+        try:
+            watcher = elfi.InotifyWatcher(abs_base)
+        except OSError:
+            self.skipTest('inotify not available')
+        try:
+            d.makedir('base/new')
+            with patch.object(watcher, 'add_watches', side_effect=OSError(
+                    errno.ENOSPC, 'No space left on device')), \
+                    patch('sys.stdout'):
+                self.assertIsNone(watcher.read(1.0))
+            d.write('base/hello/more', b'more')
+            self.assertEqual(watcher.read(1.0), {'hello/'})
+        finally:
+            watcher.close()
+
+    @tempdir()
+    def test_WatchPolling(self, d):
+        abs_base, abs_backup = self.makeTree(d)
+        with patch('elfi.InotifyWatcher', side_effect=OSError(errno.ENOSYS,
+                'inotify not available')), patch('sys.stdout'):
+            batches = elfi.watch_backup(abs_base, abs_backup, interval=0.05)
+            self.assertEqual(next(batches).copied, 3)
+            self.writeChanges(d)
+            stats = next(batches)
+            batches.close()
+        self.assertEqual((stats.copied, stats.removed), (4, 2))
+        self.assertEqual(build_path_set_walk(abs_backup),
+                        build_path_set_walk(abs_base))
+
+    def test_WatchArgs(self):
+        args = elfi.parse_args(['--watch', '--interval', '2.5', 'base',
+                                'backup'])
+        self.assertEqual((args.watch, args.interval), (True, 2.5))
+        for argv in (['--interval', '0'], ['--watch', '--snapshot'],
+                    ['--watch', '--target', 'nas']):
+            with patch('sys.stderr'), self.assertRaises(SystemExit):
+                elfi.parse_args(['base', 'backup'] + argv)
+
+
+class TestSnapshot(unittest.TestCase):
+    @tempdir()
+    def test_LinkDest(self, d):
+        d.write('base/same.txt', b'same')
+        d.write('base/changed.txt', b'old')
+        d.write('base/gone.txt', b'gone')
+        d.write('base/hello/world.txt', b'world')
+        abs_base, abs_backup = d.getpath('base'), d.getpath('backup')
+
+        first, stats = elfi.snapshot_backup(abs_base, abs_backup)
+        self.assertEqual((stats.copied, stats.linked, stats.failures),
+                        (4, 0, []))
+        d.makedir('backup/.elfi-20000101-000000-000000000.partial')
+
+        d.write('base/changed.txt', b'new')
+        later = int(round((time() + 10) * 1000000000))
+        os.utime(d.getpath('base/changed.txt'), ns=(later, later))
+        os.remove(d.getpath('base/gone.txt'))
+        d.write('base/added.txt', b'added')
+        second, stats = elfi.snapshot_backup(abs_base, abs_backup, workers=2)
+        self.assertEqual((stats.copied, stats.linked, stats.failures),
+                        (2, 2, []))
+
+        self.assertEqual(elfi.list_snapshots(abs_backup), [first, second])
+        self.assertEqual(sorted(os.listdir(abs_backup)), [first, second])
+        self.assertEqual(build_path_set_walk(os.path.join(abs_backup, second)),
+                        build_path_set_walk(abs_base))
+        self.assertEqual(d.read('backup/{}/changed.txt'.format(first)), b'old')
+        self.assertEqual(d.read('backup/{}/changed.txt'.format(second)), b'new')
+        for relpath in ('same.txt', 'hello/world.txt'):
+            self.assertTrue(os.path.samefile(
+                d.getpath('backup/{}/{}'.format(first, relpath)),
+                d.getpath('backup/{}/{}'.format(second, relpath))))
+        self.assertFalse(os.path.samefile(
+            d.getpath('backup/{}/changed.txt'.format(first)),
+            d.getpath('backup/{}/changed.txt'.format(second))))
+
+    @tempdir()
+    def test_Retention(self, d):
+        names = ['elfi-20240131-120000-000000000',  # January
+                'elfi-20240228-120000-000000000',  # week 9
+                'elfi-20240229-090000-000000000',  # week 9, latest of February
+                'elfi-20240301-120000-000000000',  # latest of week 9
+                'elfi-20240304-080000-000000000',  # week 10
+                'elfi-20240304-120000-000000000']  # latest, week 10, March
+        for name in names:
+            os.makedirs(d.getpath('backup/' + name + '/dir'), exist_ok=True)
+        abs_backup = d.getpath('backup')
+
+        self.assertEqual(elfi.prune_snapshots(abs_backup), names[-2::-1])
+        for name in names:
+            os.makedirs(d.getpath('backup/' + name + '/dir'), exist_ok=True)
+        self.assertEqual(elfi.prune_snapshots(abs_backup, keep_last=2,
+                                              keep_daily=2),
+                        [names[2], names[1], names[0]])
+        for name in names:
+            os.makedirs(d.getpath('backup/' + name + '/dir'), exist_ok=True)
+        self.assertEqual(elfi.prune_snapshots(abs_backup, keep_weekly=2,
+                        keep_monthly=3), [names[4], names[1]])
+        self.assertEqual(elfi.list_snapshots(abs_backup),
+                        [names[0], names[2], names[3], names[5]])
+
+    def test_SnapshotArgs(self):
+        args = elfi.parse_args(['base', 'backup', '--snapshot', '-a',
+                                '--keep-last', '3', '--keep-monthly', '12'])
+        self.assertEqual((args.keep_last, args.keep_daily, args.keep_monthly),
+                        (3, 0, 12))
+        for argv in (['--snapshot'], ['-a', '--keep-last', '2'],
+                    ['--snapshot', '-a', '--archive'],
+                    ['--snapshot', '-a', '--keep-daily', '0']):
+            with patch('sys.stderr'), self.assertRaises(SystemExit):
+                elfi.parse_args(['base', 'backup'] + argv)
+
+
+class TestArchive(unittest.TestCase):
+    @tempdir()
+    def test_ArchiveCompressions(self, d):
+        d.write('base/foo.txt', b'foo' * 1000)
+        d.write('base/hello/world.txt', b'world')
+        d.makedir('archives')
+        events = [('add', 'foo.txt'), ('add', 'hello/'), ('remove', 'gone.txt')]
+
+        for compression in ('none', 'gz', 'bz2', 'xz'):
+            path = d.getpath(os.path.join('archives',
+                                          elfi.archive_name(compression)))
+            stats = elfi.archive_stream(d.getpath('base'), path, events,
+                                        compression)
+            self.assertEqual(stats.copied, 2)
+            self.assertEqual(stats.removed, 1)
+            self.assertEqual(stats.bytes, 3005)
+            self.assertEqual(sorted(os.listdir(d.getpath('archives'))),
+                            [os.path.basename(path)],
+                            'Temporary file left behind.')
+
+            with elfi.tarfile.open(path, 'r:*') as tar:
+                self.assertEqual(tar.getnames(), ['foo.txt', 'hello',
+                                'hello/world.txt', elfi.ARCHIVE_MANIFEST])
+                self.assertEqual(tar.extractfile('hello/world.txt').read(),
+                                b'world')
+                manifest = elfi.json.load(
+                        tar.extractfile(elfi.ARCHIVE_MANIFEST))
+            self.assertEqual(manifest, {'add': ['foo.txt', 'hello/'],
+                                        'update': [], 'remove': ['gone.txt']})
+            os.remove(path)
+
+    @tempdir()
+    def test_IncrementalArchive(self, d):
+        d.write('base/foo.txt', b'foo')
+        d.write('base/hello/world.txt', b'world')
+        d.makedir('archives')
+        abs_base = d.getpath('base')
+        abs_archives = d.getpath('archives')
+        index = elfi.BackupIndex(d.getpath('index.db'))
+        index.clear()
+
+        def archive(name):
+            events = elfi.iter_diff(abs_base, abs_archives, index=index)
+            return elfi.archive_stream(abs_base,
+                    os.path.join(abs_archives, name), events, 'gz', index)
+
+        self.assertEqual(archive('first.tar.gz').copied, 2)
+        os.remove(d.getpath('base/foo.txt'))
+        d.write('base/hello/new.txt', b'new')
+
+        stats = archive('second.tar.gz')
+        self.assertEqual((stats.copied, stats.removed), (1, 1))
+        second = os.path.join(abs_archives, 'second.tar.gz')
+        with elfi.tarfile.open(second) as tar:
+            self.assertEqual(tar.getnames(),
+                            ['hello/new.txt', elfi.ARCHIVE_MANIFEST])
+        self.assertEqual(elfi.diff_walk(abs_base, abs_archives, index=index),
+                        (set(), set(), set()))
+
+    @tempdir()
+    def test_ArchiveNotOverwritten(self, d):
+        d.write('base/foo.txt', b'foo')
+        d.write('archives/existing.tar.gz', b'old')
+        index = elfi.BackupIndex(d.getpath('index.db'))
+        index.clear()
+
+        path = d.getpath('archives/existing.tar.gz')
+        with self.assertRaises(FileExistsError):
+            elfi.archive_stream(d.getpath('base'), path, [('add', 'foo.txt')],
+                    'gz', index)
+        self.assertEqual(d.read('archives/existing.tar.gz'), b'old')
+        self.assertEqual(os.listdir(d.getpath('archives')), ['existing.tar.gz'])
+        self.assertEqual(index.scan_dir(''), {},
+                        'Index recorded a lost archive.')
+        self.assertNotEqual(elfi.archive_name('gz'), elfi.archive_name('gz'))
+
+    @tempdir()
+    def test_FailedItemBytes(self, d):
+        d.write('base/foo.txt', b'foo')
+        d.makedir('archives')
+        path = d.getpath('archives/out.tar')
+        stats = elfi.archive_stream(d.getpath('base'), path,
+                [('add', 'foo.txt'), ('add', 'missing.txt')], 'none')
+        self.assertEqual([item for item, error in stats.failures],
+                        ['missing.txt'])
+        self.assertEqual(stats.bytes, 3)
+
+    @tempdir()
+    def test_TruncatedMember(self, d):
+        for name in ('a.txt', 'b.txt', 'c.txt'):
+            d.write('base/' + name, b'data' * 1000)
+        d.makedir('archives')
+        index = elfi.BackupIndex(d.getpath('index.db'))
+        index.clear()
+
+        copyfileobj = elfi.tarfile.copyfileobj
+        def shrinking_copy(src, dst, length=None, *args, **kwargs):
+            if src.name.endswith('b.txt'):
+                dst.write(src.read(length // 2))
+                raise OSError('unexpected end of data')
+            return copyfileobj(src, dst, length, *args, **kwargs)
+
+        path = d.getpath('archives/out.tar.gz')
+        events = [('add', 'a.txt'), ('add', 'b.txt'), ('add', 'c.txt')]
+        with patch('tarfile.copyfileobj', side_effect=shrinking_copy):
+            with self.assertRaises(OSError):
+                elfi.archive_stream(d.getpath('base'), path, events, 'gz',
+                                    index)
+        self.assertEqual(os.listdir(d.getpath('archives')), [],
+                        'Broken archive or temporary file left behind.')
+        self.assertEqual(index.scan_dir(''), {},
+                        'Index recorded a lost archive.')
+
+    def test_WriterError(self):
+        class FullDisk:
+            def write(self, data):
+                raise OSError(elfi.errno.ENOSPC, 'No space left on device')
+
+        writer = elfi.CompressingWriter(FullDisk(), elfi.NullCompressor())
+        with patch('elfi.ARCHIVE_CHUNK_SIZE', 4):
+            with self.assertRaises(OSError):
+                for _ in range(100):
+                    writer.write(b'data')
+                writer.close()
+        with self.assertRaises(OSError):
+            writer.close()
+
+
+class TestPathFilter(unittest.TestCase):
+    def test_GlobRules(self):
+        path_filter = elfi.PathFilter(['node_modules/', '*.pyc', '/build/',
+                'docs/**/*.tmp', '[!a]x'], ['keep.pyc'], [r'(^|/)cache/'])
+        for path in ('node_modules/', 'src/node_modules/', 'x.pyc',
+                    'src/lib/x.pyc', 'build/', 'docs/t.tmp', 'docs/a/b/t.tmp',
+                    'bx', 'src/cache/'):
+            self.assertTrue(path_filter.excluded(path), path)
+        for path in ('node_modules', 'keep.pyc', 'src/build/', 'src/docs/t.tmp',
+                    'ax', 'mycache/', 'foo.txt'):
+            self.assertFalse(path_filter.excluded(path), path)
+
+    @tempdir()
+    def test_ExcludedNotListed(self, d):
+        d.write('base/src/main.py', b'main')
+        d.write('base/src/main.pyc', b'')
+        d.write('base/node_modules/lib/index.js', b'')
+        d.write('base/lib/node_modules/index.js', b'')
+        d.write('base/new/main.py', b'new')
+        d.write('base/new/main.pyc', b'')
+        d.write('backup/old.pyc', b'')
+        d.write('backup/old.txt', b'')
+
+        abs_base = d.getpath('base')
+        abs_backup = d.getpath('backup')
+        path_filter = elfi.PathFilter(['node_modules/', '*.pyc'])
+
+        scanned = []
+        scan_dir = elfi.scan_dir
+        def recording_scan_dir(path):
+            scanned.append(path)
+            return scan_dir(path)
+
+        with patch('elfi.scan_dir', side_effect=recording_scan_dir):
+            diff_sets = elfi.diff_walk(abs_base, abs_backup,
+                                       path_filter=path_filter)
+        self.assertEqual(diff_sets,
+                        ({'src/', 'lib/', 'new/'}, {'old.txt'}, set()))
+        for path in scanned:
+            self.assertNotIn('node_modules', path,
+                            'Excluded directory was listed.')
+
+        stats = elfi.do_backup(abs_base, abs_backup, *diff_sets,
+                path_filter=path_filter)
+        self.assertEqual(stats.failures, [])
+        self.assertEqual(build_path_set_walk(abs_backup),
+                        {'old.pyc', 'src/', 'src/main.py', 'lib/', 'new/',
+                            'new/main.py'})
+        self.assertEqual(elfi.diff_walk(abs_base, abs_backup,
+                                        path_filter=path_filter),
+                        (set(), set(), set()))
+
+    def test_FilterArgs(self):
+        args = elfi.parse_args(['base', 'backup', '--exclude', '*.o',
+                '--exclude-regex', r'\.tmp$', '--include', 'keep.o'])
+        self.assertEqual((args.exclude, args.exclude_regex, args.include),
+                        (['*.o'], [r'\.tmp$'], ['keep.o']))
+        with patch('sys.stderr'), self.assertRaises(SystemExit):
+            elfi.parse_args(['base', 'backup', '--exclude-regex', '('])
+
+
+class TestMetrics(unittest.TestCase):
+    @tempdir()
+    def test_Metrics(self, d):
+        d.write('base/same.txt', b'same')
+        d.write('base/hello/new.txt', b'new')
+        d.write('base/hello/world/changed.txt', b'changed')
+        d.write('backup/same.txt', b'same')
+        d.write('backup/hello/world/changed.txt', b'')
+        d.write('backup/old.txt', b'')
+        later = int(round((time() + 10) * 1000000000))
+        os.utime(d.getpath('base/hello/world/changed.txt'), ns=(later, later))
+
+        abs_base = d.getpath('base')
+        abs_backup = d.getpath('backup')
+        metrics = elfi.Metrics(slowest=2)
+        diff_sets = elfi.diff_walk(abs_base, abs_backup, observer=metrics)
+        stats = elfi.do_backup(abs_base, abs_backup, *diff_sets,
+                               observer=metrics)
+        self.assertEqual(stats.failures, [])
+
+        result = metrics.as_dict()
+        self.assertEqual(result['counters'], {'dirs_listed': 3,
+                'entries_listed': 10, 'stat_calls': 4, 'entries_copied': 2,
+                'bytes_copied': 10, 'entries_removed': 1})
+        self.assertEqual(sorted(result['phases']), ['backup', 'walk'])
+        self.assertEqual(len(result['slowest_dirs']), 2)
+        self.assertEqual(len(result['slowest_entries']), 2)
+        seconds = [entry['seconds'] for entry in result['slowest_dirs']]
+        self.assertEqual(seconds, sorted(seconds, reverse=True))
+
+    @tempdir()
+    def test_StatsOutput(self, d):
+        d.write('base/foo.txt', b'foo')
+        d.makedir('backup')
+        args = elfi.parse_args([d.getpath('base'), d.getpath('backup'),
+                '--apply', '--stats', d.getpath('stats.json'), '--profile',
+                d.getpath('run.prof'), '--trace-memory'])
+        with patch('sys.stdout'):
+            self.assertEqual(elfi.profiled_main(args), 0)
+
+        with open(d.getpath('stats.json')) as f:
+            result = elfi.json.load(f)
+        self.assertEqual(result['counters']['entries_copied'], 1)
+        self.assertEqual(sorted(result['phases']), ['backup', 'total', 'walk'])
+        self.assertGreater(result['memory']['peak'], 0)
+        self.assertTrue(os.path.getsize(d.getpath('run.prof')))
+        with patch('sys.stderr'), self.assertRaises(SystemExit):
+            elfi.parse_args(['base', 'backup', '--trace-memory'])
+
+
+class TestDiffResult(unittest.TestCase):
+    def test_DiffResult(self):
+        paths = ['hello/world/foo.txt', 'hello/', 'b.txt', 'b/', 'b/c', 'b0',
+                'hello/world.txt', 'alpha/beta/gamma/']
+        result = elfi.DiffResult()
+        for path in paths:
+            result.add('add', path)
+        result.add('remove', 'hello/')
+        result.add('update', 'alpha/x')
+
+        added = result.view('add')
+        self.assertEqual(list(added), sorted(paths))
+        self.assertEqual(added, set(paths))
+        self.assertEqual(len(added), len(paths))
+        self.assertEqual(len(result.view('remove')), 0, 'Duplicate kept.')
+        self.assertIn('b/', added)
+        self.assertNotIn('b', added)
+        self.assertNotIn('alpha/x', added)
+        self.assertNotIn('missing/b.txt', added)
+        self.assertEqual(result.view('update') | added,
+                        set(paths) | {'alpha/x'})
+        self.assertEqual(added - {'b/', 'b/c'}, set(paths) - {'b/', 'b/c'})
+        self.assertIsInstance(added - set(), set)
+
+    def test_ContainsBeforeIteration(self):
+        result = elfi.DiffResult()
+        for path in ('p/b', 'q/a', 'a', 'b'):
+            result.add('add', path)
+        added = result.view('add')
+        self.assertIn('b', added)
+        self.assertIn('a', added)
+        self.assertNotIn('c', added)
+
+        result = elfi.DiffResult()
+        for path in ('p/b', 'q/a', 'a', 'b'):
+            result.add('add', path)
+        result.discard('add', 'b')
+        self.assertEqual(list(result.view('add')), ['a', 'p/b', 'q/a'])
+
+    def test_SplitRelPath(self):
+        self.assertEqual(elfi.split_rel_path('a/b/'), ('a/', 'b/'))
+        self.assertEqual(elfi.split_rel_path('a/b.txt'), ('a/', 'b.txt'))
+        self.assertEqual(elfi.split_rel_path('b.txt'), ('', 'b.txt'))
+        self.assertEqual(elfi.split_rel_path('b/'), ('', 'b/'))
+
+
 class TestPathSet(unittest.TestCase):
     def setUp(self):
         self.depth_first_paths = (
@@ -447,5 +2026,12 @@ class TestPathSet(unittest.TestCase):
     def test_MixedOrderIncremental(self):
         pass
 
+    def test_FilePrefixNotSubtree(self):
+        paths = ('hello/foo', 'hello/foo.txt', 'hello/foo/',
+                    'hello/foo/bar.txt', 'hello/foo0/bar.txt')
+        answer = set(('hello/foo', 'hello/foo.txt', 'hello/foo/',
+                        'hello/foo0/bar.txt'))
+        self.assertEqual(elfi.build_backup_path_set(paths), answer)
+
 if __name__ == '__main__':
     unittest.main()